@@ -5,35 +5,47 @@ Port: 8080
 from flask import Flask, request, jsonify, Response
 from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
+from werkzeug.test import EnvironBuilder
+from concurrent.futures import ThreadPoolExecutor
 import jwt
+import redis
 import requests
+import pybreaker
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
 from functools import wraps
+from collections import OrderedDict, deque
+import hashlib
+import gzip
+import zlib
+import json
+import os
 import time
-import logging
-from pythonjsonlogger import jsonlogger
+import threading
 import uuid
 from prometheus_flask_exporter import PrometheusMetrics
+from common.log_shipping import setup_logging
+from common.access_log import init_access_log
 
-import logstash
+# Optional encoders for response compression (gzip is always available)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-# Configure Structured Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Console Handler (JSON)
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s')
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Logstash Handler
-logstash_handler = logstash.TCPLogstashHandler('logstash', 5000, version=1)
-logger.addHandler(logstash_handler)
+# Configure Structured Logging (JSON console + asynchronous Logstash shipping)
+logger = setup_logging()
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app, path=None)
+init_access_log(app, 'api-gateway')
 
-from prometheus_client import generate_latest
+from prometheus_client import generate_latest, REGISTRY, Counter, Summary
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
 
 @app.route('/metrics')
 def metrics_route():
@@ -47,14 +59,129 @@ app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 
 # Service URLs
 SERVICES = {
-    'customer': 'http://customer-service:5001',
-    'inventory': 'http://inventory-service:5002',
-    'order': 'http://order-service:5003',
-    'payment': 'http://payment-service:5004',
-    'shipping': 'http://shipping-service:5005',
-    'notification': 'http://notification-service:5006'
+    'customer': os.getenv('CUSTOMER_SERVICE_URL', 'http://customer-service:5001'),
+    'inventory': os.getenv('INVENTORY_SERVICE_URL', 'http://inventory-service:5002'),
+    'order': os.getenv('ORDER_SERVICE_URL', 'http://order-service:5003'),
+    'payment': os.getenv('PAYMENT_SERVICE_URL', 'http://payment-service:5004'),
+    'shipping': os.getenv('SHIPPING_SERVICE_URL', 'http://shipping-service:5005'),
+    'notification': os.getenv('NOTIFICATION_SERVICE_URL', 'http://notification-service:5006')
 }
 
+# Upstream Connection Pooling
+# One keep-alive session per backend service, so proxied calls reuse TCP
+# connections instead of opening a new one for every request.
+UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', '50'))  # Kept-alive connections per service
+UPSTREAM_POOL_BLOCK = os.getenv('UPSTREAM_POOL_BLOCK', 'false').lower() == 'true'  # Wait for a free connection instead of opening an extra one
+UPSTREAM_POOL_IDLE_TIMEOUT = float(os.getenv('UPSTREAM_POOL_IDLE_TIMEOUT', '60'))  # Seconds before an unused pool is closed
+
+class UpstreamPool:
+    """Pooled keep-alive HTTP session for a single upstream service"""
+
+    def __init__(self, name, base_url):
+        self.name = name
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.session = None
+        self.last_used = time.monotonic()
+        self.requests = 0
+        self.evictions = 0
+
+    def _new_session(self):
+        session = requests.Session()
+        # The session is shared by all users, never let it keep upstream cookies
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+            pool_block=UPSTREAM_POOL_BLOCK
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            if self.session is None:
+                self.session = self._new_session()
+            session = self.session
+            self.last_used = time.monotonic()
+            self.requests += 1
+        return session.request(method, url, **kwargs)
+
+    def evict_if_idle(self, now):
+        """Close all connections if the pool has not been used recently"""
+        with self.lock:
+            if self.session is None or now - self.last_used < UPSTREAM_POOL_IDLE_TIMEOUT:
+                return False
+            session, self.session = self.session, None
+            self.evictions += 1
+        session.close()
+        logger.info(f"Evicted idle connection pool for {self.name}", extra={'upstream': self.name})
+        return True
+
+    def connection_stats(self):
+        """Return (idle, created) connection counts for the pool"""
+        with self.lock:
+            session = self.session
+        if session is None:
+            return 0, 0
+        idle = created = 0
+        poolmanager = session.get_adapter(self.base_url).poolmanager
+        for key in list(poolmanager.pools.keys()):
+            pool = poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            idle += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            created += pool.num_connections
+        return idle, created
+
+UPSTREAM_POOLS = {name: UpstreamPool(name, url) for name, url in SERVICES.items()}
+UPSTREAM_POOLS_BY_URL = {pool.base_url: pool for pool in UPSTREAM_POOLS.values()}
+
+def get_upstream_pool(service_url):
+    """Return the pooled session for a service base URL"""
+    pool = UPSTREAM_POOLS_BY_URL.get(service_url)
+    if pool is None:
+        pool = UPSTREAM_POOLS_BY_URL.setdefault(service_url, UpstreamPool(service_url, service_url))
+    return pool
+
+def evict_idle_upstream_pools():
+    """Background loop closing connection pools that have been idle too long"""
+    while True:
+        time.sleep(max(UPSTREAM_POOL_IDLE_TIMEOUT / 2, 1))
+        now = time.monotonic()
+        for pool in list(UPSTREAM_POOLS_BY_URL.values()):
+            try:
+                pool.evict_if_idle(now)
+            except Exception as e:
+                logger.error(f"Pool eviction error: {str(e)}", extra={'upstream': pool.name})
+
+class UpstreamPoolCollector:
+    """Expose per-upstream pool statistics on /metrics"""
+
+    def collect(self):
+        idle = GaugeMetricFamily('gateway_upstream_pool_idle_connections',
+                                 'Idle keep-alive connections per upstream', labels=['upstream'])
+        maxsize = GaugeMetricFamily('gateway_upstream_pool_maxsize',
+                                    'Configured keep-alive pool size per upstream', labels=['upstream'])
+        created = CounterMetricFamily('gateway_upstream_pool_connections_created',
+                                      'Connections opened by the current pool per upstream', labels=['upstream'])
+        proxied = CounterMetricFamily('gateway_upstream_requests',
+                                      'Requests sent to each upstream', labels=['upstream'])
+        evictions = CounterMetricFamily('gateway_upstream_pool_evictions',
+                                        'Idle pool evictions per upstream', labels=['upstream'])
+        for pool in list(UPSTREAM_POOLS_BY_URL.values()):
+            pool_idle, pool_created = pool.connection_stats()
+            idle.add_metric([pool.name], pool_idle)
+            maxsize.add_metric([pool.name], UPSTREAM_POOL_MAXSIZE)
+            created.add_metric([pool.name], pool_created)
+            proxied.add_metric([pool.name], pool.requests)
+            evictions.add_metric([pool.name], pool.evictions)
+        return [idle, maxsize, created, proxied, evictions]
+
+REGISTRY.register(UpstreamPoolCollector())
+threading.Thread(target=evict_idle_upstream_pools, daemon=True).start()
+
 # RBAC Configuration - Define permissions for each role
 ROLE_PERMISSIONS = {
     'admin': {
@@ -90,12 +217,33 @@ from flask_limiter.util import get_remote_address
 
 
 
-# Rate Limiter Configuration
+# Rate Limiter Configuration (shared with the async engine in async_app.py)
+DEFAULT_RATE_LIMIT = "100 per 15 minutes"
+ORDER_CREATE_RATE_LIMIT = "50 per minute"
+PAYMENT_CREATE_RATE_LIMIT = "5 per minute"
+app.config['RATELIMIT_ENABLED'] = os.getenv('RATELIMIT_ENABLED', 'true').lower() == 'true'
+
+# Counters live in a shared store (e.g. redis://redis:6379) so every gateway
+# replica enforces the same limit instead of N times the configured one.
+# memory:// keeps counters in-process, which is what local runs and tests use.
+# The moving-window strategy is a sliding log; on Redis each check is a
+# single atomic Lua script call, so one round trip per request.
+RATELIMIT_STORAGE_URI = os.getenv('RATELIMIT_STORAGE_URI', 'memory://')
+RATELIMIT_STRATEGY = os.getenv('RATELIMIT_STRATEGY', 'moving-window')
+RATELIMIT_STORAGE_TIMEOUT = float(os.getenv('RATELIMIT_STORAGE_TIMEOUT', '0.5'))
+
 limiter = Limiter(
     get_remote_address,
     app=app,
-    default_limits=["100 per 15 minutes"],
-    storage_uri="memory://"
+    default_limits=[DEFAULT_RATE_LIMIT],
+    storage_uri=RATELIMIT_STORAGE_URI,
+    strategy=RATELIMIT_STRATEGY,
+    storage_options={
+        'socket_connect_timeout': RATELIMIT_STORAGE_TIMEOUT,
+        'socket_timeout': RATELIMIT_STORAGE_TIMEOUT
+    } if RATELIMIT_STORAGE_URI.startswith('redis') else {},
+    # Keep limiting per replica if the shared store is unreachable
+    in_memory_fallback_enabled=True
 )
 
 # ... (SERVICES, ROLE_PERMISSIONS)
@@ -117,94 +265,867 @@ def extract_token():
     except:
         return None
 
+# Verified-JWT Cache
+# Clients reuse the same token many times, so decoded claims are kept in a
+# bounded LRU keyed by a digest of the token. Entries never outlive the
+# token's own exp claim.
+JWT_CACHE_ENABLED = os.getenv('JWT_CACHE_ENABLED', 'true').lower() == 'true'
+JWT_CACHE_MAX_ENTRIES = int(os.getenv('JWT_CACHE_MAX_ENTRIES', '10000'))
+JWT_CACHE_TTL = float(os.getenv('JWT_CACHE_TTL', '300'))  # Upper bound in seconds, even for long-lived tokens
+JWT_CACHE_PREWARM_ON_LOGIN = os.getenv('JWT_CACHE_PREWARM_ON_LOGIN', 'true').lower() == 'true'
+
+jwt_cache_hits = Counter('gateway_jwt_cache_hits', 'Token verifications answered from the cache')
+jwt_cache_misses = Counter('gateway_jwt_cache_misses', 'Token verifications that needed jwt.decode')
+jwt_decode_seconds = Summary('gateway_jwt_decode_seconds', 'Time spent in jwt.decode on cache misses')
+
+class TokenCache:
+    """Bounded LRU/TTL cache of verified token claims"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # token digest -> (expires_at, claims)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self.key(token)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, claims = entry
+            if expires_at <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return claims
+
+    def put(self, token, claims):
+        now = time.time()
+        expires_at = now + self.ttl
+        if isinstance(claims.get('exp'), (int, float)):
+            expires_at = min(expires_at, claims['exp'])
+        if expires_at <= now:
+            return
+        key = self.key(token)
+        with self.lock:
+            self.entries[key] = (expires_at, claims)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+token_cache = TokenCache(JWT_CACHE_MAX_ENTRIES, JWT_CACHE_TTL)
+
 def verify_token(token):
     """Verify JWT token and return decoded data"""
+    if JWT_CACHE_ENABLED:
+        claims = token_cache.get(token)
+        if claims is not None:
+            jwt_cache_hits.inc()
+            return claims
+        jwt_cache_misses.inc()
     try:
-        decoded = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        return decoded
+        with jwt_decode_seconds.time():
+            decoded = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
+    if JWT_CACHE_ENABLED:
+        token_cache.put(token, decoded)
+    return decoded
+
+# RBAC Decision Table
+# ROLE_PERMISSIONS is compiled once at startup into a frozen set of
+# (role, resource, method) triples, so a permission check is one set lookup.
+PERMISSION_TABLE = frozenset(
+    (role, resource, method)
+    for role, resources in ROLE_PERMISSIONS.items()
+    for resource, methods in resources.items()
+    for method in methods
+)
 
 def check_permission(user_role, resource, method, user_id=None, resource_id=None):
     """Check if user role has permission for the resource and method"""
-    # Check if role exists
-    if user_role not in ROLE_PERMISSIONS:
-        return False
-    
-    # Check if resource is allowed for this role
-    if resource not in ROLE_PERMISSIONS[user_role]:
-        return False
-    
-    # Check if method is allowed
-    if method not in ROLE_PERMISSIONS[user_role][resource]:
+    if (user_role, resource, method) not in PERMISSION_TABLE:
         return False
     
     # Special check for customer role - only own resources
-    if user_role == 'customer':
-        # For customer-specific resources
-        if resource == 'customers' and resource_id and str(resource_id) != str(user_id):
+    if user_role == 'customer' and resource == 'customers':
+        if resource_id and str(resource_id) != str(user_id):
             return False
     
     return True
 
-def proxy_request(service_url, path, method, headers, data=None, params=None):
+# WSGI environ key carrying the pre-verified user of a batch part (never set from HTTP headers)
+BATCH_USER_ENVIRON_KEY = 'gateway.batch_user'
+
+def require_permission(resource, resource_id_arg=None, public_methods=()):
+    """Authenticate the caller and enforce RBAC for a gateway resource.
+    
+    On success the decoded token is stored in g.user and the headers to
+    forward (with X-User-Id / X-User-Role added) in g.forward_headers.
+    Methods listed in public_methods skip authentication.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method in public_methods:
+                g.user = None
+                g.forward_headers = request.headers
+                return f(*args, **kwargs)
+            
+            # Parts of a batch request were already authenticated by batch_api
+            user = request.environ.get(BATCH_USER_ENVIRON_KEY)
+            if user is None:
+                token = extract_token()
+                if not token:
+                    return jsonify({'error': 'Token required'}), 401
+                
+                user = verify_token(token)
+                if not user:
+                    return jsonify({'error': 'Invalid or expired token'}), 401
+            
+            resource_id = kwargs.get(resource_id_arg) if resource_id_arg else None
+            if not check_permission(user['role'], resource, request.method, user['user_id'], resource_id):
+                return jsonify({'error': 'Insufficient permissions'}), 403
+            
+            # Add user context to headers for the service
+            headers = dict(request.headers)
+            headers['X-User-Id'] = str(user['user_id'])
+            headers['X-User-Role'] = user['role']
+            g.user = user
+            g.forward_headers = headers
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+# Response Streaming Configuration
+# Upstream bodies are forwarded chunk by chunk so gateway memory per request
+# stays bounded by the chunk size, whatever the size of the response.
+PROXY_STREAM_RESPONSES = os.getenv('PROXY_STREAM_RESPONSES', 'true').lower() == 'true'
+PROXY_STREAM_CHUNK_SIZE = int(os.getenv('PROXY_STREAM_CHUNK_SIZE', str(64 * 1024)))
+PROXY_MAX_BUFFER_BYTES = int(os.getenv('PROXY_MAX_BUFFER_BYTES', str(1024 * 1024)))  # Above this a buffered response switches to streaming
+
+# Hop-by-hop headers (RFC 7230 section 6.1) are meaningful for a single connection only
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'
+}
+
+def strip_hop_by_hop(header_items):
+    """Drop hop-by-hop headers, including those named in the Connection header"""
+    header_items = list(header_items)
+    connection_tokens = set()
+    for k, v in header_items:
+        if k.lower() == 'connection':
+            connection_tokens.update(t.strip().lower() for t in v.split(',') if t.strip())
+    return [(k, v) for k, v in header_items
+            if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() not in connection_tokens]
+
+def upstream_response_headers(upstream):
+    """Headers safe to send back to the client for an upstream response"""
+    # raw.headers keeps repeated headers (e.g. Set-Cookie) as separate entries
+    raw_items = list(upstream.raw.headers.items())
+    chunked = any(k.lower() == 'transfer-encoding' for k, _ in raw_items)
+    headers = strip_hop_by_hop(raw_items)
+    if chunked:
+        # Transfer-Encoding overrides Content-Length; the server re-frames the body
+        headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+    return headers
+
+def stream_upstream_body(upstream, prefix=b''):
+    """Yield the upstream body as it arrives, without decoding it"""
+    try:
+        if prefix:
+            yield prefix
+        while True:
+            chunk = upstream.raw.read(PROXY_STREAM_CHUNK_SIZE, decode_content=False)
+            if not chunk:
+                break
+            yield chunk
+    except Exception as e:
+        # Headers are already sent, the client only sees a truncated body
+        logger.error(f"Upstream stream interrupted: {str(e)}", extra={'service_url': upstream.url})
+    finally:
+        upstream.close()
+
+def read_upstream_body(upstream):
+    """Read up to PROXY_MAX_BUFFER_BYTES of the body, returning (body, complete)"""
+    body = upstream.raw.read(PROXY_MAX_BUFFER_BYTES + 1, decode_content=False)
+    if len(body) > PROXY_MAX_BUFFER_BYTES:
+        return body, False
+    upstream.close()
+    return body, True
+
+class UpstreamSnapshot:
+    """Status, headers and buffered body of an upstream response.
+    
+    Bodies larger than PROXY_MAX_BUFFER_BYTES are left incomplete: the
+    upstream stays open and to_response() streams the remainder.
+    """
+
+    def __init__(self, upstream):
+        self.status = upstream.status_code
+        self.headers = upstream_response_headers(upstream)
+        self.body, self.complete = read_upstream_body(upstream)
+        self.upstream = None if self.complete else upstream
+
+    def to_response(self):
+        if not self.complete:
+            # Too large to hold in memory, forward the rest as a stream
+            return Response(stream_upstream_body(self.upstream, prefix=self.body),
+                            status=self.status, headers=self.headers)
+        # The body length is known now, let Flask set Content-Length
+        headers = [(k, v) for k, v in self.headers if k.lower() != 'content-length']
+        return Response(self.body, status=self.status, headers=headers)
+
+def build_proxy_response(upstream, stream):
+    """Turn an upstream response into a Flask response, streamed or buffered"""
+    if stream:
+        return Response(stream_upstream_body(upstream), status=upstream.status_code,
+                        headers=upstream_response_headers(upstream))
+    return UpstreamSnapshot(upstream).to_response()
+
+def error_response(message, status):
+    """JSON error as a Response object, so callers can inspect status_code"""
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+def forward_headers(headers, correlation_id):
+    """Headers to send upstream for an incoming request"""
+    # Remove hop-by-hop headers; Host and Content-Length are recomputed for the upstream call
+    headers_to_forward = {k: v for k, v in strip_hop_by_hop(headers.items())
+                          if k.lower() not in ['host', 'content-length']}
+    
+    # Add Correlation ID to downstream headers
+    headers_to_forward['X-Correlation-ID'] = correlation_id
+    # Only let the backend compress what the client can decode, since encoded bodies pass through
+    # (without this requests would advertise its own "gzip, deflate")
+    headers_to_forward['Accept-Encoding'] = headers.get('Accept-Encoding') or 'identity'
+    return headers_to_forward
+
+# Upstream Circuit Breakers, Bulkheads and Adaptive Timeouts
+# Each upstream gets its own breaker (timeouts, connection errors and 5xx
+# count as failures), a cap on concurrent in-flight calls so one hanging
+# service cannot take every gateway worker thread, and a timeout derived from
+# its recent latency instead of a fixed 10 seconds. Requests rejected by an
+# open breaker or a full bulkhead fail immediately with 503.
+UPSTREAM_BREAKER_FAIL_MAX = int(os.getenv('UPSTREAM_BREAKER_FAIL_MAX', '5'))  # Consecutive failures before opening
+UPSTREAM_BREAKER_RESET_TIMEOUT = float(os.getenv('UPSTREAM_BREAKER_RESET_TIMEOUT', '30'))  # Seconds open before a trial call
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '20'))  # In-flight calls per upstream
+UPSTREAM_BULKHEAD_WAIT = float(os.getenv('UPSTREAM_BULKHEAD_WAIT', '0.05'))  # Seconds to wait for a free slot
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '2'))
+UPSTREAM_TIMEOUT_MIN = float(os.getenv('UPSTREAM_TIMEOUT_MIN', '1'))
+UPSTREAM_TIMEOUT_MAX = float(os.getenv('UPSTREAM_TIMEOUT_MAX', '10'))
+UPSTREAM_TIMEOUT_PERCENTILE = float(os.getenv('UPSTREAM_TIMEOUT_PERCENTILE', '99'))
+UPSTREAM_TIMEOUT_MULTIPLIER = float(os.getenv('UPSTREAM_TIMEOUT_MULTIPLIER', '3'))  # Headroom over the percentile
+UPSTREAM_LATENCY_WINDOW = int(os.getenv('UPSTREAM_LATENCY_WINDOW', '200'))  # Recent successful calls sampled
+UPSTREAM_LATENCY_MIN_SAMPLES = 20  # Below this the maximum timeout is used
+
+CIRCUIT_STATE_VALUES = {pybreaker.STATE_CLOSED: 0, pybreaker.STATE_HALF_OPEN: 1, pybreaker.STATE_OPEN: 2}
+
+upstream_fast_failed = Counter('gateway_upstream_fast_failed',
+                               'Requests rejected without calling the upstream', ['upstream', 'reason'])
+
+class UpstreamServerError(Exception):
+    """5xx answer from an upstream, raised so the breaker counts it as a failure"""
+
+    def __init__(self, response):
+        super().__init__(f"Upstream returned {response.status_code}")
+        self.response = response
+
+class UpstreamRejected(Exception):
+    """Request failed fast because the upstream is unhealthy or saturated"""
+
+    def __init__(self, upstream, reason):
+        super().__init__(f"{upstream} rejected: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+class BreakerStateLogger(pybreaker.CircuitBreakerListener):
+    """Log circuit breaker transitions"""
+
+    def state_change(self, cb, old_state, new_state):
+        logger.warning(f"Circuit breaker for {cb.name} is now {new_state.name}",
+                       extra={'upstream': cb.name, 'previous_state': old_state.name if old_state else None})
+
+class UpstreamGuard:
+    """Circuit breaker, bulkhead and adaptive timeout for one upstream"""
+
+    def __init__(self, name):
+        self.name = name
+        # On the tripping call the caller still gets the real error (timeout, 5xx)
+        self.breaker = pybreaker.CircuitBreaker(
+            fail_max=UPSTREAM_BREAKER_FAIL_MAX,
+            reset_timeout=UPSTREAM_BREAKER_RESET_TIMEOUT,
+            exclude=[UpstreamRejected],
+            listeners=[BreakerStateLogger()],
+            name=name,
+            throw_new_error_on_trip=False
+        )
+        self.bulkhead = threading.BoundedSemaphore(UPSTREAM_MAX_CONCURRENCY)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latencies = deque(maxlen=UPSTREAM_LATENCY_WINDOW)
+
+    def timeout(self):
+        """Read timeout from the recent latency percentile, clamped to the configured range"""
+        with self.lock:
+            samples = sorted(self.latencies)
+        if len(samples) < UPSTREAM_LATENCY_MIN_SAMPLES:
+            return UPSTREAM_TIMEOUT_MAX
+        index = min(len(samples) - 1, int(len(samples) * UPSTREAM_TIMEOUT_PERCENTILE / 100))
+        return min(UPSTREAM_TIMEOUT_MAX, max(UPSTREAM_TIMEOUT_MIN, samples[index] * UPSTREAM_TIMEOUT_MULTIPLIER))
+
+    def call(self, send):
+        """Run send(timeout) under the breaker and bulkhead, returning the upstream response"""
+        if not self.bulkhead.acquire(timeout=UPSTREAM_BULKHEAD_WAIT):
+            upstream_fast_failed.labels(self.name, 'bulkhead_full').inc()
+            raise UpstreamRejected(self.name, 'bulkhead_full')
+        with self.lock:
+            self.in_flight += 1
+        try:
+            return self.breaker.call(self._timed_send, send)
+        except pybreaker.CircuitBreakerError:
+            upstream_fast_failed.labels(self.name, 'circuit_open').inc()
+            raise UpstreamRejected(self.name, 'circuit_open')
+        except UpstreamServerError as e:
+            return e.response
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.bulkhead.release()
+
+    def _timed_send(self, send):
+        start = time.monotonic()
+        response = send((UPSTREAM_CONNECT_TIMEOUT, self.timeout()))
+        # Time to response headers; the body is streamed after the slot is released
+        if response.status_code >= 500:
+            raise UpstreamServerError(response)
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        return response
+
+UPSTREAM_GUARDS = {}
+UPSTREAM_GUARDS_LOCK = threading.Lock()
+
+def get_upstream_guard(service_url):
+    """Return the resilience guard for a service base URL"""
+    name = get_upstream_pool(service_url).name
+    guard = UPSTREAM_GUARDS.get(name)
+    if guard is None:
+        with UPSTREAM_GUARDS_LOCK:
+            guard = UPSTREAM_GUARDS.setdefault(name, UpstreamGuard(name))
+    return guard
+
+class UpstreamGuardCollector:
+    """Expose breaker state, in-flight calls and current timeout per upstream on /metrics"""
+
+    def collect(self):
+        state = GaugeMetricFamily('gateway_upstream_circuit_state',
+                                  'Circuit breaker state per upstream (0=closed, 1=half-open, 2=open)', labels=['upstream'])
+        in_flight = GaugeMetricFamily('gateway_upstream_in_flight',
+                                      'Calls currently holding a bulkhead slot per upstream', labels=['upstream'])
+        timeout = GaugeMetricFamily('gateway_upstream_timeout_seconds',
+                                    'Current adaptive read timeout per upstream', labels=['upstream'])
+        for guard in list(UPSTREAM_GUARDS.values()):
+            state.add_metric([guard.name], CIRCUIT_STATE_VALUES.get(guard.breaker.current_state, 0))
+            in_flight.add_metric([guard.name], guard.in_flight)
+            timeout.add_metric([guard.name], guard.timeout())
+        return [state, in_flight, timeout]
+
+for _service_url in SERVICES.values():
+    get_upstream_guard(_service_url)
+REGISTRY.register(UpstreamGuardCollector())
+
+def send_upstream(service_url, path, method, headers, data=None, params=None):
+    """Send a request through the service's connection pool, leaving the body unread"""
+    pool = get_upstream_pool(service_url)
+    return get_upstream_guard(service_url).call(lambda timeout: pool.request(
+        method,
+        f"{service_url}{path}",
+        headers=headers,
+        params=params if method == 'GET' else None,
+        json=data if method in ('POST', 'PUT') else None,
+        timeout=timeout,
+        stream=True
+    ))
+
+def upstream_error_response(e, url, correlation_id):
+    """Map an upstream call failure to the gateway's error response"""
+    if isinstance(e, UpstreamRejected):
+        logger.warning(f"Fast-failed request to {url}: {e.reason}", extra={'correlation_id': correlation_id, 'upstream': e.upstream})
+        response = error_response('Service temporarily unavailable', 503)
+        if e.reason == 'circuit_open':
+            response.headers['Retry-After'] = str(int(UPSTREAM_BREAKER_RESET_TIMEOUT))
+        return response
+    if isinstance(e, requests.exceptions.Timeout):
+        logger.error(f"Service timeout: {url}", extra={'correlation_id': correlation_id})
+        return error_response('Service timeout', 504)
+    if isinstance(e, requests.exceptions.ConnectionError):
+        logger.error(f"Service unavailable: {url}", extra={'correlation_id': correlation_id})
+        return error_response('Service unavailable', 503)
+    logger.error(f"Proxy error: {str(e)}", extra={'correlation_id': correlation_id, 'stack': str(e)})
+    return error_response(str(e), 500)
+
+# Request Coalescing (single-flight)
+# Identical concurrent GETs (same upstream, path, query and user scope) share
+# one upstream call: the first caller fetches, the others wait for its
+# buffered result. Only responses that fit in PROXY_MAX_BUFFER_BYTES can be
+# shared; for larger ones the waiters make their own call.
+PROXY_COALESCE_GETS = os.getenv('PROXY_COALESCE_GETS', 'true').lower() == 'true'
+
+# Request headers that change the upstream response and so must match
+COALESCE_KEY_HEADERS = ('X-User-Id', 'X-User-Role', 'Accept', 'Accept-Encoding')
+
+coalesced_requests = Counter('gateway_coalesced_requests',
+                             'GET requests answered by another in-flight upstream call', ['upstream'])
+coalesce_leader_requests = Counter('gateway_coalesce_leader_requests',
+                                   'Coalescable GET requests that made the upstream call', ['upstream'])
+
+class SingleFlight:
+    """Run one call per key at a time and share its result with concurrent callers"""
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (result, shared); shared is True if another caller ran fn"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+single_flight = SingleFlight()
+
+def coalesce_key(service_url, path, params, headers):
+    items = (params.items(multi=True) if hasattr(params, 'getlist') else params.items()) if params else []
+    query = '&'.join(f"{k}={v}" for k, v in sorted(items))
+    scope = tuple(headers.get(h, '') for h in COALESCE_KEY_HEADERS)
+    return (service_url, path, query) + scope
+
+def fetch_snapshot(service_url, path, headers, params):
+    """GET an upstream resource as a snapshot, coalescing identical in-flight calls"""
+    upstream_name = get_upstream_pool(service_url).name
+    
+    def fetch():
+        coalesce_leader_requests.labels(upstream_name).inc()
+        return UpstreamSnapshot(send_upstream(service_url, path, 'GET', headers, params=params))
+    
+    if not PROXY_COALESCE_GETS:
+        return fetch()
+    
+    snapshot, shared = single_flight.do(coalesce_key(service_url, path, params, headers), fetch)
+    if shared:
+        if not snapshot.complete:
+            # The leader is streaming its body, it can't be shared
+            return UpstreamSnapshot(send_upstream(service_url, path, 'GET', headers, params=params))
+        coalesced_requests.labels(upstream_name).inc()
+    return snapshot
+
+def proxy_request(service_url, path, method, headers, data=None, params=None, stream=None):
     """Forward request to microservice"""
     url = f"{service_url}{path}"
+    if stream is None:
+        stream = PROXY_STREAM_RESPONSES
+    
+    correlation_id = g.correlation_id
+    if params is None:
+        # Query parameters (filters, limit/after cursors) pass through to the service
+        params = request.args
     
-    # Ensure Correlation ID
-    correlation_id = request.headers.get('X-Correlation-ID') or str(uuid.uuid4())
+    if method not in ('GET', 'POST', 'PUT', 'DELETE'):
+        return error_response('Method not allowed', 405)
     
     try:
-        # Remove hop-by-hop headers
-        headers_to_forward = {k: v for k, v in headers.items() 
-                              if k.lower() not in ['host', 'connection']}
-        
-        # Add Correlation ID to downstream headers
-        headers_to_forward['X-Correlation-ID'] = correlation_id
-        
-        logger.info(f"Proxying request to {url}", extra={
+        logger.debug("Proxying request to %s", url, extra={
             'method': method,
             'service_url': url,
             'correlation_id': correlation_id
         })
+        headers_to_forward = forward_headers(headers, correlation_id)
         
-        if method == 'GET':
-            response = requests.get(url, headers=headers_to_forward, params=params, timeout=10)
-        elif method == 'POST':
-            response = requests.post(url, headers=headers_to_forward, json=data, timeout=10)
-        elif method == 'PUT':
-            response = requests.put(url, headers=headers_to_forward, json=data, timeout=10)
-        elif method == 'DELETE':
-            response = requests.delete(url, headers=headers_to_forward, timeout=10)
-        else:
-            return jsonify({'error': 'Method not allowed'}), 405
+        # Idempotent reads may share an in-flight upstream call
+        if method == 'GET' and PROXY_COALESCE_GETS:
+            return fetch_snapshot(service_url, path, headers_to_forward, params).to_response()
+        
+        # The body is always read lazily, build_proxy_response decides how
+        response = send_upstream(service_url, path, method, headers_to_forward, data, params)
         
         # Return response from microservice
-        return Response(
-            response.content,
-            status=response.status_code,
-            headers=dict(response.headers)
-        )
-    except requests.exceptions.Timeout:
-        logger.error(f"Service timeout: {url}", extra={'correlation_id': correlation_id})
-        return jsonify({'error': 'Service timeout'}), 504
-    except requests.exceptions.ConnectionError:
-        logger.error(f"Service unavailable: {url}", extra={'correlation_id': correlation_id})
-        return jsonify({'error': 'Service unavailable'}), 503
+        return build_proxy_response(response, stream)
     except Exception as e:
-        logger.error(f"Proxy error: {str(e)}", extra={'correlation_id': correlation_id, 'stack': str(e)})
-        return jsonify({'error': str(e)}), 500
+        return upstream_error_response(e, url, correlation_id)
+
+# Response Compression
+# JSON from the backends is compressed here according to the client's
+# Accept-Encoding, so services can keep returning plain jsonify() output.
+# A body the backend already encoded (Content-Encoding set) passes through
+# untouched. Streamed responses (large or unbuffered bodies) are not
+# compressed; cached responses keep their compressed variants.
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))  # Smaller bodies are sent as is
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '6'))  # gzip/zstd level, brotli quality
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/javascript', 'application/xml', 'text/')
+
+COMPRESSORS = OrderedDict()  # In server preference order
+DECOMPRESSORS = {'gzip': gzip.decompress, 'deflate': zlib.decompress}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda body: zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(body)
+    DECOMPRESSORS['zstd'] = lambda body: zstandard.ZstdDecompressor().decompressobj().decompress(body)
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=min(COMPRESSION_LEVEL, 11))
+    DECOMPRESSORS['br'] = brotli.decompress
+COMPRESSORS['gzip'] = lambda body: gzip.compress(body, compresslevel=min(COMPRESSION_LEVEL, 9), mtime=0)
+
+compressed_responses = Counter('gateway_compressed_responses',
+                               'Responses sent compressed by the gateway', ['encoding'])
+compression_saved_bytes = Counter('gateway_compression_saved_bytes',
+                                  'Bytes saved by gateway response compression', ['encoding'])
+
+def negotiate_encoding():
+    """Best content coding the client accepts, or None for identity"""
+    if not COMPRESSION_ENABLED or not request.accept_encodings:
+        return None
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+def is_compressible(mimetype, size):
+    return size >= COMPRESSION_MIN_SIZE and (mimetype or '').startswith(COMPRESSIBLE_MIMETYPES)
+
+def compress_body(body, encoding):
+    """Encoded body, or None when compression does not make it smaller"""
+    compressed = COMPRESSORS[encoding](body)
+    if len(compressed) >= len(body):
+        return None
+    return compressed
+
+def decompress_body(body, encoding):
+    """Decoded body, or None for an unknown or corrupt encoding"""
+    decoder = DECOMPRESSORS.get(encoding)
+    if decoder is None:
+        return None
+    try:
+        return decoder(body)
+    except Exception:
+        return None
+
+def variant_etag(etag, encoding):
+    """Distinct strong validator for an encoded representation"""
+    return f'"{etag.strip(chr(34))}-{encoding}"'
+
+def record_compression(encoding, original_size, compressed_size):
+    compressed_responses.labels(encoding).inc()
+    compression_saved_bytes.labels(encoding).inc(original_size - compressed_size)
+
+@app.after_request
+def compress_response(response):
+    """Compress buffered responses when the client accepts an encoding"""
+    if not COMPRESSION_ENABLED or response.is_streamed or response.direct_passthrough:
+        return response
+    if response.status_code not in (200, 201) or 'Content-Encoding' in response.headers:
+        return response
+    if 'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+    body = response.get_data()
+    if not is_compressible(response.mimetype, len(body)):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    compressed = compress_body(body, encoding) if encoding else None
+    if compressed is None:
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = variant_etag(response.headers['ETag'], encoding)
+    record_compression(encoding, len(body), len(compressed))
+    return response
+
+# Public Response Cache
+# Product reads are the highest-volume route and the catalog rarely changes,
+# so successful GET responses are cached per path and query with an ETag.
+# Writes through products_proxy invalidate the cache. Stock changes made by
+# order-service directly on inventory-service are only picked up when the
+# entry expires, so TTLs stay short.
+# A write invalidates every replica, not just the one that served it: it
+# bumps a counter in Redis (the rate limiter's store by default) that each
+# replica polls at most every RESPONSE_CACHE_SYNC_INTERVAL seconds on its
+# next cache lookup, dropping its cached products when the counter moved.
+# Without a shared store (memory://, or Redis unreachable) other replicas
+# serve the old catalog for up to the TTL plus the stale-while-revalidate window.
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+RESPONSE_CACHE_STALE_WHILE_REVALIDATE = float(os.getenv('RESPONSE_CACHE_STALE_WHILE_REVALIDATE', '30'))
+PRODUCTS_LIST_CACHE_TTL = float(os.getenv('PRODUCTS_LIST_CACHE_TTL', '10'))
+PRODUCT_DETAIL_CACHE_TTL = float(os.getenv('PRODUCT_DETAIL_CACHE_TTL', '30'))
+RESPONSE_CACHE_SYNC_URI = os.getenv('RESPONSE_CACHE_SYNC_URI',
+                                    RATELIMIT_STORAGE_URI if RATELIMIT_STORAGE_URI.startswith('redis') else '')
+RESPONSE_CACHE_SYNC_INTERVAL = float(os.getenv('RESPONSE_CACHE_SYNC_INTERVAL', '1'))  # Max lag of a remote invalidation
+RESPONSE_CACHE_SYNC_RETRY = 30  # Seconds before polling an unreachable store again
+RESPONSE_CACHE_SYNC_KEY = 'gateway:response-cache:invalidations'
+
+response_cache_requests = Counter('gateway_response_cache_requests',
+                                  'Cacheable requests by cache result', ['route', 'result'])
+
+class CachedResponse:
+    """Buffered upstream response with its validator"""
+
+    def __init__(self, status, headers, body, ttl):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.ttl = ttl
+        self.stored_at = time.monotonic()
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        mimetype = next((v.split(';')[0].strip() for k, v in headers if k.lower() == 'content-type'), '')
+        self.compressible = is_compressible(mimetype, len(body))
+        self.variants = {}  # Encoded bodies by content coding, filled on first use
+
+    def age(self):
+        return time.monotonic() - self.stored_at
+
+    def encoded(self, encoding):
+        """Body compressed with encoding, or None to send it as is"""
+        if not self.compressible:
+            return None
+        if encoding not in self.variants:
+            # Racing threads compute the same bytes, keeping either is fine
+            self.variants[encoding] = compress_body(self.body, encoding)
+        return self.variants[encoding]
+
+class ResponseCache:
+    """Bounded LRU cache of GET responses with stale-while-revalidate"""
+
+    def __init__(self, max_entries, stale_while_revalidate):
+        self.max_entries = max_entries
+        self.stale_while_revalidate = stale_while_revalidate
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.generation = 0  # Bumped on invalidation so in-flight refreshes are discarded
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """Return (entry, state) where state is 'fresh', 'stale' or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None, None
+            age = entry.age()
+            if age < entry.ttl:
+                self.entries.move_to_end(key)
+                return entry, 'fresh'
+            if age < entry.ttl + self.stale_while_revalidate:
+                return entry, 'stale'
+            del self.entries[key]
+            return None, None
+
+    def put(self, key, entry, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def start_refresh(self, key):
+        """Claim the background refresh of a key, returning the cache generation"""
+        with self.lock:
+            if key in self.refreshing:
+                return None
+            self.refreshing.add(key)
+            return self.generation
+
+    def end_refresh(self, key):
+        with self.lock:
+            self.refreshing.discard(key)
+
+    def invalidate(self, prefix):
+        with self.lock:
+            self.generation += 1
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+class CacheInvalidationSync:
+    """Shares a ResponseCache's invalidations between gateway replicas through a Redis counter"""
+
+    def __init__(self, cache, uri, interval):
+        self.cache = cache
+        self.client = redis.Redis.from_url(uri, socket_connect_timeout=RATELIMIT_STORAGE_TIMEOUT,
+                                           socket_timeout=RATELIMIT_STORAGE_TIMEOUT)
+        self.interval = interval
+        self.seen = None  # Counter value the local cache is in line with
+        self.next_poll = 0.0
+        self.lock = threading.Lock()
+
+    def poll(self):
+        """Drop the cached entries if any replica invalidated them since the last poll"""
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_poll:
+                return
+            self.next_poll = now + self.interval  # Claimed: concurrent lookups don't poll too
+        try:
+            counter = int(self.client.get(RESPONSE_CACHE_SYNC_KEY) or 0)
+        except redis.RedisError as e:
+            logger.warning(f"Response cache sync unreachable, other replicas' writes show after the TTL: {str(e)}")
+            with self.lock:
+                self.next_poll = now + RESPONSE_CACHE_SYNC_RETRY
+            return
+        if self.seen is not None and counter != self.seen:
+            self.cache.invalidate('')
+        self.seen = counter
+
+    def publish(self):
+        """Tell the other replicas to drop their cached entries"""
+        try:
+            self.client.incr(RESPONSE_CACHE_SYNC_KEY)
+        except redis.RedisError as e:
+            logger.warning(f"Could not share a response cache invalidation: {str(e)}")
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_STALE_WHILE_REVALIDATE)
+response_cache_sync = (CacheInvalidationSync(response_cache, RESPONSE_CACHE_SYNC_URI, RESPONSE_CACHE_SYNC_INTERVAL)
+                       if RESPONSE_CACHE_ENABLED and RESPONSE_CACHE_SYNC_URI else None)
+
+def response_cache_key(path, params):
+    return path + '?' + '&'.join(f"{k}={v}" for k, v in sorted(params.items(multi=True)))
+
+def cache_entry_from_snapshot(snapshot, ttl):
+    """Cache entry for a complete 200 snapshot, or None if it can't be cached"""
+    if snapshot.status != 200 or not snapshot.complete:
+        return None
+    headers = [(k, v) for k, v in snapshot.headers
+               if k.lower() not in ('content-length', 'date', 'set-cookie', 'etag', 'cache-control',
+                                    'content-encoding', 'vary')]
+    # The cache holds the identity body; a backend-encoded body is kept as a ready variant
+    encoding = next((v.strip().lower() for k, v in snapshot.headers if k.lower() == 'content-encoding'), None)
+    body = snapshot.body
+    if encoding and encoding != 'identity':
+        body = decompress_body(snapshot.body, encoding)
+        if body is None:
+            return None
+    entry = CachedResponse(snapshot.status, headers, body, ttl)
+    if encoding in COMPRESSORS and entry.compressible:
+        entry.variants[encoding] = snapshot.body
+    return entry
+
+def refresh_cached_response(key, service_url, path, params, ttl, generation):
+    """Background revalidation of a stale cache entry"""
+    correlation_id = str(uuid.uuid4())
+    try:
+        snapshot = UpstreamSnapshot(send_upstream(service_url, path, 'GET', {'X-Correlation-ID': correlation_id}, params=params))
+        if snapshot.upstream is not None:
+            snapshot.upstream.close()
+        entry = cache_entry_from_snapshot(snapshot, ttl)
+        if entry is not None:
+            response_cache.put(key, entry, generation)
+    except Exception as e:
+        logger.warning(f"Cache refresh failed for {path}: {str(e)}", extra={'correlation_id': correlation_id})
+    finally:
+        response_cache.end_refresh(key)
+
+def serve_cached(entry, cache_result):
+    """Build the client response for a cache entry, honouring If-None-Match and Accept-Encoding"""
+    encoding = negotiate_encoding() if entry.compressible else None
+    body = entry.encoded(encoding) if encoding else None
+    etag = entry.etag
+    headers = list(entry.headers)
+    if body is None:
+        body = entry.body
+    else:
+        etag = variant_etag(etag, encoding)
+        headers.append(('Content-Encoding', encoding))
+    if entry.compressible:
+        headers.append(('Vary', 'Accept-Encoding'))
+    headers += [
+        ('ETag', etag),
+        ('Cache-Control', f"public, max-age={int(entry.ttl)}, stale-while-revalidate={int(RESPONSE_CACHE_STALE_WHILE_REVALIDATE)}"),
+        ('X-Cache', cache_result.upper())
+    ]
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return Response(status=304, headers=[(k, v) for k, v in headers
+                                             if k.lower() not in ('content-type', 'content-encoding')])
+    if body is not entry.body:
+        record_compression(encoding, len(entry.body), len(body))
+    return Response(body, status=entry.status, headers=headers)
+
+def cached_proxy_request(service_url, path, ttl, route):
+    """GET through the response cache, falling back to a normal proxied call"""
+    params = request.args
+    if not RESPONSE_CACHE_ENABLED:
+        return proxy_request(service_url, path, 'GET', g.forward_headers, params=params)
+    
+    if response_cache_sync is not None:
+        response_cache_sync.poll()
+    key = response_cache_key(path, params)
+    entry, state = response_cache.lookup(key)
+    if state == 'stale':
+        # Serve the stale copy now and revalidate in the background
+        generation = response_cache.start_refresh(key)
+        if generation is not None:
+            threading.Thread(target=refresh_cached_response,
+                             args=(key, service_url, path, params.copy(), ttl, generation),
+                             daemon=True).start()
+    if entry is not None:
+        response_cache_requests.labels(route, 'hit' if state == 'fresh' else 'stale').inc()
+        return serve_cached(entry, 'hit' if state == 'fresh' else 'stale')
+    
+    response_cache_requests.labels(route, 'miss').inc()
+    correlation_id = g.correlation_id
+    url = f"{service_url}{path}"
+    try:
+        with response_cache.lock:
+            generation = response_cache.generation
+        # Concurrent misses for the same key (e.g. a flash sale) share one upstream call
+        snapshot = fetch_snapshot(service_url, path, forward_headers(g.forward_headers, correlation_id), params)
+    except Exception as e:
+        return upstream_error_response(e, url, correlation_id)
+    entry = cache_entry_from_snapshot(snapshot, ttl)
+    if entry is None:
+        return snapshot.to_response()
+    response_cache.put(key, entry, generation)
+    return serve_cached(entry, 'miss')
 
 # Remove manual rate limiting middleware and check_rate_limit function
-# @app.before_request is no longer needed for rate limiting, but we keep logging
+# @app.before_request is no longer needed for rate limiting; access logging is done by init_access_log
 
 @app.before_request
 def before_request():
-    """Access logging"""
-    client_ip = request.remote_addr
-    logger.info(f"Incoming request: {request.method} {request.path}", extra={'client_ip': client_ip})
+    """Ensure a Correlation ID for the request and everything it calls"""
+    g.correlation_id = request.headers.get('X-Correlation-ID') or str(uuid.uuid4())
 
 # Apply specific limits to critical endpoints
 
@@ -212,26 +1133,9 @@ def before_request():
 @app.route('/api/orders', methods=['GET', 'POST'])
 @app.route('/api/orders/<int:order_id>', methods=['GET', 'PUT', 'DELETE'])
 @app.route('/api/orders/<int:order_id>/status', methods=['PUT'])
-@limiter.limit("50 per minute", methods=['POST'])  # Limit order creation
+@limiter.limit(ORDER_CREATE_RATE_LIMIT, methods=['POST'])  # Limit order creation
+@require_permission('orders')
 def orders_proxy(order_id=None):
-    # Authentication required
-    token = extract_token()
-    if not token:
-        return jsonify({'error': 'Token required'}), 401
-    
-    user = verify_token(token)
-    if not user:
-        return jsonify({'error': 'Invalid or expired token'}), 401
-    
-    # Check permissions
-    if not check_permission(user['role'], 'orders', request.method):
-        return jsonify({'error': 'Insufficient permissions'}), 403
-    
-    # Add user context to headers for the service
-    headers = dict(request.headers)
-    headers['X-User-Id'] = str(user['user_id'])
-    headers['X-User-Role'] = user['role']
-    
     # Build path
     if '/status' in request.path:
         path = f"/api/orders/{order_id}/status"
@@ -244,39 +1148,22 @@ def orders_proxy(order_id=None):
         SERVICES['order'],
         path,
         request.method,
-        headers,
-        request.json
+        g.forward_headers,
+        request.get_json(silent=True)
     )
 
 # Payment Service routes
 @app.route('/api/payments', methods=['GET'])
 @app.route('/api/payments/<int:payment_id>', methods=['GET'])
-@limiter.limit("5 per minute", methods=['POST'])
+@limiter.limit(PAYMENT_CREATE_RATE_LIMIT, methods=['POST'])
+@require_permission('payments')
 def payments_proxy(payment_id=None):
-    # Authentication required
-    token = extract_token()
-    if not token:
-        return jsonify({'error': 'Token required'}), 401
-    
-    user = verify_token(token)
-    if not user:
-        return jsonify({'error': 'Invalid or expired token'}), 401
-    
-    # Check permissions
-    if not check_permission(user['role'], 'payments', request.method):
-        return jsonify({'error': 'Insufficient permissions'}), 403
-    
-    # Add user context
-    headers = dict(request.headers)
-    headers['X-User-Id'] = str(user['user_id'])
-    headers['X-User-Role'] = user['role']
-    
     path = f"/api/payments/{payment_id}" if payment_id else "/api/payments"
     return proxy_request(
         SERVICES['payment'],
         path,
         request.method,
-        headers
+        g.forward_headers
     )
 
 # Health check
@@ -297,38 +1184,34 @@ def register():
 
 @app.route('/auth/login', methods=['POST'])
 def login():
-    return proxy_request(
+    response = proxy_request(
         SERVICES['customer'],
         '/auth/login',
         'POST',
         request.headers,
-        request.json
+        request.json,
+        stream=not (JWT_CACHE_ENABLED and JWT_CACHE_PREWARM_ON_LOGIN)
     )
+    
+    # Pre-validate the new token so the first authenticated call is a cache hit
+    if JWT_CACHE_ENABLED and JWT_CACHE_PREWARM_ON_LOGIN and response.status_code == 200:
+        try:
+            token = json.loads(response.get_data()).get('token')
+            if token:
+                verify_token(token)
+        except (ValueError, AttributeError):
+            pass
+    return response
 
 # Customer Service routes
 @app.route('/api/customers', methods=['GET', 'POST'])
 @app.route('/api/customers/<int:customer_id>', methods=['GET', 'PUT', 'DELETE'])
+@require_permission('customers', resource_id_arg='customer_id')
 def customers_proxy(customer_id=None):
-    # 1. استخراج وتحقق التوكن
-    token = extract_token()
-    if not token:
-        return jsonify({'error': 'Token required'}), 401
-    
-    user = verify_token(token)
-    if not user:
-        return jsonify({'error': 'Invalid or expired token'}), 401
-    
-    user_role = user['role']
-    user_id = user['user_id']
+    user_role = g.user['role']
+    user_id = g.user['user_id']
     method = request.method
     
-    # 2. تطبيق منطق التوجيه والتحقق من النطاق (Scoping Logic)
-
-    # التحقق من الإذن العام أولاً (باستخدام القاموس ROLE_PERMISSIONS)
-    # ملاحظة: دالة check_permission يجب أن تقبل customer_id و user_id في الحالات الأخرى
-    if not check_permission(user_role, 'customers', method, user_id, customer_id):
-        return jsonify({'error': 'Insufficient permissions (RBAC)'}), 403
-
     # منطق التوجيه: إذا كان GET على القائمة العامة (بدون ID)
     if method == 'GET' and customer_id is None:
         # إذا لم يكن المستخدم مديراً (admin)، قم بتوجيهه داخلياً إلى مورده الخاص
@@ -343,58 +1226,41 @@ def customers_proxy(customer_id=None):
         if user_role == 'customer' and int(customer_id) != int(user_id):
             return jsonify({'error': 'Access denied: Customer can only access self data'}), 403
 
-    # 3. تمرير الطلب إلى الخدمة المصغرة
+    # تمرير الطلب إلى الخدمة المصغرة
     path = f"/api/customers/{customer_id}" if customer_id else "/api/customers"
-
-    # نضمن إرسال هوية المستخدم ودوره للخدمة المصغرة
-    forward_headers = dict(request.headers)
-    forward_headers['X-User-ID'] = str(user_id)
-    forward_headers['X-User-Role'] = user_role
     
     return proxy_request(
         SERVICES['customer'],
         path,
         method,
-        forward_headers,
-        request.json
+        g.forward_headers,
+        request.get_json(silent=True)
     )
 
 
 # Inventory/Products Service routes
 @app.route('/api/products', methods=['GET', 'POST'])
 @app.route('/api/products/<int:product_id>', methods=['GET', 'PUT', 'DELETE'])
+@require_permission('products', public_methods=('GET',))  # GET products is public (no token required)
 def products_proxy(product_id=None):
-    # GET products is public (no token required)
+    path = f"/api/products/{product_id}" if product_id else "/api/products"
     if request.method == 'GET':
-        path = f"/api/products/{product_id}" if product_id else "/api/products"
-        return proxy_request(
-            SERVICES['inventory'],
-            path,
-            request.method,
-            request.headers
-        )
+        ttl = PRODUCT_DETAIL_CACHE_TTL if product_id else PRODUCTS_LIST_CACHE_TTL
+        return cached_proxy_request(SERVICES['inventory'], path, ttl, 'products')
     
-    # Other methods require authentication
-    token = extract_token()
-    if not token:
-        return jsonify({'error': 'Token required'}), 401
-    
-    user = verify_token(token)
-    if not user:
-        return jsonify({'error': 'Invalid or expired token'}), 401
-    
-    # Check permissions
-    if not check_permission(user['role'], 'products', request.method):
-        return jsonify({'error': 'Insufficient permissions'}), 403
-    
-    path = f"/api/products/{product_id}" if product_id else "/api/products"
-    return proxy_request(
+    response = proxy_request(
         SERVICES['inventory'],
         path,
         request.method,
-        request.headers,
-        request.json
+        g.forward_headers,
+        request.get_json(silent=True)
     )
+    # Catalog changed, drop cached product lists and details
+    if response.status_code < 400:
+        response_cache.invalidate('/api/products')
+        if response_cache_sync is not None:
+            response_cache_sync.publish()
+    return response
 
 
 
@@ -402,25 +1268,8 @@ def products_proxy(product_id=None):
 @app.route('/api/shipments', methods=['GET'])
 @app.route('/api/shipments/<int:shipment_id>', methods=['GET'])
 @app.route('/api/shipments/track/<tracking_number>', methods=['GET'])
+@require_permission('shipments')
 def shipments_proxy(shipment_id=None, tracking_number=None):
-    # Authentication required
-    token = extract_token()
-    if not token:
-        return jsonify({'error': 'Token required'}), 401
-    
-    user = verify_token(token)
-    if not user:
-        return jsonify({'error': 'Invalid or expired token'}), 401
-    
-    # Check permissions
-    if not check_permission(user['role'], 'shipments', request.method):
-        return jsonify({'error': 'Insufficient permissions'}), 403
-    
-    # Add user context
-    headers = dict(request.headers)
-    headers['X-User-Id'] = str(user['user_id'])
-    headers['X-User-Role'] = user['role']
-    
     # Build path
     if tracking_number:
         path = f"/api/shipments/track/{tracking_number}"
@@ -433,42 +1282,111 @@ def shipments_proxy(shipment_id=None, tracking_number=None):
         SERVICES['shipping'],
         path,
         request.method,
-        headers
+        g.forward_headers
     )
 
 # Notification Service routes
 @app.route('/api/notifications', methods=['GET'])
 @app.route('/api/notifications/customer/<int:customer_id>', methods=['GET'])
+@require_permission('notifications')
 def notifications_proxy(customer_id=None):
-    # Authentication required
+    # Customers can only see their own notifications
+    if g.user['role'] == 'customer' and customer_id and customer_id != g.user['user_id']:
+        return jsonify({'error': 'Cannot access other customer notifications'}), 403
+    
+    path = f"/api/notifications/customer/{customer_id}" if customer_id else "/api/notifications"
+    return proxy_request(
+        SERVICES['notification'],
+        path,
+        request.method,
+        g.forward_headers
+    )
+
+# Batch API
+# Lets a client fetch several gateway resources in one call, e.g. an order
+# page needing /api/orders/<id>, /api/payments/<id> and /api/shipments/<id>.
+# The token is verified once; each part is then dispatched concurrently
+# through the normal route (RBAC, scoping, cache, coalescing) and its status
+# and body are reported individually, so one failing part doesn't fail the
+# whole batch.
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', '20'))
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', '32'))
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix='batch')
+
+def run_batch_part(path, headers, user, remote_addr):
+    """Dispatch one GET through the gateway's own routes, returning (status, body)"""
+    # The caller's address, so each part counts against the caller's own rate limit
+    builder = EnvironBuilder(path=path, method='GET', headers=headers,
+                             environ_base={'REMOTE_ADDR': remote_addr})
+    environ = builder.get_environ()
+    environ[BATCH_USER_ENVIRON_KEY] = user
+    with app.request_context(environ):
+        response = app.full_dispatch_request()
+        data = response.get_data()
+    try:
+        body = json.loads(data) if data else None
+    except ValueError:
+        body = data.decode('utf-8', 'replace')
+    return response.status_code, body
+
+@app.route('/api/batch', methods=['POST'])
+def batch_api():
     token = extract_token()
     if not token:
         return jsonify({'error': 'Token required'}), 401
-    
     user = verify_token(token)
     if not user:
         return jsonify({'error': 'Invalid or expired token'}), 401
     
-    # Check permissions
-    if not check_permission(user['role'], 'notifications', request.method):
-        return jsonify({'error': 'Insufficient permissions'}), 403
+    payload = request.get_json(silent=True) or {}
+    parts = payload.get('requests')
+    if not isinstance(parts, list) or not parts:
+        return jsonify({'error': 'Body must contain a non-empty "requests" list'}), 400
+    if len(parts) > BATCH_MAX_REQUESTS:
+        return jsonify({'error': f'At most {BATCH_MAX_REQUESTS} requests per batch'}), 400
     
-    # Customers can only see their own notifications
-    if user['role'] == 'customer' and customer_id and customer_id != user['user_id']:
-        return jsonify({'error': 'Cannot access other customer notifications'}), 403
+    # Same correlation ID for every part; bodies come back uncompressed so they can be merged
+    headers = {
+        'Authorization': request.headers.get('Authorization'),
+        'X-Correlation-ID': g.correlation_id,
+        'Accept': 'application/json',
+        'Accept-Encoding': 'identity'
+    }
+    if 'X-Forwarded-For' in request.headers:
+        headers['X-Forwarded-For'] = request.headers['X-Forwarded-For']
+    remote_addr = request.remote_addr
+    
+    futures = []
+    for index, part in enumerate(parts):
+        part = part if isinstance(part, dict) else {}
+        part_id = part.get('id', index)
+        path = part.get('path')
+        method = part.get('method', 'GET')
+        if not isinstance(path, str) or not path.startswith('/api/') or path.startswith('/api/batch'):
+            futures.append((part_id, None, {'error': 'Path must be a gateway /api/ route'}, 400))
+        elif not isinstance(method, str):
+            futures.append((part_id, None, {'error': 'Method must be a string'}, 400))
+        elif method.upper() != 'GET':
+            futures.append((part_id, None, {'error': 'Only GET is allowed in a batch'}, 405))
+        else:
+            futures.append((part_id, batch_executor.submit(run_batch_part, path, headers, user, remote_addr),
+                            None, None))
     
-    # Add user context
-    headers = dict(request.headers)
-    headers['X-User-Id'] = str(user['user_id'])
-    headers['X-User-Role'] = user['role']
+    responses = []
+    for part_id, future, body, status in futures:
+        if future is not None:
+            try:
+                status, body = future.result()
+            except Exception as e:
+                logger.error(f"Batch part failed: {str(e)}", extra={'correlation_id': headers['X-Correlation-ID']})
+                status, body = 500, {'error': str(e)}
+        responses.append({'id': part_id, 'status': status, 'body': body})
     
-    path = f"/api/notifications/customer/{customer_id}" if customer_id else "/api/notifications"
-    return proxy_request(
-        SERVICES['notification'],
-        path,
-        request.method,
-        headers
-    )
+    return jsonify({
+        'responses': responses,
+        'partial': any(r['status'] >= 400 for r in responses)
+    }), 200
 
 # 404 handler
 @app.errorhandler(404)
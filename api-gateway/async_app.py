@@ -0,0 +1,544 @@
+"""
+API Gateway - Asyncio Engine
+Port: 8080
+
+Serves the same routes as app.py with the same JWT validation, RBAC
+(check_permission), rate limits and per-upstream circuit breakers, bulkheads
+and adaptive timeouts, but on an aiohttp event loop. Upstream calls are
+non-blocking, so a single worker can hold thousands of slow proxied requests
+without pinning a thread for each one.
+
+Run with: python async_app.py
+"""
+import asyncio
+import json
+import time
+import uuid
+
+import aiohttp
+import pybreaker
+from aiohttp import web
+from multidict import CIMultiDict
+from limits import parse, parse_many
+from limits.aio.strategies import STRATEGIES
+from limits.errors import StorageError
+from limits.storage import storage_from_string
+from prometheus_client import generate_latest
+
+from common.access_log import ACCESS_LOG_ENABLED, log_access
+
+from app import (
+    SERVICES, DEFAULT_RATE_LIMIT, ORDER_CREATE_RATE_LIMIT, RATELIMIT_STORAGE_URI, RATELIMIT_STRATEGY,
+    RATELIMIT_STORAGE_TIMEOUT,
+    UPSTREAM_POOL_MAXSIZE, UPSTREAM_POOL_IDLE_TIMEOUT, PROXY_STREAM_CHUNK_SIZE, BATCH_MAX_REQUESTS,
+    UPSTREAM_MAX_CONCURRENCY, UPSTREAM_BULKHEAD_WAIT, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_BREAKER_RESET_TIMEOUT,
+    UpstreamRejected, upstream_fast_failed, get_upstream_guard,
+    app as flask_app, logger, verify_token, check_permission, strip_hop_by_hop
+)
+
+# Rate Limiter Configuration (same limits, storage and strategy as the Flask engine)
+# The async Redis client is coredis, whose socket timeouts are connect_timeout / stream_timeout
+rate_limit_storage = storage_from_string(f"async+{RATELIMIT_STORAGE_URI}", **({
+    'connect_timeout': RATELIMIT_STORAGE_TIMEOUT,
+    'stream_timeout': RATELIMIT_STORAGE_TIMEOUT,
+    'wrap_exceptions': True
+} if RATELIMIT_STORAGE_URI.startswith('redis') else {}))
+rate_limiter = STRATEGIES[RATELIMIT_STRATEGY](rate_limit_storage)
+# As Flask-Limiter's in_memory_fallback: keep limiting per replica while the shared store is unreachable
+fallback_rate_limiter = STRATEGIES[RATELIMIT_STRATEGY](storage_from_string('async+memory://'))
+RATELIMIT_FALLBACK_RETRY = 30  # Seconds on the in-process counters before trying the shared store again
+rate_limit_fallback_until = 0.0  # monotonic() deadline while degraded, 0 while the shared store answers
+RATELIMIT_ENABLED = flask_app.config['RATELIMIT_ENABLED']
+DEFAULT_LIMITS = parse_many(DEFAULT_RATE_LIMIT)
+ROUTE_LIMITS = {
+    ('orders', 'POST'): [parse(ORDER_CREATE_RATE_LIMIT)]
+}
+
+# Request state key carrying the pre-verified user of a batch part (never set from HTTP headers)
+BATCH_USER_KEY = 'batch_user'
+
+def json_error(message, status):
+    return web.json_response({'error': message}, status=status)
+
+async def hit_rate_limit(limit, key, route_name):
+    """Count one hit against limit, on the in-process counters while the shared store is down"""
+    global rate_limit_fallback_until
+    if time.monotonic() >= rate_limit_fallback_until:
+        try:
+            allowed = await rate_limiter.hit(limit, key, route_name)
+        except (StorageError, asyncio.TimeoutError) as e:
+            logger.warning(f"Rate limit storage unreachable, limiting per replica for {RATELIMIT_FALLBACK_RETRY}s: {e!r}")
+            rate_limit_fallback_until = time.monotonic() + RATELIMIT_FALLBACK_RETRY
+        else:
+            if rate_limit_fallback_until:
+                logger.info("Rate limit storage reachable again, back to shared counters")
+                rate_limit_fallback_until = 0.0
+            return allowed
+    return await fallback_rate_limiter.hit(limit, key, route_name)
+
+async def check_rate_limit(request, route_name):
+    """Return a 429 response if the client exceeded a limit on this route"""
+    if not RATELIMIT_ENABLED:
+        return None
+    limits = ROUTE_LIMITS.get((route_name, request.method), DEFAULT_LIMITS)
+    for limit in limits:
+        if not await hit_rate_limit(limit, request.remote or 'unknown', route_name):
+            return json_error(f'Rate limit exceeded: {limit}', 429)
+    return None
+
+def authenticate(request):
+    """Extract and verify the bearer token, returning (user, error_response)"""
+    # Parts of a batch request were already authenticated by batch_api
+    user = request.get(BATCH_USER_KEY)
+    if user is not None:
+        return user, None
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return None, json_error('Token required', 401)
+    user = verify_token(auth_header.replace('Bearer ', ''))
+    if not user:
+        return None, json_error('Invalid or expired token', 401)
+    return user, None
+
+def anonymous_headers(request):
+    """Headers for a public route: no user context, and none claimed by the client either"""
+    return {k: v for k, v in request.headers.items() if not k.lower().startswith('x-user-')}
+
+def user_headers(request, user):
+    """Add user context to headers for the service"""
+    headers = anonymous_headers(request)
+    headers['X-User-Id'] = str(user['user_id'])
+    headers['X-User-Role'] = user['role']
+    return headers
+
+# Upstream Circuit Breakers, Bulkheads and Adaptive Timeouts
+# The same UpstreamGuard per upstream as the Flask engine (breaker, recent
+# latencies for the timeout, /metrics), driven from the event loop. Only the
+# bulkhead differs: an asyncio.Semaphore, so waiting for a slot never blocks
+# the loop.
+def breaker_outcome():
+    """Guarded call for pybreaker: the breaker counts the error sent in once the upstream answered"""
+    error = yield
+    if error is not None:
+        raise error
+
+class AsyncUpstreamGuard:
+    """Circuit breaker, bulkhead and adaptive timeout for one upstream, awaitable"""
+
+    def __init__(self, guard):
+        self.guard = guard
+        self.bulkhead = asyncio.Semaphore(UPSTREAM_MAX_CONCURRENCY)
+
+    async def call(self, send):
+        """Await send(timeout) under the breaker and bulkhead, returning the upstream response"""
+        guard = self.guard
+        try:
+            await asyncio.wait_for(self.bulkhead.acquire(), UPSTREAM_BULKHEAD_WAIT)
+        except asyncio.TimeoutError:
+            upstream_fast_failed.labels(guard.name, 'bulkhead_full').inc()
+            raise UpstreamRejected(guard.name, 'bulkhead_full')
+        try:
+            # pybreaker guards a generator call until the generator finishes, so the
+            # breaker stays in charge across the await (admission now, outcome below)
+            try:
+                outcome = guard.breaker.call(breaker_outcome)
+            except pybreaker.CircuitBreakerError:
+                upstream_fast_failed.labels(guard.name, 'circuit_open').inc()
+                raise UpstreamRejected(guard.name, 'circuit_open')
+            next(outcome)
+            with guard.lock:
+                guard.in_flight += 1
+            error = None  # A cancelled call (client gone) counts as neither success nor failure of the upstream
+            try:
+                start = time.monotonic()
+                response = await send(aiohttp.ClientTimeout(sock_connect=UPSTREAM_CONNECT_TIMEOUT,
+                                                            sock_read=guard.timeout()))
+                # Time to response headers; the body is streamed after the slot is released
+                if response.status >= 500:
+                    error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                        status=response.status, message=response.reason)
+                else:
+                    with guard.lock:
+                        guard.latencies.append(time.monotonic() - start)
+                return response
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                with guard.lock:
+                    guard.in_flight -= 1
+                try:
+                    outcome.send(error)
+                except StopIteration:
+                    pass
+                except Exception:
+                    pass  # The error sent in, re-raised once the breaker counted it
+        finally:
+            self.bulkhead.release()
+
+def get_async_upstream_guard(application, service_url):
+    guards = application['upstream_guards']
+    guard = guards.get(service_url)
+    if guard is None:
+        guard = guards[service_url] = AsyncUpstreamGuard(get_upstream_guard(service_url))
+    return guard
+
+async def proxy_request(request, service_url, path, headers):
+    """Forward request to microservice without blocking the event loop"""
+    url = f"{service_url}{path}"
+    method = request.method
+    correlation_id = request.headers.get('X-Correlation-ID') or str(uuid.uuid4())
+
+    # Remove hop-by-hop headers; Host and Content-Length are recomputed for the upstream call
+    headers_to_forward = {k: v for k, v in strip_hop_by_hop(headers.items())
+                          if k.lower() not in ['host', 'content-length']}
+    headers_to_forward['X-Correlation-ID'] = correlation_id
+
+    logger.debug("Proxying request to %s", url, extra={
+        'method': method,
+        'service_url': url,
+        'correlation_id': correlation_id
+    })
+
+    body = await request.read() if method in ('POST', 'PUT') else None
+    guard = get_async_upstream_guard(request.app, service_url)
+    response = None
+    try:
+        upstream = await guard.call(lambda timeout: request.app['upstream_session'].request(
+            method, url, headers=headers_to_forward, data=body,
+            params=request.query if method == 'GET' else None, timeout=timeout))
+        try:
+            raw_headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in upstream.raw_headers]
+            response_headers = strip_hop_by_hop(raw_headers)
+            if request.get(BATCH_USER_KEY) is not None:
+                # A batch part: its body is merged into the batch response, not streamed to the client
+                return web.Response(status=upstream.status, body=await upstream.read())
+            if any(k.lower() == 'transfer-encoding' for k, _ in raw_headers):
+                # Transfer-Encoding overrides Content-Length; the server re-frames the body
+                response_headers = [(k, v) for k, v in response_headers if k.lower() != 'content-length']
+
+            # Forward the body chunk by chunk, still encoded as the upstream sent it
+            response = web.StreamResponse(status=upstream.status, headers=CIMultiDict(response_headers))
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(PROXY_STREAM_CHUNK_SIZE):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            upstream.release()
+    except UpstreamRejected as e:
+        logger.warning(f"Fast-failed request to {url}: {e.reason}", extra={'correlation_id': correlation_id, 'upstream': e.upstream})
+        rejected = json_error('Service temporarily unavailable', 503)
+        if e.reason == 'circuit_open':
+            rejected.headers['Retry-After'] = str(int(UPSTREAM_BREAKER_RESET_TIMEOUT))
+        return rejected
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        if response is not None and response.prepared:
+            # The status line already went out: drop the connection so the client sees the body cut short
+            logger.error(f"Upstream failed mid-response: {url}: {e!r}", extra={'correlation_id': correlation_id})
+            if request.transport is not None:
+                request.transport.close()
+            return response
+        if isinstance(e, asyncio.TimeoutError):
+            logger.error(f"Service timeout: {url}", extra={'correlation_id': correlation_id})
+            return json_error('Service timeout', 504)
+        if isinstance(e, aiohttp.ClientConnectionError):
+            logger.error(f"Service unavailable: {url}", extra={'correlation_id': correlation_id})
+            return json_error('Service unavailable', 503)
+        logger.error(f"Proxy error: {str(e)}", extra={'correlation_id': correlation_id, 'stack': str(e)})
+        return json_error(str(e), 500)
+
+@web.middleware
+async def access_log_middleware(request, handler):
+    """Access logging, one sampled line per request"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPNotFound:
+        status = 404
+        return json_error('Route not found', 404)
+    except web.HTTPMethodNotAllowed:
+        status = 405
+        return json_error('Method not allowed', 405)
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if ACCESS_LOG_ENABLED:
+            log_access('api-gateway', request.method, request.path, status,
+                       (time.perf_counter() - started) * 1000,
+                       request.headers.get('X-Correlation-ID'), request.remote)
+
+def optional_int(request, name):
+    value = request.match_info.get(name)
+    return int(value) if value is not None else None
+
+# Basic routes
+async def metrics_route(request):
+    return web.Response(body=generate_latest(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+async def test_route(request):
+    return web.Response(text="OK")
+
+async def health(request):
+    return web.json_response({'status': 'healthy', 'service': 'api-gateway', 'engine': 'async'})
+
+# Authentication endpoints (no JWT required)
+async def auth_proxy(request):
+    limited = await check_rate_limit(request, 'auth')
+    if limited is not None:
+        return limited
+    return await proxy_request(request, SERVICES['customer'], request.path, anonymous_headers(request))
+
+# Order Service routes
+async def orders_proxy(request):
+    limited = await check_rate_limit(request, 'orders')
+    if limited is not None:
+        return limited
+    user, error = authenticate(request)
+    if error is not None:
+        return error
+    if not check_permission(user['role'], 'orders', request.method):
+        return json_error('Insufficient permissions', 403)
+
+    order_id = optional_int(request, 'order_id')
+    if request.path.endswith('/status'):
+        path = f"/api/orders/{order_id}/status"
+    elif order_id:
+        path = f"/api/orders/{order_id}"
+    else:
+        path = "/api/orders"
+    return await proxy_request(request, SERVICES['order'], path, user_headers(request, user))
+
+# Payment Service routes
+async def payments_proxy(request):
+    limited = await check_rate_limit(request, 'payments')
+    if limited is not None:
+        return limited
+    user, error = authenticate(request)
+    if error is not None:
+        return error
+    if not check_permission(user['role'], 'payments', request.method):
+        return json_error('Insufficient permissions', 403)
+
+    payment_id = optional_int(request, 'payment_id')
+    path = f"/api/payments/{payment_id}" if payment_id else "/api/payments"
+    return await proxy_request(request, SERVICES['payment'], path, user_headers(request, user))
+
+# Customer Service routes
+async def customers_proxy(request):
+    limited = await check_rate_limit(request, 'customers')
+    if limited is not None:
+        return limited
+    user, error = authenticate(request)
+    if error is not None:
+        return error
+
+    user_role = user['role']
+    user_id = user['user_id']
+    method = request.method
+    customer_id = optional_int(request, 'customer_id')
+
+    if not check_permission(user_role, 'customers', method, user_id, customer_id):
+        return json_error('Insufficient permissions (RBAC)', 403)
+
+    # Non-admin roles listing customers are coerced to their own record
+    if method == 'GET' and customer_id is None and user_role != 'admin':
+        customer_id = user_id
+        logger.warning(f"Non-admin role '{user_role}' accessing list endpoint. Coercing request to self-access: ID {customer_id}", extra={'correlation_id': request.headers.get('X-Correlation-ID')})
+
+    if method in ['GET', 'PUT', 'DELETE'] and customer_id is not None:
+        if user_role == 'customer' and int(customer_id) != int(user_id):
+            return json_error('Access denied: Customer can only access self data', 403)
+
+    path = f"/api/customers/{customer_id}" if customer_id else "/api/customers"
+    return await proxy_request(request, SERVICES['customer'], path, user_headers(request, user))
+
+# Inventory/Products Service routes
+async def products_proxy(request):
+    limited = await check_rate_limit(request, 'products')
+    if limited is not None:
+        return limited
+    product_id = optional_int(request, 'product_id')
+    path = f"/api/products/{product_id}" if product_id else "/api/products"
+
+    # GET products is public (no token required)
+    if request.method == 'GET':
+        return await proxy_request(request, SERVICES['inventory'], path, anonymous_headers(request))
+
+    user, error = authenticate(request)
+    if error is not None:
+        return error
+    if not check_permission(user['role'], 'products', request.method):
+        return json_error('Insufficient permissions', 403)
+    return await proxy_request(request, SERVICES['inventory'], path, user_headers(request, user))
+
+# Shipping Service routes
+async def shipments_proxy(request):
+    limited = await check_rate_limit(request, 'shipments')
+    if limited is not None:
+        return limited
+    user, error = authenticate(request)
+    if error is not None:
+        return error
+    if not check_permission(user['role'], 'shipments', request.method):
+        return json_error('Insufficient permissions', 403)
+
+    shipment_id = optional_int(request, 'shipment_id')
+    tracking_number = request.match_info.get('tracking_number')
+    if tracking_number:
+        path = f"/api/shipments/track/{tracking_number}"
+    elif shipment_id:
+        path = f"/api/shipments/{shipment_id}"
+    else:
+        path = "/api/shipments"
+    return await proxy_request(request, SERVICES['shipping'], path, user_headers(request, user))
+
+# Notification Service routes
+async def notifications_proxy(request):
+    limited = await check_rate_limit(request, 'notifications')
+    if limited is not None:
+        return limited
+    user, error = authenticate(request)
+    if error is not None:
+        return error
+    if not check_permission(user['role'], 'notifications', request.method):
+        return json_error('Insufficient permissions', 403)
+
+    customer_id = optional_int(request, 'customer_id')
+    if user['role'] == 'customer' and customer_id and customer_id != user['user_id']:
+        return json_error('Cannot access other customer notifications', 403)
+
+    path = f"/api/notifications/customer/{customer_id}" if customer_id else "/api/notifications"
+    return await proxy_request(request, SERVICES['notification'], path, user_headers(request, user))
+
+# Batch API (see batch_api in app.py): parts run concurrently through this engine's own routes
+async def run_batch_part(base, path, headers, user):
+    """Dispatch one GET through the engine's own routes, returning (status, body)"""
+    part = base.clone(method='GET', rel_url=path, headers=headers)
+    part[BATCH_USER_KEY] = user
+    match_info = await base.app.router.resolve(part)
+    match_info.add_app(base.app)
+    part._match_info = match_info  # As web.Application does before calling a handler
+    response = await access_log_middleware(part, match_info.handler)
+    try:
+        body = json.loads(response.body) if response.body else None
+    except ValueError:
+        body = response.body.decode('utf-8', 'replace')
+    return response.status, body
+
+async def batch_api(request):
+    limited = await check_rate_limit(request, 'batch')
+    if limited is not None:
+        return limited
+    user, error = authenticate(request)
+    if error is not None:
+        return error
+
+    base = request.clone()  # Parts are cloned from this: a request can't be cloned once its body is read
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    parts = payload.get('requests') if isinstance(payload, dict) else None
+    if not isinstance(parts, list) or not parts:
+        return json_error('Body must contain a non-empty "requests" list', 400)
+    if len(parts) > BATCH_MAX_REQUESTS:
+        return json_error(f'At most {BATCH_MAX_REQUESTS} requests per batch', 400)
+
+    # Same correlation ID for every part; bodies come back uncompressed so they can be merged
+    correlation_id = request.headers.get('X-Correlation-ID') or str(uuid.uuid4())
+    headers = {
+        'Authorization': request.headers.get('Authorization'),
+        'X-Correlation-ID': correlation_id,
+        'Accept': 'application/json',
+        'Accept-Encoding': 'identity'
+    }
+    if 'X-Forwarded-For' in request.headers:
+        headers['X-Forwarded-For'] = request.headers['X-Forwarded-For']
+
+    part_ids, calls, results = [], [], []
+    for index, part in enumerate(parts):
+        part = part if isinstance(part, dict) else {}
+        part_ids.append(part.get('id', index))
+        path = part.get('path')
+        method = part.get('method', 'GET')
+        if not isinstance(path, str) or not path.startswith('/api/') or path.startswith('/api/batch'):
+            results.append((400, {'error': 'Path must be a gateway /api/ route'}))
+        elif not isinstance(method, str):
+            results.append((400, {'error': 'Method must be a string'}))
+        elif method.upper() != 'GET':
+            results.append((405, {'error': 'Only GET is allowed in a batch'}))
+        else:
+            results.append(None)
+            calls.append(run_batch_part(base, path, headers, user))
+
+    outcomes = iter(await asyncio.gather(*calls, return_exceptions=True))
+    responses = []
+    for part_id, result in zip(part_ids, results):
+        if result is None:
+            result = next(outcomes)
+            if isinstance(result, Exception):
+                logger.error(f"Batch part failed: {str(result)}", extra={'correlation_id': correlation_id})
+                result = (500, {'error': str(result)})
+        status, body = result
+        responses.append({'id': part_id, 'status': status, 'body': body})
+
+    return web.json_response({
+        'responses': responses,
+        'partial': any(r['status'] >= 400 for r in responses)
+    })
+
+async def upstream_session_context(application):
+    """Keep-alive connection pool shared by all upstream calls"""
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=UPSTREAM_POOL_MAXSIZE,
+        keepalive_timeout=UPSTREAM_POOL_IDLE_TIMEOUT
+    )
+    application['upstream_session'] = aiohttp.ClientSession(
+        connector=connector,
+        auto_decompress=False,
+        cookie_jar=aiohttp.DummyCookieJar()
+    )
+    application['upstream_guards'] = {}  # service URL -> AsyncUpstreamGuard, made in the loop that uses them
+    yield
+    await application['upstream_session'].close()
+
+# (path, methods, handler) - mirrors the Flask routes in app.py
+ROUTES = [
+    ('/metrics', ['GET'], metrics_route),
+    ('/test', ['GET'], test_route),
+    ('/health', ['GET'], health),
+    ('/auth/register', ['POST'], auth_proxy),
+    ('/auth/login', ['POST'], auth_proxy),
+    ('/api/orders', ['GET', 'POST'], orders_proxy),
+    (r'/api/orders/{order_id:\d+}', ['GET', 'PUT', 'DELETE'], orders_proxy),
+    (r'/api/orders/{order_id:\d+}/status', ['PUT'], orders_proxy),
+    ('/api/payments', ['GET'], payments_proxy),
+    (r'/api/payments/{payment_id:\d+}', ['GET'], payments_proxy),
+    ('/api/customers', ['GET', 'POST'], customers_proxy),
+    (r'/api/customers/{customer_id:\d+}', ['GET', 'PUT', 'DELETE'], customers_proxy),
+    ('/api/products', ['GET', 'POST'], products_proxy),
+    (r'/api/products/{product_id:\d+}', ['GET', 'PUT', 'DELETE'], products_proxy),
+    ('/api/shipments', ['GET'], shipments_proxy),
+    (r'/api/shipments/{shipment_id:\d+}', ['GET'], shipments_proxy),
+    ('/api/shipments/track/{tracking_number}', ['GET'], shipments_proxy),
+    ('/api/notifications', ['GET'], notifications_proxy),
+    (r'/api/notifications/customer/{customer_id:\d+}', ['GET'], notifications_proxy),
+    ('/api/batch', ['POST'], batch_api),
+]
+
+def create_app():
+    application = web.Application(middlewares=[access_log_middleware])
+    application.cleanup_ctx.append(upstream_session_context)
+    for path, methods, handler in ROUTES:
+        for method in methods:
+            application.router.add_route(method, path, handler)
+    return application
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=8080, access_log=None)
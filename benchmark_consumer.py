@@ -0,0 +1,174 @@
+"""
+Consumer benchmark: messages/second vs worker count for common.consumer.EventConsumer
+
+Runs a small in-process AMQP 0-9-1 stand-in (enough of the protocol for
+declare/bind/qos/consume/ack) so no RabbitMQ is needed, fills a queue with
+order.created events and times how fast the consumer drains it with each
+worker count. The handler sleeps --work seconds to stand in for the payment
+gateway call in process_payment_logic.
+
+Usage: python benchmark_consumer.py [--messages 400] [--workers 1 2 4 8 16 32] [--work 0.05]
+Needs pika and prometheus_client installed locally.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import pika.frame as frame
+import pika.spec as spec
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common.consumer import EventConsumer  # noqa: E402
+
+BROKER_PORT = 5699
+
+
+class StandInBroker:
+    """Single-queue AMQP stand-in honouring prefetch and (multiple) acks"""
+
+    def __init__(self, port):
+        self.queue = deque()
+        self.acked = 0
+        self.lock = threading.Lock()
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen(8)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def fill(self, bodies):
+        with self.lock:
+            self.queue.extend(bodies)
+            self.acked = 0
+
+    def _accept(self):
+        while True:
+            client, _ = self.server.accept()
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        state = {'prefetch': 0, 'consumer': None, 'channel': 1, 'tag': 0, 'unacked': {}}
+
+        def send(*frames):
+            client.sendall(b''.join(f.marshal() for f in frames))
+
+        def pump():
+            # Deliver while the prefetch window allows
+            while state['consumer'] and (not state['prefetch'] or len(state['unacked']) < state['prefetch']):
+                with self.lock:
+                    if not self.queue:
+                        return
+                    body = self.queue.popleft()
+                state['tag'] += 1
+                state['unacked'][state['tag']] = body
+                channel = state['channel']
+                send(frame.Method(channel, spec.Basic.Deliver(state['consumer'], state['tag'], False, 'order_events', 'order.created')),
+                     frame.Header(channel, len(body), spec.BasicProperties(delivery_mode=2)),
+                     frame.Body(channel, body))
+
+        def settle(tag, multiple):
+            tags = [t for t in state['unacked'] if t <= tag] if multiple else [tag]
+            for t in tags:
+                if state['unacked'].pop(t, None) is not None:
+                    with self.lock:
+                        self.acked += 1
+
+        buffer = client.recv(8)  # Protocol header
+        send(frame.Method(0, spec.Connection.Start(server_properties={'capabilities': {'basic.nack': True}})))
+        try:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                while True:
+                    consumed, decoded = frame.decode_frame(buffer)
+                    if decoded is None:
+                        break
+                    buffer = buffer[consumed:]
+                    if not isinstance(decoded, frame.Method):
+                        continue
+                    method, channel = decoded.method, decoded.channel_number
+                    if isinstance(method, spec.Connection.StartOk):
+                        send(frame.Method(0, spec.Connection.Tune(0, 131072, 0)))
+                    elif isinstance(method, spec.Connection.Open):
+                        send(frame.Method(0, spec.Connection.OpenOk()))
+                    elif isinstance(method, spec.Connection.Close):
+                        send(frame.Method(0, spec.Connection.CloseOk()))
+                        return
+                    elif isinstance(method, spec.Channel.Open):
+                        state['channel'] = channel
+                        send(frame.Method(channel, spec.Channel.OpenOk()))
+                    elif isinstance(method, spec.Exchange.Declare):
+                        send(frame.Method(channel, spec.Exchange.DeclareOk()))
+                    elif isinstance(method, spec.Queue.Declare):
+                        send(frame.Method(channel, spec.Queue.DeclareOk(method.queue, len(self.queue), 0)))
+                    elif isinstance(method, spec.Queue.Bind):
+                        send(frame.Method(channel, spec.Queue.BindOk()))
+                    elif isinstance(method, spec.Basic.Qos):
+                        state['prefetch'] = method.prefetch_count
+                        send(frame.Method(channel, spec.Basic.QosOk()))
+                    elif isinstance(method, spec.Basic.Consume):
+                        state['consumer'] = method.consumer_tag or 'ctag-1'
+                        send(frame.Method(channel, spec.Basic.ConsumeOk(state['consumer'])))
+                    elif isinstance(method, spec.Basic.Cancel):
+                        state['consumer'] = None
+                        send(frame.Method(channel, spec.Basic.CancelOk(method.consumer_tag)))
+                    elif isinstance(method, (spec.Basic.Ack, spec.Basic.Nack)):
+                        settle(method.delivery_tag, method.multiple)
+                    elif isinstance(method, spec.Channel.Close):
+                        send(frame.Method(channel, spec.Channel.CloseOk()))
+                pump()
+        except OSError:
+            pass
+        finally:
+            # Unacked messages go back to the queue, as on a real broker
+            with self.lock:
+                self.queue.extendleft(reversed(list(state['unacked'].values())))
+            client.close()
+
+
+def run(broker, workers, messages, work):
+    broker.fill([json.dumps({'event': 'order.created', 'data': {'order_id': i, 'total_price': 10.0}}).encode()
+                 for i in range(messages)])
+
+    def handle_event(event_type, data):
+        time.sleep(work)
+
+    consumer = EventConsumer('payment_queue', 'order_events', ['order.created'], handle_event,
+                             workers=workers, host='127.0.0.1', port=BROKER_PORT)
+    start = time.perf_counter()
+    consumer.start()
+    while broker.acked < messages:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    consumer.stop(timeout=5)
+    return messages / elapsed, consumer.prefetch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=400)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--work', type=float, default=0.05, help='Handler time per message in seconds')
+    args = parser.parse_args()
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    broker = StandInBroker(BROKER_PORT)
+    print(f"Handler time: {args.work * 1000:.0f} ms, {args.messages} messages per run\n")
+    print(f"{'Workers':<8} | {'Prefetch':<8} | {'Msg/s':>8}")
+    print("-" * 32)
+    for workers in args.workers:
+        rate, prefetch = run(broker, workers, args.messages, args.work)
+        print(f"{workers:<8} | {prefetch:<8} | {rate:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+SQLite access benchmark: connection per request vs pooled WAL connections (common/db.py)
+
+Runs inventory-service on a scratch database seeded with --products rows,
+once with DB_POOL_SIZE=0 (open, configure and close a connection for every
+request, as the services did before) and once with the pool, and sends the
+same concurrent load to its read endpoints.
+
+Usage: python benchmark_db.py [--requests 2000] [--concurrency 1 16 64] [--products 1000]
+Needs the inventory-service requirements plus aiohttp installed locally.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+from benchmark_gateway import ROOT_DIR, load, wait_until_up
+
+SERVICE_DIR = os.path.join(ROOT_DIR, 'inventory-service')
+SERVICE_PORT = 9502
+
+MODES = {
+    'per-request': {'DB_POOL_SIZE': '0'},
+    'pooled': {'DB_POOL_SIZE': '16'},
+}
+
+ENDPOINTS = ['/api/products', '/api/products/42']
+
+def seed(path, products):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE products
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name TEXT NOT NULL,
+                     description TEXT,
+                     price REAL NOT NULL,
+                     quantity INTEGER NOT NULL,
+                     sku TEXT UNIQUE,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.executemany('INSERT INTO products (name, description, price, quantity, sku) VALUES (?, ?, ?, ?, ?)',
+                     [(f'Product {i}', f'Description {i}', 10.0 + i, 100, f'SKU{i:06d}') for i in range(products)])
+    conn.commit()
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--products', type=int, default=1000)
+    args = parser.parse_args()
+
+    code = (f"import sys; sys.path.insert(0, {SERVICE_DIR!r}); from app import app; "
+            f"app.run(host='127.0.0.1', port={SERVICE_PORT}, threaded=True)")
+    print(f"{args.products} products, {args.requests} requests per run\n")
+    print(f"{'Mode':<12} | {'Endpoint':<17} | {'Concurrency':<11} | {'Req/s':>8} | {'p50 ms':>8} | {'p99 ms':>8} | {'Errors'}")
+    print("-" * 88)
+    with tempfile.TemporaryDirectory() as workdir:
+        seed(os.path.join(workdir, 'inventory.db'), args.products)
+        for mode, settings in MODES.items():
+            env = dict(os.environ, PYTHONPATH=ROOT_DIR, LOGSTASH_HOST='', LOG_LEVEL='WARNING',
+                       ACCESS_LOG_ENABLED='false', **settings)
+            service = subprocess.Popen([sys.executable, '-c', code], cwd=workdir, env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_until_up(f'http://127.0.0.1:{SERVICE_PORT}/health')
+                for endpoint in ENDPOINTS:
+                    for concurrency in args.concurrency:
+                        result = asyncio.run(load(f'http://127.0.0.1:{SERVICE_PORT}{endpoint}',
+                                                  args.requests, concurrency))
+                        print(f"{mode:<12} | {endpoint:<17} | {concurrency:<11} | {result['rps']:>8.1f} | "
+                              f"{result['p50']:>8.1f} | {result['p99']:>8.1f} | {result['errors']}")
+            finally:
+                service.terminate()
+                service.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Gateway engine benchmark: threaded Flask (app.py) vs asyncio (async_app.py)
+
+Starts a slow fake backend, runs each gateway engine in front of it and
+sends the same concurrent load to the public GET /api/products route.
+
+Usage: python benchmark_gateway.py [--requests 2000] [--concurrency 10 100 500] [--delay 0.2]
+Needs the api-gateway requirements plus aiohttp installed locally.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+import aiohttp
+from aiohttp import web
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+GATEWAY_DIR = os.path.join(ROOT_DIR, 'api-gateway')
+BACKEND_PORT = 9500
+GATEWAY_PORT = 9580
+
+ENGINES = {
+    'threaded': f"from app import app; app.run(host='127.0.0.1', port={GATEWAY_PORT}, threaded=True)",
+    'async': ("from aiohttp import web; from async_app import create_app; "
+              f"web.run_app(create_app(), host='127.0.0.1', port={GATEWAY_PORT}, access_log=None, print=None)"),
+}
+
+def run_backend(port, delay):
+    """Fake inventory-service answering after a fixed delay"""
+    async def products(request):
+        await asyncio.sleep(delay)
+        return web.json_response([{'id': i, 'name': f'Product {i}', 'price': 10.0, 'quantity': 5} for i in range(20)])
+
+    application = web.Application()
+    application.router.add_get('/api/products', products)
+    web.run_app(application, host='127.0.0.1', port=port, access_log=None, print=None)
+
+def wait_until_up(url, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+async def load(url, total, concurrency):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def client(session):
+        nonlocal errors
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'rps': total / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'errors': errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--delay', type=float, default=0.2, help='Backend latency in seconds')
+    parser.add_argument('--backend', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.backend:
+        run_backend(BACKEND_PORT, args.delay)
+        return
+
+    env = dict(os.environ,
+               INVENTORY_SERVICE_URL=f'http://127.0.0.1:{BACKEND_PORT}',
+               RATELIMIT_ENABLED='false',
+               UPSTREAM_POOL_MAXSIZE='1000',
+               PYTHONPATH=ROOT_DIR,  # for the shared common/ package
+               LOGSTASH_HOST='',
+               LOG_LEVEL='WARNING')
+    backend = subprocess.Popen([sys.executable, __file__, '--backend', '--delay', str(args.delay)])
+    try:
+        wait_until_up(f'http://127.0.0.1:{BACKEND_PORT}/api/products')
+        print(f"Backend latency: {args.delay * 1000:.0f} ms, {args.requests} requests per run\n")
+        print(f"{'Engine':<10} | {'Concurrency':<11} | {'Req/s':>8} | {'p50 ms':>8} | {'p99 ms':>8} | {'Errors'}")
+        print("-" * 65)
+        for engine, code in ENGINES.items():
+            gateway = subprocess.Popen([sys.executable, '-c', code], cwd=GATEWAY_DIR, env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_until_up(f'http://127.0.0.1:{GATEWAY_PORT}/health')
+                for concurrency in args.concurrency:
+                    result = asyncio.run(load(f'http://127.0.0.1:{GATEWAY_PORT}/api/products',
+                                              args.requests, concurrency))
+                    print(f"{engine:<10} | {concurrency:<11} | {result['rps']:>8.1f} | "
+                          f"{result['p50']:>8.1f} | {result['p99']:>8.1f} | {result['errors']}")
+            finally:
+                gateway.terminate()
+                gateway.wait()
+    finally:
+        backend.terminate()
+        backend.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Batch rate limit check: batch parts count against their caller (api-gateway /api/batch)
+
+Loads the gateway in-process with in-memory rate limit counters. Two
+clients, each with a token of its own and a different address, take turns
+sending /api/batch requests whose parts all ask for another customer's
+record (RBAC answers 403, so no upstream service is needed). Then checks that:
+- the first client can spend its whole default limit on batch parts
+- the second client's parts are still answered afterwards (no 429), i.e.
+  the two clients do not share one bucket
+- once a client has used up its limit, its own further parts get 429
+
+Usage: python check_batch_limits.py
+Needs the api-gateway requirements installed locally.
+"""
+import datetime
+import importlib.util
+import os
+import sys
+
+import jwt
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+GATEWAY_DIR = os.path.join(ROOT_DIR, 'api-gateway')
+CLIENTS = {'10.0.0.1': 1, '10.0.0.2': 2}  # Address -> customer id
+
+def load_gateway():
+    os.environ.update(LOGSTASH_HOST='', LOG_LEVEL='WARNING', ACCESS_LOG_ENABLED='false',
+                      RATELIMIT_ENABLED='true', RATELIMIT_STORAGE_URI='memory://')
+    sys.path[:0] = [ROOT_DIR, GATEWAY_DIR]
+    spec = importlib.util.spec_from_file_location('app', os.path.join(GATEWAY_DIR, 'app.py'))
+    gateway = importlib.util.module_from_spec(spec)
+    sys.modules['app'] = gateway
+    spec.loader.exec_module(gateway)
+    return gateway
+
+def token(gateway, customer_id):
+    return jwt.encode({'user_id': customer_id, 'email': f'customer{customer_id}@example.com', 'role': 'customer',
+                       'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                      gateway.app.config['SECRET_KEY'], algorithm='HS256')
+
+def batch(http, gateway, address, size):
+    """One /api/batch of size parts from the client at address; returns the part statuses"""
+    customer_id = CLIENTS[address]
+    response = http.post('/api/batch', json={'requests': [{'path': f'/api/customers/{customer_id + 100}'}] * size},
+                         headers={'Authorization': f'Bearer {token(gateway, customer_id)}'},
+                         environ_base={'REMOTE_ADDR': address})
+    assert response.status_code == 200, f"{address}: batch answered {response.status_code}"
+    return [part['status'] for part in response.get_json()['responses']]
+
+def main():
+    gateway = load_gateway()
+    http = gateway.app.test_client()
+    limit = int(gateway.DEFAULT_RATE_LIMIT.split()[0])
+    size = gateway.BATCH_MAX_REQUESTS
+    first, second = CLIENTS
+
+    # Together the two clients send more parts than one client's limit, each stays below it
+    statuses = {address: [] for address in CLIENTS}
+    for _ in range(limit // size - 1):
+        for address in CLIENTS:
+            statuses[address] += batch(http, gateway, address, size)
+    for address, seen in statuses.items():
+        assert 429 not in seen, f"{address}: {seen.count(429)} of {len(seen)} parts throttled"
+        assert set(seen) == {403}, f"{address}: unexpected statuses {set(seen)}"
+    print(f"OK  two clients batching in turn sent {sum(map(len, statuses.values()))} parts, none throttled")
+
+    while 429 not in statuses[first]:
+        statuses[first] += batch(http, gateway, first, size)
+    answered = len(statuses[first]) - statuses[first].count(429)
+    assert answered == limit, f"{first}: {answered} parts answered before 429, limit is {limit}"
+    seen = batch(http, gateway, second, size)
+    assert 429 not in seen, f"{second}: throttled by {first}'s parts"
+    print(f"OK  parts beyond a client's {gateway.DEFAULT_RATE_LIMIT} get 429, only for that client")
+
+if __name__ == '__main__':
+    main()
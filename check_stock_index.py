@@ -0,0 +1,154 @@
+"""
+Stock index check: concurrent reservations never oversell (inventory-service/stock_index.py)
+
+Seeds a scratch inventory database, loads inventory-service in-process and
+has --threads clients race single and batch reservations for a few
+products until they are sold out. Then checks that:
+- no product sold more units than it had, and every unit was sold
+- stock seen in the index equals the initial stock minus what was sold
+- after a checkpoint, the products table holds the same stock
+- a second process refuses to load the index of a database in use
+- after a crash (a child process reserving, then exiting without a
+  checkpoint) the journal is replayed at startup and nothing is lost
+
+Usage: python check_stock_index.py [--threads 32] [--products 5] [--stock 200]
+Needs the inventory-service requirements installed locally.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(ROOT_DIR, 'inventory-service')
+
+def load_service(workdir):
+    # The service opens inventory.db and its journal in the working directory
+    os.chdir(workdir)
+    os.environ.update(LOGSTASH_HOST='', LOG_LEVEL='WARNING', ACCESS_LOG_ENABLED='false')
+    sys.path[:0] = [ROOT_DIR, SERVICE_DIR]
+    spec = importlib.util.spec_from_file_location('inventory_app', os.path.join(SERVICE_DIR, 'app.py'))
+    service = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(service)
+    return service
+
+def seed(path, products, stock):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE products
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name TEXT NOT NULL,
+                     description TEXT,
+                     price REAL NOT NULL,
+                     quantity INTEGER NOT NULL,
+                     sku TEXT UNIQUE,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.executemany('INSERT INTO products (name, description, price, quantity, sku) VALUES (?, ?, ?, ?, ?)',
+                     [(f'Product {i}', None, 10.0, stock, f'SKU{i:06d}') for i in range(products)])
+    conn.commit()
+    conn.close()
+
+def stored_quantities(path):
+    conn = sqlite3.connect(path)
+    quantities = dict(conn.execute('SELECT id, quantity FROM products').fetchall())
+    conn.close()
+    return quantities
+
+def race(service, product_ids, threads):
+    """Reserve random lines until every product is sold out; returns units sold per product"""
+    sold = {product_id: 0 for product_id in product_ids}
+    lock = threading.Lock()
+
+    def client():
+        http = service.app.test_client()
+        while any(service.stock_index.quantity(product_id) for product_id in product_ids):
+            lines = {random.choice(product_ids): random.randint(1, 3) for _ in range(random.randint(1, 2))}
+            if len(lines) == 1:
+                [(product_id, quantity)] = lines.items()
+                response = http.post('/api/products/reserve', json={'product_id': product_id, 'quantity': quantity})
+            else:
+                response = http.post('/api/products/reserve-batch', json={'items': [
+                    {'product_id': product_id, 'quantity': quantity} for product_id, quantity in lines.items()]})
+            if response.status_code == 200:
+                with lock:
+                    for product_id, quantity in lines.items():
+                        sold[product_id] += quantity
+            elif response.status_code != 400:
+                raise AssertionError(f"Unexpected {response.status_code}: {response.get_data(as_text=True)}")
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sold
+
+def crash(workdir, threads):
+    """Child process: sell out, make sure it is journaled, exit without a checkpoint"""
+    os.environ['STOCK_CHECKPOINT_MS'] = str(3600 * 1000)
+    service = load_service(workdir)
+    product_ids = [row['id'] for row in service.app.test_client().get('/api/products').get_json()]
+    sold = race(service, product_ids, threads)
+    print(sum(sold.values()), flush=True)
+    os._exit(0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--products', type=int, default=5)
+    parser.add_argument('--stock', type=int, default=200)
+    parser.add_argument('--crash', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.crash:
+        crash(args.crash, args.threads)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database = os.path.join(workdir, 'inventory.db')
+        seed(database, args.products, args.stock)
+        os.environ['STOCK_CHECKPOINT_MS'] = '50'
+        service = load_service(workdir)
+        product_ids = list(range(1, args.products + 1))
+
+        sold = race(service, product_ids, args.threads)
+        print(f"{args.threads} threads sold {sum(sold.values())} units of {args.products} products x {args.stock}")
+        for product_id, units in sold.items():
+            assert units == args.stock, f"Product {product_id}: sold {units} of {args.stock}"
+            assert service.stock_index.quantity(product_id) == 0, f"Product {product_id}: index not at 0"
+        print("OK  no oversell, every unit sold once")
+
+        service.stock_index.journal.checkpoint()
+        assert stored_quantities(database) == {product_id: 0 for product_id in product_ids}, stored_quantities(database)
+        print("OK  products table matches the index after a checkpoint")
+
+        # Restock through the admin path (write-through), then sell out again in a process that crashes
+        http = service.app.test_client()
+        for product_id in product_ids:
+            http.put(f'/api/products/{product_id}', json={'name': f'Product {product_id}', 'price': 10.0,
+                                                           'quantity': args.stock})
+        service.stock_index.journal.checkpoint()
+        assert stored_quantities(database) == {product_id: args.stock for product_id in product_ids}
+        crash_command = [sys.executable, __file__, '--crash', workdir, '--threads', str(args.threads)]
+        refused = subprocess.run(crash_command, capture_output=True, text=True)
+        assert refused.returncode != 0 and 'StockIndexLocked' in refused.stderr, refused.stderr[-500:]
+        print("OK  a second process refuses to load the index of a database in use")
+
+        service.stock_index.release()  # Hand the database over to the child, claimed back by load()
+        child = subprocess.run(crash_command, capture_output=True, text=True, check=True)
+        units = int(child.stdout.split()[-1])
+        assert units == args.stock * args.products, f"Crashed process sold {units} units"
+        segments = [name for name in os.listdir(workdir) if name.startswith('stock-journal.')]
+        assert segments, "Crashed process left no journal"
+        assert stored_quantities(database) == {product_id: args.stock for product_id in product_ids}
+
+        service.stock_index.load()
+        assert stored_quantities(database) == {product_id: 0 for product_id in product_ids}, stored_quantities(database)
+        assert all(service.stock_index.quantity(product_id) == 0 for product_id in product_ids)
+        assert not [name for name in os.listdir(workdir) if name.startswith('stock-journal.')]
+        print(f"OK  {len(segments)} journal segment(s) of a crashed process replayed at startup")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+"""
+Shared helpers used by every service (copied into each image as /app/common)
+"""
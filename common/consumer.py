@@ -0,0 +1,346 @@
+"""
+RabbitMQ Consumer Runtime
+
+Runs a queue's handler on a pool of worker threads instead of the pika
+callback thread, so one slow message no longer holds up the whole queue.
+The pika connection stays on a single thread (BlockingConnection is not
+thread-safe): it receives deliveries, hands them to the workers and
+settles them when the workers report back through
+add_callback_threadsafe. Acks are sent in delivery order, as one
+multiple=True ack per contiguous run of finished messages; a failed
+message is nacked without requeue, as before, unless it failed with one of
+the consumer's requeue_on exception types (transient failures such as
+timeouts). Those are retried: a copy carrying an x-retry-count header is
+published to the back of the queue and the original acked. After
+CONSUMER_MAX_REDELIVERIES retries the copy goes to the <queue>.dead queue
+instead, parked for inspection and manual replay. A handler that hands the
+message on to other threads (e.g. a common.pipeline.Pipeline) returns the
+Future of that work, and the message is settled when the Future completes.
+
+CONSUMER_PREFETCH bounds the unacked deliveries the broker sends, and so
+the messages buffered in front of the workers. stop() drains: it cancels
+the consumer, waits for in-flight messages to finish and be acked (up to
+CONSUMER_DRAIN_TIMEOUT), then closes the connection. Anything still
+unacked is redelivered by the broker.
+
+BatchConsumer is the variant for handlers that write every message: it
+hands the handler whole batches (N messages or T milliseconds, whichever
+comes first) so they can be persisted in one transaction, and acks a batch
+with one multiple=True ack only after the handler has returned.
+"""
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pika
+from flask import g
+from prometheus_client import Counter, Gauge, Summary
+
+from common.events import RABBITMQ_HOST, RABBITMQ_PORT
+
+CONSUMER_WORKERS = int(os.getenv('CONSUMER_WORKERS', '4'))
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', '0'))  # 0 = twice the worker count
+CONSUMER_DRAIN_TIMEOUT = float(os.getenv('CONSUMER_DRAIN_TIMEOUT', '30'))  # Seconds to finish in-flight messages on stop
+CONSUMER_MAX_REDELIVERIES = int(os.getenv('CONSUMER_MAX_REDELIVERIES', '5'))  # Retries of a requeue_on failure before parking it
+
+RETRY_HEADER = 'x-retry-count'
+
+logger = logging.getLogger(__name__)
+
+consumer_messages = Counter('consumer_messages', 'Messages handled by queue consumers', ['queue', 'result'])
+consumer_in_flight = Gauge('consumer_in_flight', 'Delivered messages not yet acked', ['queue'])
+consumer_handle_seconds = Summary('consumer_handle_seconds', 'Time spent in the message handler', ['queue'])
+consumer_batch_size = Summary('consumer_batch_size', 'Messages per batch handed to a batch handler', ['queue'])
+
+
+class AckTracker:
+    """Settles the deliveries of one channel in delivery-tag order"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.outstanding = deque()  # Delivery tags in arrival order
+        self.finished = {}  # delivery tag -> succeeded
+
+    def delivered(self, tag):
+        self.outstanding.append(tag)
+
+    def finish(self, tag, succeeded):
+        """Record a result and settle every finished message at the head of the queue"""
+        self.finished[tag] = succeeded
+        ack_upto = None
+        while self.outstanding and self.outstanding[0] in self.finished:
+            head = self.outstanding.popleft()
+            if self.finished.pop(head):
+                ack_upto = head
+                continue
+            if ack_upto is not None:
+                self.channel.basic_ack(delivery_tag=ack_upto, multiple=True)
+                ack_upto = None
+            self.channel.basic_nack(delivery_tag=head, requeue=False)
+        if ack_upto is not None:
+            self.channel.basic_ack(delivery_tag=ack_upto, multiple=True)
+
+
+class EventConsumer:
+    """Consume one queue bound to an exchange with a pool of worker threads"""
+
+    def __init__(self, queue, exchange, routing_keys, handler, app=None, workers=CONSUMER_WORKERS,
+                 prefetch=CONSUMER_PREFETCH, host=RABBITMQ_HOST, port=RABBITMQ_PORT, exchange_type='topic',
+                 requeue_on=(), max_redeliveries=CONSUMER_MAX_REDELIVERIES):
+        self.queue = queue
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.routing_keys = routing_keys
+        self.handler = handler  # handler(event_type, data), may return a Future
+        self.app = app  # Handlers run inside its app context, with g.correlation_id set
+        self.workers = workers
+        self.prefetch = prefetch or workers * 2
+        self.requeue_on = tuple(requeue_on)  # Exception types whose messages are retried instead of dropped
+        self.max_redeliveries = max_redeliveries
+        self.dead_letter_queue = f'{queue}.dead'
+        self.parameters = pika.ConnectionParameters(host=host, port=port, heartbeat=30)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'consumer-{queue}')
+        self.stopping = threading.Event()
+        self.thread = None
+        consumer_in_flight.labels(queue).set(0)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f'consumer-{self.queue}', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=CONSUMER_DRAIN_TIMEOUT):
+        """Stop consuming, finish in-flight messages and close the connection"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout + 5)
+        self.executor.shutdown(wait=False)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self._consume()
+            except Exception as e:
+                logger.error(f"Consumer error: {str(e)}", extra={'correlation_id': 'system', 'queue': self.queue})
+                self.stopping.wait(5)
+
+    def _open_channel(self):
+        connection = pika.BlockingConnection(self.parameters)
+        channel = connection.channel()
+
+        # Declare exchange and queue, bind the routing keys
+        channel.exchange_declare(exchange=self.exchange, exchange_type=self.exchange_type, durable=True)
+        channel.queue_declare(queue=self.queue, durable=True)
+        for routing_key in self.routing_keys:
+            channel.queue_bind(exchange=self.exchange, queue=self.queue, routing_key=routing_key)
+        if self.requeue_on:
+            channel.queue_declare(queue=self.dead_letter_queue, durable=True)
+        channel.basic_qos(prefetch_count=self.prefetch)
+        return connection, channel
+
+    def _consume(self):
+        connection, channel = self._open_channel()
+        tracker = AckTracker(channel)
+
+        def on_message(ch, method, properties, body):
+            tracker.delivered(method.delivery_tag)
+            consumer_in_flight.labels(self.queue).inc()
+            self.executor.submit(self._work, connection, tracker, method.delivery_tag, properties, body)
+
+        consumer_tag = channel.basic_consume(queue=self.queue, on_message_callback=on_message)
+        logger.info(f"Consuming {self.queue} with {self.workers} workers, prefetch {self.prefetch}",
+                    extra={'correlation_id': 'system'})
+        while not self.stopping.is_set():
+            connection.process_data_events(time_limit=0.5)
+
+        # Graceful drain: no new deliveries, wait for the workers to settle what they hold
+        channel.basic_cancel(consumer_tag)
+        deadline = time.monotonic() + CONSUMER_DRAIN_TIMEOUT
+        while tracker.outstanding and time.monotonic() < deadline:
+            connection.process_data_events(time_limit=0.1)
+        if tracker.outstanding:
+            logger.warning(f"{len(tracker.outstanding)} messages left unacked on {self.queue}, they will be redelivered",
+                           extra={'correlation_id': 'system'})
+        connection.close()
+
+    def _work(self, connection, tracker, tag, properties, body):
+        start = time.perf_counter()
+        result = self._handle(properties, body)
+        if isinstance(result, Future):
+            # The handler handed the message on: settle it when that work completes
+            result.add_done_callback(lambda future: self._finished(connection, tracker, tag, future, start,
+                                                                   properties, body))
+        else:
+            self._settle(connection, tracker, tag, result, start, properties, body)
+
+    def _finished(self, connection, tracker, tag, future, start, properties, body):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Error processing message: {str(error)}",
+                         extra={'correlation_id': properties.correlation_id or 'system'})
+        self._settle(connection, tracker, tag, error, start, properties, body)
+
+    def _settle(self, connection, tracker, tag, error, start, properties, body):
+        consumer_handle_seconds.labels(self.queue).observe(time.perf_counter() - start)
+        retries = (properties.headers or {}).get(RETRY_HEADER, 0)
+        if error is None:
+            result = 'ok'
+        elif not isinstance(error, self.requeue_on):
+            result = 'failed'
+        elif retries < self.max_redeliveries:
+            result = 'requeued'
+        else:
+            result = 'dead_lettered'
+            logger.error(f"Giving up after {retries} retries, parking the message in {self.dead_letter_queue}",
+                         extra={'correlation_id': properties.correlation_id or 'system'})
+        consumer_messages.labels(self.queue, result).inc()
+
+        def settle():
+            consumer_in_flight.labels(self.queue).dec()
+            if result == 'requeued':
+                self._republish(tracker.channel, self.queue, properties, body, retries + 1)
+            elif result == 'dead_lettered':
+                self._republish(tracker.channel, self.dead_letter_queue, properties, body, retries)
+            # A retried or parked message lives on in its copy: the original is acked
+            tracker.finish(tag, result != 'failed')
+        try:
+            connection.add_callback_threadsafe(settle)
+        except Exception:
+            # Connection already gone: the broker redelivers the message
+            consumer_in_flight.labels(self.queue).dec()
+
+    def _republish(self, channel, queue, properties, body, retries):
+        """Publish a copy of a delivery straight to queue (default exchange), with its retry count"""
+        properties.headers = dict(properties.headers or {}, **{RETRY_HEADER: retries})
+        channel.basic_publish(exchange='', routing_key=queue, body=body, properties=properties)
+
+    def _handle(self, properties, body):
+        """Run the handler: returns its Future, None if it succeeded, or the exception it raised"""
+        correlation_id = properties.correlation_id or 'system'
+        try:
+            message = json.loads(body)
+            event_type = message.get('event')
+            logger.info(f"Received event: {event_type}", extra={'correlation_id': correlation_id})
+            if self.app is None:
+                result = self.handler(event_type, message.get('data'))
+            else:
+                with self.app.app_context():
+                    g.correlation_id = correlation_id
+                    result = self.handler(event_type, message.get('data'))
+            return result if isinstance(result, Future) else None
+        except Exception as e:
+            logger.error(f"Error processing message: {str(e)}", extra={'correlation_id': correlation_id})
+            return e
+
+
+class BatchConsumer(EventConsumer):
+    """Consume a queue in batches, acking each batch once its handler has made it durable
+
+    batch_handler(events) receives a list of (event_type, data, correlation_id)
+    and must persist them all (e.g. one executemany transaction) before
+    returning. A batch is handed over when it reaches batch_size messages or
+    its oldest message has waited max_wait_ms, then acked with a single
+    multiple=True ack. If the batch handler fails, the events are retried one
+    by one so only the failing ones are nacked.
+    """
+
+    def __init__(self, queue, exchange, routing_keys, batch_handler, app=None, batch_size=100,
+                 max_wait_ms=200, host=RABBITMQ_HOST, port=RABBITMQ_PORT, exchange_type='topic'):
+        # The prefetch window must hold more than one batch or flushes would wait for the timer
+        super().__init__(queue, exchange, routing_keys, None, app=app, workers=1, prefetch=batch_size * 2,
+                         host=host, port=port, exchange_type=exchange_type)
+        self.batch_handler = batch_handler
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+
+    def _consume(self):
+        connection, channel = self._open_channel()
+        batch = []  # (delivery tag, (event_type, data, correlation_id))
+        batch_started = None
+
+        def flush():
+            nonlocal batch_started
+            if batch:
+                self._flush(channel, batch)
+                batch.clear()
+            batch_started = None
+
+        def on_message(ch, method, properties, body):
+            nonlocal batch_started
+            try:
+                message = json.loads(body)
+                event = (message.get('event'), message.get('data'), properties.correlation_id or 'system')
+            except ValueError as e:
+                logger.error(f"Error processing message: {str(e)}", extra={'correlation_id': 'system'})
+                consumer_messages.labels(self.queue, 'failed').inc()
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                return
+            if not batch:
+                batch_started = time.monotonic()
+            batch.append((method.delivery_tag, event))
+            if len(batch) >= self.batch_size:
+                flush()
+
+        consumer_tag = channel.basic_consume(queue=self.queue, on_message_callback=on_message)
+        logger.info(f"Consuming {self.queue} in batches of {self.batch_size} / {self.max_wait * 1000:.0f} ms",
+                    extra={'correlation_id': 'system'})
+        while not self.stopping.is_set():
+            if batch_started is None:
+                connection.process_data_events(time_limit=0.5)
+                continue
+            remaining = batch_started + self.max_wait - time.monotonic()
+            if remaining > 0:
+                connection.process_data_events(time_limit=remaining)
+            if batch_started is not None and time.monotonic() - batch_started >= self.max_wait:
+                flush()
+
+        # Graceful drain: stop deliveries, persist and ack what was already received
+        channel.basic_cancel(consumer_tag)
+        connection.process_data_events(time_limit=0)
+        flush()
+        connection.close()
+
+    def _run_batch_handler(self, events):
+        if self.app is None:
+            self.batch_handler(events)
+            return
+        with self.app.app_context():
+            g.correlation_id = events[0][2] if len(events) == 1 else 'system'
+            self.batch_handler(events)
+
+    def _flush(self, channel, batch):
+        start = time.perf_counter()
+        try:
+            self._run_batch_handler([event for _, event in batch])
+            # Everything up to the last tag of this batch is durable (failed messages were nacked already)
+            channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+            consumer_messages.labels(self.queue, 'ok').inc(len(batch))
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} failed, retrying one by one: {str(e)}", extra={'correlation_id': 'system'})
+            for tag, event in batch:
+                try:
+                    self._run_batch_handler([event])
+                    channel.basic_ack(delivery_tag=tag)
+                    consumer_messages.labels(self.queue, 'ok').inc()
+                except Exception as e:
+                    logger.error(f"Error processing message: {str(e)}", extra={'correlation_id': event[2]})
+                    channel.basic_nack(delivery_tag=tag, requeue=False)
+                    consumer_messages.labels(self.queue, 'failed').inc()
+        consumer_handle_seconds.labels(self.queue).observe(time.perf_counter() - start)
+        consumer_batch_size.labels(self.queue).observe(len(batch))
+
+
+def drain_on_shutdown(*consumers):
+    """Stop the consumers gracefully on SIGTERM/SIGINT (call from the main thread)"""
+    def handle_signal(signum, frame):
+        for consumer in consumers:
+            consumer.stop()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
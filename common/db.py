@@ -0,0 +1,168 @@
+"""
+SQLite Access Layer
+
+Replaces the connect / query / close pattern in every handler with a
+small pool of long-lived connections per database file. Reusing a
+connection keeps its page cache, its memory map and its prepared
+statement cache (sqlite3's cached_statements) warm between requests.
+
+Each connection is opened with:
+- journal_mode=WAL: readers no longer block the writer or each other
+- synchronous=NORMAL: with WAL, commits no longer fsync (only checkpoints
+  do); a power cut can lose the last transactions but never corrupts
+- cache_size / mmap_size: larger page cache and memory-mapped reads
+- busy_timeout: wait for a lock instead of failing at once
+
+Connections run in autocommit mode. Writes go through transaction(),
+which starts with BEGIN IMMEDIATE: the write lock is taken up front, so a
+busy database means waiting up to DB_BUSY_TIMEOUT_MS rather than a
+SQLITE_BUSY halfway through a transaction that busy_timeout cannot retry.
+
+Flask's threaded server starts a thread per request, so connections are
+pooled rather than kept per thread: a thread borrows one for the duration
+of a `with` block (check_same_thread is off, a connection is only ever
+used by one thread at a time). DB_POOL_SIZE=0 turns pooling off and opens
+a connection per block, which is what benchmark_db.py compares against.
+
+Schemas are versioned: migrate() applies each (version, statements) step
+newer than the file's PRAGMA user_version in its own write transaction, so
+several processes starting at once apply every step exactly once.
+init_query_plans() serves EXPLAIN QUERY PLAN for a service's hot queries
+at /diagnostics/query-plans, flagging full table scans and sorts.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import jsonify
+from prometheus_client import Counter
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '16'))  # Idle connections kept per database, 0 = no pooling
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))  # Max wait for a lock
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '16384'))  # Page cache per connection
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))  # Bytes of the file read through mmap
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '128'))  # Prepared statements per connection
+
+logger = logging.getLogger(__name__)
+
+db_connections_opened = Counter('db_connections_opened', 'SQLite connections opened', ['database'])
+db_busy_errors = Counter('db_busy_errors', 'Operations that gave up waiting for a SQLite lock', ['database'])
+
+
+class Database:
+    """Pooled, tuned connections to one SQLite file"""
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self.idle = []  # LIFO, so the warmest connection is reused first
+        self.lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                               check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={DB_SYNCHRONOUS}')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        db_connections_opened.labels(self.path).inc()
+        return conn
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self._open()
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            # Left open by an error: never hand a connection back mid-transaction
+            conn.rollback()
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection (autocommit) for reads"""
+        conn = self._acquire()
+        try:
+            yield conn
+        except sqlite3.OperationalError as e:
+            self._count_busy(e)
+            raise
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self, durable=False):
+        """Borrow a connection inside BEGIN IMMEDIATE ... COMMIT (rolled back on error)
+
+        durable=True fsyncs this commit (synchronous=FULL), for writes that must
+        survive a power cut and not just a crash.
+        """
+        with self.connection() as conn:
+            if durable:
+                conn.execute('PRAGMA synchronous=FULL')
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield conn
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+            finally:
+                if durable:
+                    conn.execute(f'PRAGMA synchronous={DB_SYNCHRONOUS}')
+
+    def schema_version(self):
+        with self.connection() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, migrations):
+        """Apply the (version, [statements]) migrations newer than the schema version, in order"""
+        for version, statements in sorted(migrations, key=lambda migration: migration[0]):
+            with self.transaction() as conn:
+                # Re-read under the write lock: another process may have applied it meanwhile
+                if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+            logger.info(f"{self.path}: applied schema migration {version}")
+
+    def explain(self, sql, params=()):
+        """EXPLAIN QUERY PLAN details for a query, e.g. ['SEARCH orders USING INDEX ... (customer_id=?)']"""
+        with self.connection() as conn:
+            return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+    def _count_busy(self, error):
+        if 'locked' in str(error) or 'busy' in str(error):
+            db_busy_errors.labels(self.path).inc()
+            logger.warning(f"{self.path}: gave up waiting for a lock after {DB_BUSY_TIMEOUT_MS} ms")
+
+
+def init_query_plans(app, db, queries):
+    """Serve the query plans of {name: (sql, params)} at GET /diagnostics/query-plans"""
+
+    @app.route('/diagnostics/query-plans', methods=['GET'])
+    def query_plans():
+        plans = {}
+        for name, (sql, params) in queries.items():
+            plan = db.explain(sql, params)
+            plans[name] = {
+                'sql': sql,
+                'plan': plan,
+                # "SCAN t" reads the whole table, even "SCAN t USING INDEX" (index order, no filter)
+                'full_scan': any(detail.startswith('SCAN') for detail in plan),
+                'temp_sort': any('TEMP B-TREE' in detail for detail in plan)
+            }
+        return jsonify({'database': db.path, 'schema_version': db.schema_version(), 'queries': plans}), 200
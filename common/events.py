@@ -0,0 +1,210 @@
+"""
+RabbitMQ Event Publisher
+
+One long-lived connection per process, owned by a background thread running
+pika's SelectConnection. publish_event() only appends the message to a
+bounded local buffer and wakes that thread, so callers never wait on the
+broker. The thread declares the exchange once, publishes with publisher
+confirms enabled and drops messages from the buffer only when the broker
+acks them; the broker acks in batches (multiple=True). Nacked messages and
+messages unconfirmed when the connection drops are published again after
+reconnecting, so delivery is at-least-once. While the broker is down,
+messages wait in the buffer, up to PUBLISHER_BUFFER_SIZE.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import pika
+from prometheus_client import Counter, Gauge
+
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
+PUBLISHER_BUFFER_SIZE = int(os.getenv('PUBLISHER_BUFFER_SIZE', '10000'))  # Messages kept while the broker is down
+PUBLISHER_MAX_IN_FLIGHT = int(os.getenv('PUBLISHER_MAX_IN_FLIGHT', '256'))  # Published but not yet confirmed
+PUBLISHER_MAX_BACKOFF = float(os.getenv('PUBLISHER_MAX_BACKOFF', '10'))  # Max wait between reconnect attempts
+PUBLISHER_CLOSE_TIMEOUT = float(os.getenv('PUBLISHER_CLOSE_TIMEOUT', '5'))  # Flush time allowed at exit
+
+logger = logging.getLogger(__name__)
+
+events_published = Counter('events_published', 'Events confirmed by the broker', ['exchange'])
+events_republished = Counter('events_republished', 'Events queued again after a nack or lost connection', ['exchange'])
+events_dropped = Counter('events_dropped', 'Events dropped because the publish buffer was full', ['exchange'])
+publisher_buffer_depth = Gauge('publisher_buffer_depth', 'Events waiting to be published or confirmed', ['exchange'])
+
+
+class EventPublisher:
+    """Thread-safe, non-blocking publisher to one exchange"""
+
+    def __init__(self, exchange, exchange_type='topic', host=RABBITMQ_HOST, port=RABBITMQ_PORT):
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.parameters = pika.ConnectionParameters(host=host, port=port, heartbeat=30)
+        self.lock = threading.Lock()
+        self.outbox = deque()  # (routing_key, body) not yet published
+        self.unconfirmed = {}  # delivery tag -> (routing_key, body)
+        self.connection = None
+        self.channel = None
+        self.ready = False  # Channel open, confirms on and exchange declared
+        self.exchange_declared = False
+        self.flush_scheduled = False
+        self.delivery_tag = 0
+        self.closing = False
+        self.thread = None
+        publisher_buffer_depth.labels(exchange).set_function(lambda: len(self.outbox) + len(self.unconfirmed))
+
+    def publish_event(self, event_type, data):
+        """Queue {'event': event_type, 'data': data} for publishing with routing key event_type"""
+        body = json.dumps({'event': event_type, 'data': data})
+        with self.lock:
+            if len(self.outbox) + len(self.unconfirmed) >= PUBLISHER_BUFFER_SIZE:
+                events_dropped.labels(self.exchange).inc()
+                logger.error(f"Event buffer full, dropping {event_type}", extra={'exchange': self.exchange})
+                return False
+            self.outbox.append((event_type, body))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=f'publisher-{self.exchange}', daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+            schedule = self.ready and not self.flush_scheduled
+            if schedule:
+                self.flush_scheduled = True
+            connection = self.connection
+        if schedule:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._flush)
+            except Exception:
+                # Connection is going away; the buffer is flushed after reconnecting
+                pass
+        return True
+
+    # Everything below runs on the publisher thread
+
+    def _run(self):
+        backoff = 0.5
+        while not self.closing:
+            opened_at = time.monotonic()
+            try:
+                connection = pika.SelectConnection(
+                    self.parameters,
+                    on_open_callback=self._on_connection_open,
+                    on_open_error_callback=self._on_connection_error,
+                    on_close_callback=self._on_connection_closed
+                )
+                with self.lock:
+                    self.connection = connection
+                connection.ioloop.start()
+            except Exception as e:
+                logger.error(f"Event publisher error: {str(e)}", extra={'exchange': self.exchange})
+            if self.closing:
+                return
+            # A connection that stayed up for a while resets the backoff
+            backoff = 0.5 if time.monotonic() - opened_at > PUBLISHER_MAX_BACKOFF else min(backoff * 2, PUBLISHER_MAX_BACKOFF)
+            time.sleep(backoff)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        logger.warning(f"Cannot connect to RabbitMQ: {error}", extra={'exchange': self.exchange})
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        self._requeue_unconfirmed()
+        with self.lock:
+            self.connection = None
+        if not self.closing:
+            logger.warning(f"RabbitMQ connection closed: {reason}", extra={'exchange': self.exchange})
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        self.delivery_tag = 0
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        if self.exchange_declared:
+            self._on_exchange_declared(None)
+        else:
+            channel.exchange_declare(exchange=self.exchange, exchange_type=self.exchange_type, durable=True,
+                                     callback=self._on_exchange_declared)
+
+    def _on_exchange_declared(self, frame):
+        self.exchange_declared = True
+        with self.lock:
+            self.ready = True
+            self.flush_scheduled = True
+        self._flush()
+
+    def _on_channel_closed(self, channel, reason):
+        # e.g. 404 when the exchange vanished with a broker reset: declare it again on the next channel
+        self.exchange_declared = False
+        with self.lock:
+            self.ready = False
+        self._requeue_unconfirmed()
+        if not self.closing and self.connection is not None and self.connection.is_open:
+            logger.warning(f"RabbitMQ channel closed: {reason}", extra={'exchange': self.exchange})
+            self.connection.channel(on_open_callback=self._on_channel_open)
+
+    def _requeue_unconfirmed(self):
+        with self.lock:
+            self.ready = False
+            pending = [self.unconfirmed[tag] for tag in sorted(self.unconfirmed)]
+            self.unconfirmed.clear()
+            self.outbox.extendleft(reversed(pending))
+        if pending:
+            events_republished.labels(self.exchange).inc(len(pending))
+
+    def _flush(self):
+        """Publish buffered messages while the in-flight window allows"""
+        with self.lock:
+            self.flush_scheduled = False
+            if not self.ready:
+                return
+            while self.outbox and len(self.unconfirmed) < PUBLISHER_MAX_IN_FLIGHT:
+                routing_key, body = self.outbox.popleft()
+                self.delivery_tag += 1
+                self.unconfirmed[self.delivery_tag] = (routing_key, body)
+                self.channel.basic_publish(
+                    exchange=self.exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                        content_type='application/json'
+                    )
+                )
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self.lock:
+            tags = [t for t in self.unconfirmed if t <= method.delivery_tag] if method.multiple else [method.delivery_tag]
+            messages = [self.unconfirmed.pop(t) for t in sorted(tags) if t in self.unconfirmed]
+            if not acked:
+                self.outbox.extendleft(reversed(messages))
+        if acked:
+            events_published.labels(self.exchange).inc(len(messages))
+        else:
+            events_republished.labels(self.exchange).inc(len(messages))
+        self._flush()
+
+    def close(self, timeout=PUBLISHER_CLOSE_TIMEOUT):
+        """Wait (bounded) for buffered events to be confirmed, then close the connection"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.outbox and not self.unconfirmed:
+                    break
+            time.sleep(0.05)
+        self.closing = True
+        with self.lock:
+            connection = self.connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(connection.close)
+            except Exception:
+                pass
@@ -0,0 +1,145 @@
+"""
+Paginated List Endpoints
+
+List endpoints used to fetchall() a whole table and jsonify it. A Listing
+reads the list parameters of the request and answers in one of two modes,
+both returning the same JSON array of rows as before:
+
+- Paged (`limit` given): keyset pagination. Rows come in (sort column, id)
+  order and `after` is an opaque cursor holding the last row's sort value
+  and id, so page N costs the same as page 1 (no OFFSET) and pages stay
+  stable while rows are inserted. When there is a next page, its cursor is
+  in the X-Next-Cursor header and its URL in a Link: rel="next" header.
+- Streamed (no `limit`): the full list, encoded row by row from the
+  cursor as the response is sent, so memory no longer grows with the table.
+
+`sort=<column>` or `sort=-<column>` (descending) and `<column>=<value>`
+equality filters are accepted only for the columns a Listing is given,
+which are the ones its service indexes.
+"""
+import base64
+import json
+import os
+from urllib.parse import urlencode
+
+from flask import Response, jsonify
+
+LIST_DEFAULT_LIMIT = int(os.getenv('LIST_DEFAULT_LIMIT', '100'))  # Page size for ?limit= without a value
+LIST_MAX_LIMIT = int(os.getenv('LIST_MAX_LIMIT', '1000'))
+LIST_STREAM_BATCH = int(os.getenv('LIST_STREAM_BATCH', '500'))  # Rows fetched per step when streaming
+
+
+class ListError(ValueError):
+    """Invalid list parameters (400)"""
+
+
+def encode_cursor(sort_value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, row_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return sort_value, int(row_id)
+    except (ValueError, TypeError):
+        raise ListError('Invalid after cursor')
+
+
+class Listing:
+    """Filtered, sorted, keyset-paginated or streamed list of one table"""
+
+    def __init__(self, db, table, columns, to_dict, filters=(), sorts=('id',), default_sort='id'):
+        self.db = db
+        self.table = table
+        self.columns = list(columns)  # Must include id
+        self.to_dict = to_dict  # row tuple -> dict
+        self.filters = set(filters)
+        self.sorts = set(sorts) | {'id'}
+        self.default_sort = default_sort
+
+    def respond(self, path, args, where=None):
+        """Flask response for the request args; where holds fixed filters, e.g. the caller's customer_id"""
+        try:
+            return self._respond(path, args, where or {})
+        except ListError as e:
+            return jsonify({'message': str(e)}), 400
+
+    def _respond(self, path, args, where):
+        sort = args.get('sort', self.default_sort)
+        descending = sort.startswith('-')
+        column = sort.lstrip('-')
+        if column not in self.sorts:
+            raise ListError(f"Cannot sort by {column}, use one of: {', '.join(sorted(self.sorts))}")
+
+        conditions, params = [], []
+        for name, value in args.items():
+            if name in ('limit', 'after', 'sort'):
+                continue
+            if name not in self.filters:
+                raise ListError(f"Cannot filter by {name}, use one of: {', '.join(sorted(self.filters)) or 'none'}")
+            conditions.append(f'{name} = ?')
+            params.append(value)
+        for name, value in where.items():
+            conditions.append(f'{name} = ?')
+            params.append(value)
+
+        direction = 'DESC' if descending else 'ASC'
+        order_by = f'id {direction}' if column == 'id' else f'{column} {direction}, id {direction}'
+        if 'limit' not in args:
+            return self._stream(conditions, params, order_by)
+
+        try:
+            limit = int(args['limit'] or LIST_DEFAULT_LIMIT)
+        except ValueError:
+            raise ListError('limit must be a number')
+        if not 1 <= limit <= LIST_MAX_LIMIT:
+            raise ListError(f'limit must be between 1 and {LIST_MAX_LIMIT}')
+
+        after = args.get('after')
+        if after:
+            sort_value, row_id = decode_cursor(after)
+            comparison = '<' if descending else '>'
+            if column == 'id':
+                conditions.append(f'id {comparison} ?')
+                params.append(row_id)
+            else:
+                # Row-value comparison keeps (column, id) ordering in one index range scan
+                conditions.append(f'({column}, id) {comparison} (?, ?)')
+                params.extend([sort_value, row_id])
+
+        sql = f"SELECT {', '.join(self.columns)} FROM {self.table}{self._where(conditions)} ORDER BY {order_by} LIMIT ?"
+        with self.db.connection() as conn:
+            rows = conn.execute(sql, params + [limit + 1]).fetchall()
+
+        response = jsonify([self.to_dict(row) for row in rows[:limit]])
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            cursor = encode_cursor(last[self.columns.index(column)], last[self.columns.index('id')])
+            next_args = [(k, v) for k, v in args.items(multi=True) if k != 'after'] + [('after', cursor)]
+            response.headers['X-Next-Cursor'] = cursor
+            response.headers['Link'] = f'<{path}?{urlencode(next_args)}>; rel="next"'
+        return response
+
+    def _stream(self, conditions, params, order_by):
+        sql = f"SELECT {', '.join(self.columns)} FROM {self.table}{self._where(conditions)} ORDER BY {order_by}"
+
+        def generate():
+            # Holds a pooled connection until the last row is sent (or the client goes away)
+            with self.db.connection() as conn:
+                cursor = conn.execute(sql, params)
+                yield '['
+                separator = ''
+                while True:
+                    rows = cursor.fetchmany(LIST_STREAM_BATCH)
+                    if not rows:
+                        break
+                    chunk = ','.join(json.dumps(self.to_dict(row), separators=(',', ':')) for row in rows)
+                    yield separator + chunk
+                    separator = ','
+                yield ']'
+
+        return Response(generate(), mimetype='application/json')
+
+    @staticmethod
+    def _where(conditions):
+        return f" WHERE {' AND '.join(conditions)}" if conditions else ''
@@ -0,0 +1,170 @@
+"""
+Asynchronous Log Shipping to Logstash
+
+Request threads only append records to a bounded in-memory ring buffer; a
+background shipper thread formats them and sends them to Logstash in
+batches of newline-framed JSON (the same framing TCPLogstashHandler uses,
+read by the `codec => json` TCP input). A slow or unreachable Logstash
+therefore never blocks a request: when the buffer fills up, records are
+dropped according to LOG_OVERFLOW_POLICY and counted on /metrics.
+"""
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+from logstash.formatter import LogstashFormatterVersion1
+from prometheus_client import Counter, Gauge
+from pythonjsonlogger import jsonlogger
+
+LOGSTASH_HOST = os.getenv('LOGSTASH_HOST', 'logstash')  # Empty value disables shipping
+LOGSTASH_PORT = int(os.getenv('LOGSTASH_PORT', '5000'))
+LOG_BUFFER_SIZE = int(os.getenv('LOG_BUFFER_SIZE', '10000'))  # Records held while Logstash is slow
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', '500'))  # Records per send
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '0.5'))  # Max seconds a record waits for a batch
+LOG_SEND_TIMEOUT = float(os.getenv('LOG_SEND_TIMEOUT', '2'))  # Connect/send timeout of the shipper socket
+LOG_MAX_BACKOFF = float(os.getenv('LOG_MAX_BACKOFF', '10'))  # Max wait between reconnect attempts
+# drop_oldest: evict the oldest buffered record, drop_newest: reject the new one,
+# sample: above LOG_SAMPLE_HIGH_WATER keep only 1 in LOG_SAMPLE_RATE records below WARNING
+LOG_OVERFLOW_POLICY = os.getenv('LOG_OVERFLOW_POLICY', 'sample')
+LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', '10'))
+LOG_SAMPLE_HIGH_WATER = float(os.getenv('LOG_SAMPLE_HIGH_WATER', '0.8'))  # Fraction of the buffer
+
+log_records_shipped = Counter('log_records_shipped', 'Log records sent to Logstash')
+log_records_dropped = Counter('log_records_dropped', 'Log records dropped before reaching Logstash', ['reason'])
+log_buffer_depth = Gauge('log_buffer_depth', 'Log records waiting to be shipped')
+
+
+class AsyncLogstashHandler(logging.Handler):
+    """Logging handler that buffers records and ships them from a background thread"""
+
+    def __init__(self, host, port, buffer_size=LOG_BUFFER_SIZE, policy=LOG_OVERFLOW_POLICY):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.policy = policy
+        self.buffer = deque(maxlen=buffer_size)
+        self.buffer_size = buffer_size
+        self.high_water = int(buffer_size * LOG_SAMPLE_HIGH_WATER)
+        self.cond = threading.Condition()
+        self.sock = None
+        self.pending = None  # Framed batch that failed to send, retried before anything else
+        self.closed = False
+        self.formatter = LogstashFormatterVersion1('logstash', None, False)
+        log_buffer_depth.set_function(lambda: len(self.buffer))
+        self.thread = threading.Thread(target=self._run, name='log-shipper', daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        # Resolve %-style arguments now, they may change once the caller returns
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        with self.cond:
+            depth = len(self.buffer)
+            if depth >= self.buffer_size:
+                if self.policy == 'drop_newest' or (self.policy == 'sample' and record.levelno < logging.WARNING):
+                    log_records_dropped.labels('buffer_full').inc()
+                    return
+                # deque(maxlen) evicts the oldest record on append
+                log_records_dropped.labels('buffer_full').inc()
+            elif (self.policy == 'sample' and depth >= self.high_water
+                  and record.levelno < logging.WARNING and random.randrange(LOG_SAMPLE_RATE) != 0):
+                log_records_dropped.labels('sampled').inc()
+                return
+            self.buffer.append(record)
+            if len(self.buffer) >= LOG_BATCH_SIZE:
+                self.cond.notify()
+
+    def _take_batch(self):
+        with self.cond:
+            if not self.buffer and not self.closed:
+                self.cond.wait(LOG_FLUSH_INTERVAL)
+            count = min(len(self.buffer), LOG_BATCH_SIZE)
+            return [self.buffer.popleft() for _ in range(count)]
+
+    def _frame(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                log_records_dropped.labels('format_error').inc()
+        return b'\n'.join(lines) + b'\n' if lines else None, len(lines)
+
+    def _send(self, payload):
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port), timeout=LOG_SEND_TIMEOUT)
+        try:
+            self.sock.sendall(payload)
+        except OSError:
+            self._close_socket()
+            raise
+
+    def _close_socket(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            if self.pending is None:
+                records = self._take_batch()
+                if not records:
+                    if self.closed:
+                        return
+                    continue
+                self.pending = self._frame(records)
+                if self.pending[0] is None:
+                    self.pending = None
+                    continue
+            payload, count = self.pending
+            try:
+                self._send(payload)
+            except OSError as e:
+                if self.closed:
+                    log_records_dropped.labels('send_failed').inc(count)
+                    return
+                # Keep the batch; new records accumulate (and overflow) in the buffer meanwhile
+                if backoff == 0.5:
+                    print(f"Log shipping to {self.host}:{self.port} failed: {e}", file=sys.stderr)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, LOG_MAX_BACKOFF)
+                continue
+            log_records_shipped.inc(count)
+            self.pending = None
+            backoff = 0.5
+
+    def close(self):
+        """Flush what is buffered (bounded by LOG_SEND_TIMEOUT) and stop the shipper"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(LOG_SEND_TIMEOUT)
+        self._close_socket()
+        super().close()
+
+
+def setup_logging():
+    """Configure the root logger: JSON to the console plus async shipping to Logstash"""
+    logger = logging.getLogger()
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+
+    # Console Handler (JSON)
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s'))
+    logger.addHandler(log_handler)
+
+    # Logstash Handler (set LOGSTASH_HOST to an empty value to disable)
+    if LOGSTASH_HOST:
+        logstash_handler = AsyncLogstashHandler(LOGSTASH_HOST, LOGSTASH_PORT)
+        logger.addHandler(logstash_handler)  # Flushed by logging.shutdown() at exit
+    return logger
@@ -0,0 +1,106 @@
+"""
+Staged Work Pipeline
+
+Splits a multi-step job into stages, each with its own bounded queue and
+pool of worker threads, so a slow step for one item does not hold up the
+other steps for the next items. submit() returns a Future that completes
+when the item leaves the last stage (or fails in any stage). A full queue
+blocks the stage in front of it, which pushes back all the way to
+submit(): the number of items in a pipeline is bounded by the sum of its
+queue sizes and workers.
+
+Each stage function takes the item and returns the item for the next
+stage. A stage timeout is the longest an item may wait in that stage's
+queue; an item that waited longer fails with StageTimeout instead of being
+processed late. Timeouts on the work itself (HTTP, database) belong to the
+stage functions.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+pipeline_stage_seconds = Histogram('pipeline_stage_seconds', 'Time spent running a pipeline stage',
+                                   ['pipeline', 'stage'])
+pipeline_queue_wait_seconds = Histogram('pipeline_queue_wait_seconds', 'Time items waited in front of a stage',
+                                        ['pipeline', 'stage'])
+pipeline_queue_depth = Gauge('pipeline_queue_depth', 'Items waiting in front of a stage', ['pipeline', 'stage'])
+pipeline_items = Counter('pipeline_items', 'Items processed by a pipeline stage', ['pipeline', 'stage', 'result'])
+
+
+class StageTimeout(Exception):
+    """An item waited longer than the stage timeout"""
+
+
+class Stage:
+    """One step of a pipeline: fn(item) -> item, run by `workers` threads"""
+
+    def __init__(self, name, fn, workers=1, queue_size=100, timeout=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.timeout = timeout  # Seconds an item may wait in the queue, None = no limit
+
+
+class Pipeline:
+    """Runs items through a list of stages"""
+
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+        self.lock = threading.Lock()
+        self.started = False
+        for stage in stages:
+            pipeline_queue_depth.labels(name, stage.name).set_function(stage.queue.qsize)
+
+    def submit(self, item):
+        """Queue an item for the first stage (blocks while that queue is full)"""
+        if not self.started:
+            self._start()
+        future = Future()
+        self.stages[0].queue.put((item, future, time.monotonic()))
+        return future
+
+    def _start(self):
+        with self.lock:
+            if self.started:
+                return
+            for index, stage in enumerate(self.stages):
+                for n in range(stage.workers):
+                    threading.Thread(target=self._work, args=(index,), name=f'{self.name}-{stage.name}-{n}',
+                                     daemon=True).start()
+            self.started = True
+
+    def _work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item, future, queued_at = stage.queue.get()
+            waited = time.monotonic() - queued_at
+            pipeline_queue_wait_seconds.labels(self.name, stage.name).observe(waited)
+            if stage.timeout is not None and waited > stage.timeout:
+                pipeline_items.labels(self.name, stage.name, 'timeout').inc()
+                future.set_exception(StageTimeout(f"{stage.name}: waited {waited:.1f}s in queue"))
+                continue
+
+            start = time.perf_counter()
+            try:
+                item = stage.fn(item)
+            except Exception as e:
+                pipeline_items.labels(self.name, stage.name, 'failed').inc()
+                future.set_exception(e)
+                continue
+            finally:
+                pipeline_stage_seconds.labels(self.name, stage.name).observe(time.perf_counter() - start)
+            pipeline_items.labels(self.name, stage.name, 'ok').inc()
+
+            if next_stage is None:
+                future.set_result(item)
+            else:
+                next_stage.queue.put((item, future, time.monotonic()))
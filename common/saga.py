@@ -0,0 +1,67 @@
+"""
+Saga Coordinator
+
+A multi-service operation (e.g. create_order: reserve stock, write the
+order, take payment) cannot run in one transaction. A Saga records, for
+each step that left something behind in another service, the compensation
+that undoes it. If a later step fails, the compensations run newest first
+and the failure is re-raised:
+
+    with Saga('create_order') as saga:
+        hold = reserve(...)
+        saga.on_failure('release_reservation', release, hold_id)
+        order_id = insert_order(...)
+        saga.on_failure('cancel_order', cancel, order_id)
+        take_payment(...)
+        saga.pivot()  # Paid: from here on nothing is undone
+
+After pivot() the saga only goes forward; steps that fail past it are left
+for a retrying sweeper. A compensation that fails is logged and counted,
+and the remaining ones still run: the state they left behind is what the
+sweepers (and reservation expiry) exist to clean up.
+"""
+import logging
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+saga_compensations = Counter('saga_compensations', 'Compensations run by failed sagas', ['saga', 'step', 'result'])
+
+
+class Saga:
+    """Compensations of one multi-service operation, run in reverse if it fails"""
+
+    def __init__(self, name, correlation_id=None):
+        self.name = name
+        self.correlation_id = correlation_id
+        self.compensations = []  # (step name, fn, args), oldest first
+
+    def on_failure(self, step, fn, *args):
+        """Run fn(*args) if the saga fails from here on"""
+        self.compensations.append((step, fn, args))
+
+    def pivot(self):
+        """Past the point of no return: nothing done so far is compensated any more"""
+        self.compensations = []
+
+    def compensate(self):
+        """Run the compensations newest first (each at most once)"""
+        while self.compensations:
+            step, fn, args = self.compensations.pop()
+            try:
+                fn(*args)
+                saga_compensations.labels(self.name, step, 'ok').inc()
+                logger.info(f"{self.name}: compensated {step}", extra={'correlation_id': self.correlation_id})
+            except Exception as e:
+                saga_compensations.labels(self.name, step, 'failed').inc()
+                logger.error(f"{self.name}: compensation {step} failed: {str(e)}",
+                             extra={'correlation_id': self.correlation_id})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.compensate()
+        return False
@@ -10,29 +10,20 @@ import datetime
 from functools import wraps
 import hashlib
 
-import logging
-from pythonjsonlogger import jsonlogger
 from flask import g
 from prometheus_flask_exporter import PrometheusMetrics
 
-import logstash
+from common.log_shipping import setup_logging
+from common.access_log import init_access_log
+from common.db import Database, init_query_plans
+from common.listing import Listing
 
-# Configure Structured Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Console Handler (JSON)
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s')
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Logstash Handler
-logstash_handler = logstash.TCPLogstashHandler('logstash', 5000, version=1)
-logger.addHandler(logstash_handler)
+# Configure Structured Logging (JSON console + asynchronous Logstash shipping)
+logger = setup_logging()
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app, path=None)
+init_access_log(app, 'customer-service')
 
 from prometheus_client import generate_latest
 
@@ -46,35 +37,42 @@ def before_request():
     g.correlation_id = request.headers.get('X-Correlation-ID')
     if not g.correlation_id:
         g.correlation_id = "unknown"
-        
-    logger.info(f"Request received: {request.method} {request.path}", extra={
-        'service': 'customer-service',
-        'correlation_id': g.correlation_id,
-        'method': request.method,
-        'path': request.path
-    })
 
 CORS(app)
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 
+# Database: pooled WAL connections (see common/db.py)
+db = Database('customers.db')
+
+# Schema migrations: (version, statements), each applied once per database file
+MIGRATIONS = [
+    (1, ['''CREATE TABLE IF NOT EXISTS customers
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   name TEXT NOT NULL,
+                   email TEXT UNIQUE NOT NULL,
+                   password TEXT NOT NULL,
+                   phone TEXT,
+                   address TEXT,
+                   role TEXT DEFAULT 'customer',
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''']),
+    # Indexes for the customer list's ?role= filter and ?sort=created_at
+    (2, ['CREATE INDEX IF NOT EXISTS idx_customers_role ON customers (role)',
+         'CREATE INDEX IF NOT EXISTS idx_customers_created ON customers (created_at)']),
+]
+
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('customers.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS customers
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  password TEXT NOT NULL,
-                  phone TEXT,
-                  address TEXT,
-                  role TEXT DEFAULT 'customer',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    db.migrate(MIGRATIONS)
 
 init_db()
 
+# Hot queries whose plans are served at /diagnostics/query-plans
+HOT_QUERIES = {
+    'login': ('SELECT * FROM customers WHERE email = ? AND password = ?', ('user@example.com', '')),
+    'get_customer': ('SELECT id, name, email, phone, address, role, created_at FROM customers WHERE id = ?', (1,))
+}
+init_query_plans(app, db, HOT_QUERIES)
+
 # JWT Token verification decorator
 def token_required(f):
     @wraps(f)
@@ -95,20 +93,17 @@ def token_required(f):
 @app.route('/auth/register', methods=['POST'])
 def register():
     data = request.json
-    conn = sqlite3.connect('customers.db')
-    c = conn.cursor()
     
     # Hash password
     hashed_password = hashlib.sha256(data['password'].encode()).hexdigest()
     
     try:
-        c.execute('''INSERT INTO customers (name, email, password, phone, address, role)
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (data['name'], data['email'], hashed_password, 
-                   data.get('phone'), data.get('address'), data.get('role', 'customer')))
-        conn.commit()
+        with db.transaction() as conn:
+            c = conn.execute('''INSERT INTO customers (name, email, password, phone, address, role)
+                                VALUES (?, ?, ?, ?, ?, ?)''',
+                             (data['name'], data['email'], hashed_password, 
+                              data.get('phone'), data.get('address'), data.get('role', 'customer')))
         customer_id = c.lastrowid
-        conn.close()
         return jsonify({'message': 'Customer registered successfully', 'id': customer_id}), 201
     except sqlite3.IntegrityError:
         return jsonify({'message': 'Email already exists'}), 400
@@ -116,14 +111,11 @@ def register():
 @app.route('/auth/login', methods=['POST'])
 def login():
     data = request.json
-    conn = sqlite3.connect('customers.db')
-    c = conn.cursor()
     
     hashed_password = hashlib.sha256(data['password'].encode()).hexdigest()
-    c.execute('SELECT * FROM customers WHERE email = ? AND password = ?', 
-              (data['email'], hashed_password))
-    customer = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        customer = conn.execute('SELECT * FROM customers WHERE email = ? AND password = ?', 
+                                (data['email'], hashed_password)).fetchone()
     
     if customer:
         token = jwt.encode({
@@ -144,30 +136,25 @@ def login():
         }), 200
     return jsonify({'message': 'Invalid credentials'}), 401
 
+# Customer list (never includes the password hash)
+customer_listing = Listing(db, 'customers', ['id', 'name', 'email', 'phone', 'address', 'role', 'created_at'],
+                           lambda c: {
+                               'id': c[0], 'name': c[1], 'email': c[2], 
+                               'phone': c[3], 'address': c[4], 'role': c[5], 'created_at': c[6]
+                           }, filters=['role', 'email'], sorts=['created_at'])
+
 # Customer CRUD operations
 @app.route('/api/customers', methods=['GET'])
 def get_customers():
     # Authorization is handled by Gateway (only admin can reach here)
-    conn = sqlite3.connect('customers.db')
-    c = conn.cursor()
-    c.execute('SELECT id, name, email, phone, address, role, created_at FROM customers')
-    customers = c.fetchall()
-    conn.close()
-    
-    return jsonify([{
-        'id': c[0], 'name': c[1], 'email': c[2], 
-        'phone': c[3], 'address': c[4], 'role': c[5], 'created_at': c[6]
-    } for c in customers]), 200
+    return customer_listing.respond(request.path, request.args)
 
 @app.route('/api/customers/<int:customer_id>', methods=['GET'])
 def get_customer(customer_id):
     # Authorization is handled by Gateway
-    conn = sqlite3.connect('customers.db')
-    c = conn.cursor()
-    c.execute('SELECT id, name, email, phone, address, role, created_at FROM customers WHERE id = ?', 
-              (customer_id,))
-    customer = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        customer = conn.execute('SELECT id, name, email, phone, address, role, created_at FROM customers WHERE id = ?', 
+                                (customer_id,)).fetchone()
     
     if customer:
         return jsonify({
@@ -181,23 +168,17 @@ def get_customer(customer_id):
 def update_customer(customer_id):
     # Authorization is handled by Gateway
     data = request.json
-    conn = sqlite3.connect('customers.db')
-    c = conn.cursor()
-    c.execute('''UPDATE customers SET name = ?, phone = ?, address = ?
-                 WHERE id = ?''',
-              (data['name'], data.get('phone'), data.get('address'), customer_id))
-    conn.commit()
-    conn.close()
+    with db.transaction() as conn:
+        conn.execute('''UPDATE customers SET name = ?, phone = ?, address = ?
+                        WHERE id = ?''',
+                     (data['name'], data.get('phone'), data.get('address'), customer_id))
     return jsonify({'message': 'Customer updated successfully'}), 200
 
 @app.route('/api/customers/<int:customer_id>', methods=['DELETE'])
 def delete_customer(customer_id):
     # Authorization is handled by Gateway (only admin can reach here)
-    conn = sqlite3.connect('customers.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM customers WHERE id = ?', (customer_id,))
-    conn.commit()
-    conn.close()
+    with db.transaction() as conn:
+        conn.execute('DELETE FROM customers WHERE id = ?', (customer_id,))
     return jsonify({'message': 'Customer deleted successfully'}), 200
 
 @app.route('/health', methods=['GET'])
@@ -5,32 +5,29 @@ Port: 5002
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import sqlite3
+import os
+import re
+import threading
+import time
 import jwt
+from contextlib import contextmanager
 from functools import wraps
 
-import logging
-from pythonjsonlogger import jsonlogger
 from flask import g
 from prometheus_flask_exporter import PrometheusMetrics
 
-import logstash
+from common.log_shipping import setup_logging
+from common.access_log import init_access_log
+from common.db import Database, init_query_plans
+from common.listing import Listing
+from stock_index import HOLD_COLUMNS, JournalTimeout, StockIndex, StockJournal, hold_from_row
 
-# Configure Structured Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Console Handler (JSON)
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s')
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Logstash Handler
-logstash_handler = logstash.TCPLogstashHandler('logstash', 5000, version=1)
-logger.addHandler(logstash_handler)
+# Configure Structured Logging (JSON console + asynchronous Logstash shipping)
+logger = setup_logging()
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app, path=None)
+init_access_log(app, 'inventory-service')
 
 from prometheus_client import generate_latest
 
@@ -44,47 +41,107 @@ def before_request():
     g.correlation_id = request.headers.get('X-Correlation-ID')
     if not g.correlation_id:
         g.correlation_id = "unknown"
-        
-    logger.info(f"Request received: {request.method} {request.path}", extra={
-        'service': 'inventory-service',
-        'correlation_id': g.correlation_id,
-        'method': request.method,
-        'path': request.path
-    })
 
 CORS(app)
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 
+# Database: pooled WAL connections (see common/db.py)
+db = Database('inventory.db')
+
+# Schema migrations: (version, statements), each applied once per database file
+MIGRATIONS = [
+    (1, ['''CREATE TABLE IF NOT EXISTS products
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   name TEXT NOT NULL,
+                   description TEXT,
+                   price REAL NOT NULL,
+                   quantity INTEGER NOT NULL,
+                   sku TEXT UNIQUE,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''']),
+    # Index for ?sort=price on the product list
+    (2, ['CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)']),
+    # Stock journal segments already applied to products (see stock_index.py)
+    (3, ['CREATE TABLE IF NOT EXISTS stock_journal_segments (name TEXT PRIMARY KEY)']),
+    # Reservation holds: stock taken for an order until confirmed, released or expired
+    (4, ['''CREATE TABLE IF NOT EXISTS reservations
+                  (id TEXT PRIMARY KEY,
+                   product_id INTEGER NOT NULL,
+                   quantity INTEGER NOT NULL,
+                   unit_price REAL NOT NULL,
+                   status TEXT NOT NULL,
+                   expires_at REAL NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+         'CREATE INDEX IF NOT EXISTS idx_reservations_status_expires ON reservations (status, expires_at)']),
+]
+
 def init_db():
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS products
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  description TEXT,
-                  price REAL NOT NULL,
-                  quantity INTEGER NOT NULL,
-                  sku TEXT UNIQUE,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Insert sample products
-    c.execute('SELECT COUNT(*) FROM products')
-    if c.fetchone()[0] == 0:
-        sample_products = [
-            ('Laptop', 'High-performance laptop', 1200.00, 50, 'LAP001'),
-            ('Mouse', 'Wireless mouse', 25.00, 200, 'MOU001'),
-            ('Keyboard', 'Mechanical keyboard', 80.00, 150, 'KEY001'),
-            ('Monitor', '27-inch 4K monitor', 350.00, 75, 'MON001'),
-            ('Headphones', 'Noise-cancelling headphones', 150.00, 100, 'HEA001')
-        ]
-        c.executemany('INSERT INTO products (name, description, price, quantity, sku) VALUES (?, ?, ?, ?, ?)', 
-                      sample_products)
-    
-    conn.commit()
-    conn.close()
+    db.migrate(MIGRATIONS)
+    with db.transaction() as conn:
+        # Insert sample products
+        if conn.execute('SELECT COUNT(*) FROM products').fetchone()[0] == 0:
+            sample_products = [
+                ('Laptop', 'High-performance laptop', 1200.00, 50, 'LAP001'),
+                ('Mouse', 'Wireless mouse', 25.00, 200, 'MOU001'),
+                ('Keyboard', 'Mechanical keyboard', 80.00, 150, 'KEY001'),
+                ('Monitor', '27-inch 4K monitor', 350.00, 75, 'MON001'),
+                ('Headphones', 'Noise-cancelling headphones', 150.00, 100, 'HEA001')
+            ]
+            conn.executemany('INSERT INTO products (name, description, price, quantity, sku) VALUES (?, ?, ?, ?, ?)', 
+                             sample_products)
 
 init_db()
 
+# Hot queries whose plans are served at /diagnostics/query-plans
+HOT_QUERIES = {
+    'get_product': ('SELECT * FROM products WHERE id = ?', (1,)),
+    'check_availability': ('SELECT quantity FROM products WHERE id = ?', (1,)),
+    'expired_holds': ("SELECT id FROM reservations WHERE status = 'held' AND expires_at <= ?", (0,))
+}
+init_query_plans(app, db, HOT_QUERIES)
+
+# In-memory stock index: availability and reservations are served from memory
+# and journaled to SQLite with group commit (see stock_index.py)
+STOCK_INDEX_ENABLED = os.getenv('STOCK_INDEX_ENABLED', 'true').lower() == 'true'
+STOCK_JOURNAL_DIR = os.getenv('STOCK_JOURNAL_DIR', os.path.dirname(db.path))  # Next to the database by default
+STOCK_GROUP_COMMIT_MS = int(os.getenv('STOCK_GROUP_COMMIT_MS', '2'))  # Reservations gathered per journal fsync
+STOCK_CHECKPOINT_MS = int(os.getenv('STOCK_CHECKPOINT_MS', '500'))  # How often the journal is applied to SQLite
+STOCK_JOURNAL_FSYNC = os.getenv('STOCK_JOURNAL_FSYNC', 'true').lower() == 'true'
+STOCK_JOURNAL_TIMEOUT_MS = int(os.getenv('STOCK_JOURNAL_TIMEOUT_MS', '5000'))  # Longest wait for a change to be on disk
+STOCK_HOLD_RETAIN_SECONDS = int(os.getenv('STOCK_HOLD_RETAIN_SECONDS', '3600'))  # Ended holds remembered for retries
+
+# One process owns the index of a database (load() refuses a second one). Under app.run(debug=True)
+# this module also runs in the reloader's parent, which only restarts the serving child: skip it there
+reloader_parent = __name__ == '__main__' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+
+stock_index = None
+if STOCK_INDEX_ENABLED and not reloader_parent:
+    stock_index = StockIndex(db, StockJournal(db, STOCK_JOURNAL_DIR, group_commit_ms=STOCK_GROUP_COMMIT_MS,
+                                              checkpoint_ms=STOCK_CHECKPOINT_MS, fsync=STOCK_JOURNAL_FSYNC,
+                                              timeout_ms=STOCK_JOURNAL_TIMEOUT_MS),
+                             retain_seconds=STOCK_HOLD_RETAIN_SECONDS)
+    stock_index.load()
+
+@app.errorhandler(JournalTimeout)
+def journal_timeout(e):
+    logger.error(f"Stock journal: {str(e)}")
+    return jsonify({'success': False, 'message': 'Stock service temporarily unavailable'}), 503
+
+def current_quantity(product_id, stored):
+    # SQLite lags the index by up to one checkpoint
+    if stock_index is None:
+        return stored
+    quantity = stock_index.quantity(product_id)
+    return stored if quantity is None else quantity
+
+@contextmanager
+def stock_write():
+    # Admin writes to products, one at a time (reservations carry on)
+    if stock_index is None:
+        yield None
+        return
+    with stock_index.write_through() as index:
+        yield index
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -100,32 +157,29 @@ def token_required(f):
         return f(*args, **kwargs)
     return decorated
 
+# Product list: sortable by price, filterable by sku
+product_listing = Listing(db, 'products', ['id', 'name', 'description', 'price', 'quantity', 'sku', 'created_at'],
+                          lambda p: {
+                              'id': p[0], 'name': p[1], 'description': p[2],
+                              'price': p[3], 'quantity': current_quantity(p[0], p[4]), 'sku': p[5],
+                              'created_at': p[6]
+                          }, filters=['sku'], sorts=['price'])
+
 # Product CRUD operations
 @app.route('/api/products', methods=['GET'])
 def get_products():
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM products')
-    products = c.fetchall()
-    conn.close()
-    
-    return jsonify([{
-        'id': p[0], 'name': p[1], 'description': p[2],
-        'price': p[3], 'quantity': p[4], 'sku': p[5], 'created_at': p[6]
-    } for p in products]), 200
+    # ?limit=&after= for keyset pages, the full list is streamed (see common/listing.py)
+    return product_listing.respond(request.path, request.args)
 
 @app.route('/api/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM products WHERE id = ?', (product_id,))
-    product = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
     
     if product:
         return jsonify({
             'id': product[0], 'name': product[1], 'description': product[2],
-            'price': product[3], 'quantity': product[4], 'sku': product[5], 
+            'price': product[3], 'quantity': current_quantity(product[0], product[4]), 'sku': product[5],
             'created_at': product[6]
         }), 200
     return jsonify({'message': 'Product not found'}), 404
@@ -134,17 +188,16 @@ def get_product(product_id):
 def create_product():
     # Authorization is handled by Gateway (only admin/staff can reach here)
     data = request.json
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    
     try:
-        c.execute('''INSERT INTO products (name, description, price, quantity, sku)
-                     VALUES (?, ?, ?, ?, ?)''',
-                  (data['name'], data.get('description'), data['price'], 
-                   data['quantity'], data.get('sku')))
-        conn.commit()
-        product_id = c.lastrowid
-        conn.close()
+        with stock_write() as index:
+            with db.transaction() as conn:
+                c = conn.execute('''INSERT INTO products (name, description, price, quantity, sku)
+                                    VALUES (?, ?, ?, ?, ?)''',
+                                 (data['name'], data.get('description'), data['price'], 
+                                  data['quantity'], data.get('sku')))
+            product_id = c.lastrowid
+            if index:
+                index.add(product_id, data['quantity'], data['price'])
         return jsonify({'message': 'Product created successfully', 'id': product_id}), 201
     except sqlite3.IntegrityError:
         return jsonify({'message': 'SKU already exists'}), 400
@@ -153,24 +206,29 @@ def create_product():
 def update_product(product_id):
     # Authorization is handled by Gateway (only admin/staff can reach here)
     data = request.json
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('''UPDATE products SET name = ?, description = ?, price = ?, quantity = ?
-                 WHERE id = ?''',
-              (data['name'], data.get('description'), data['price'], 
-               data['quantity'], product_id))
-    conn.commit()
-    conn.close()
+    with stock_write() as index:
+        with db.transaction() as conn:
+            if index:
+                # The stock goes through the journal, behind the reservations already in it
+                c = conn.execute('UPDATE products SET name = ?, description = ?, price = ? WHERE id = ?',
+                                 (data['name'], data.get('description'), data['price'], product_id))
+            else:
+                c = conn.execute('''UPDATE products SET name = ?, description = ?, price = ?, quantity = ?
+                                    WHERE id = ?''',
+                                 (data['name'], data.get('description'), data['price'], 
+                                  data['quantity'], product_id))
+        if index and c.rowcount:
+            index.update(product_id, data['quantity'], data['price'])
     return jsonify({'message': 'Product updated successfully'}), 200
 
 @app.route('/api/products/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
     # Authorization is handled by Gateway (only admin can reach here)
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM products WHERE id = ?', (product_id,))
-    conn.commit()
-    conn.close()
+    with stock_write() as index:
+        with db.transaction() as conn:
+            conn.execute('DELETE FROM products WHERE id = ?', (product_id,))
+        if index:
+            index.remove(product_id)
     return jsonify({'message': 'Product deleted successfully'}), 200
 
 # Check product availability (internal API for Order Service)
@@ -180,15 +238,33 @@ def check_availability():
     product_id = data.get('product_id')
     quantity = data.get('quantity')
     
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('SELECT quantity FROM products WHERE id = ?', (product_id,))
-    result = c.fetchone()
-    conn.close()
+    if stock_index is not None:
+        current = stock_index.quantity(product_id)
+    else:
+        with db.connection() as conn:
+            result = conn.execute('SELECT quantity FROM products WHERE id = ?', (product_id,)).fetchone()
+        current = result[0] if result else None
     
-    if result and result[0] >= quantity:
-        return jsonify({'available': True, 'current_quantity': result[0]}), 200
-    return jsonify({'available': False, 'current_quantity': result[0] if result else 0}), 200
+    if current is not None and current >= quantity:
+        return jsonify({'available': True, 'current_quantity': current}), 200
+    return jsonify({'available': False, 'current_quantity': current or 0}), 200
+
+# Stock Reservations
+# With the stock index, a check-and-decrement under its lock; otherwise one
+# conditional UPDATE per line. Either way the stock check and the decrement
+# are one atomic step, so concurrent reservations cannot oversell.
+RESERVE_BATCH_MAX_ITEMS = int(os.getenv('RESERVE_BATCH_MAX_ITEMS', '100'))  # Lines per reserve-batch request
+RESERVE_SQL = 'UPDATE products SET quantity = quantity - ? WHERE id = ? AND quantity >= ? RETURNING quantity'
+RESERVE_PRICED_SQL = RESERVE_SQL + ', price'
+
+class InsufficientStock(Exception):
+    """A reservation line could not be met; the batch is rolled back"""
+    def __init__(self, product_ids):
+        super().__init__(f"Insufficient stock for products {product_ids}")
+        self.product_ids = product_ids
+
+def valid_quantity(quantity):
+    return isinstance(quantity, int) and not isinstance(quantity, bool) and quantity > 0
 
 # Reserve product quantity (reduce stock)
 @app.route('/api/products/reserve', methods=['POST'])
@@ -196,22 +272,230 @@ def reserve_product():
     data = request.json
     product_id = data.get('product_id')
     quantity = data.get('quantity')
+    if not valid_quantity(quantity):
+        return jsonify({'success': False, 'message': 'quantity must be a positive integer'}), 400
     
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('SELECT quantity FROM products WHERE id = ?', (product_id,))
-    result = c.fetchone()
+    if stock_index is not None:
+        new_quantity = stock_index.reserve(product_id, quantity)
+    else:
+        with db.connection() as conn:
+            result = conn.execute(RESERVE_SQL, (quantity, product_id, quantity)).fetchone()
+        new_quantity = result[0] if result else None
     
-    if result and result[0] >= quantity:
-        new_quantity = result[0] - quantity
-        c.execute('UPDATE products SET quantity = ? WHERE id = ?', (new_quantity, product_id))
-        conn.commit()
-        conn.close()
+    if new_quantity is not None:
         return jsonify({'success': True, 'message': 'Product reserved', 'new_quantity': new_quantity}), 200
-    
-    conn.close()
     return jsonify({'success': False, 'message': 'Insufficient stock'}), 400
 
+# Reserve several products at once, all or nothing (multi-line carts)
+@app.route('/api/products/reserve-batch', methods=['POST'])
+def reserve_products_batch():
+    items = (request.get_json(silent=True) or {}).get('items')
+    if not isinstance(items, list) or not items or len(items) > RESERVE_BATCH_MAX_ITEMS:
+        return jsonify({'success': False,
+                        'message': f'items must be a list of 1 to {RESERVE_BATCH_MAX_ITEMS} lines'}), 400
+    
+    # Lines for the same product are merged so the stock check covers their total
+    quantities = {}
+    for item in items:
+        quantity = item.get('quantity') if isinstance(item, dict) else None
+        if not valid_quantity(quantity):
+            return jsonify({'success': False, 'message': 'quantity must be a positive integer'}), 400
+        quantities[item.get('product_id')] = quantities.get(item.get('product_id'), 0) + quantity
+    
+    try:
+        if stock_index is not None:
+            new_quantities, failed = stock_index.reserve_many(quantities)
+            if failed:
+                raise InsufficientStock(failed)
+        else:
+            new_quantities = reserve_in_sqlite(quantities)
+    except InsufficientStock as e:
+        return jsonify({'success': False, 'message': 'Insufficient stock', 'failed_products': e.product_ids}), 400
+    
+    return jsonify({'success': True, 'message': 'Products reserved', 'items': [
+        {'product_id': product_id, 'quantity': quantity, 'new_quantity': new_quantities[product_id]}
+        for product_id, quantity in quantities.items()
+    ]}), 200
+
+def reserve_in_sqlite(quantities):
+    """Reserve {product_id: quantity} in one transaction; raises InsufficientStock (rolled back)"""
+    new_quantities = {}
+    with db.transaction() as conn:
+        failed = []
+        for product_id, quantity in quantities.items():
+            result = conn.execute(RESERVE_SQL, (quantity, product_id, quantity)).fetchone()
+            if result:
+                new_quantities[product_id] = result[0]
+            else:
+                failed.append(product_id)
+        if failed:
+            raise InsufficientStock(failed)
+    return new_quantities
+
+# Check, reserve and price in one call (internal API for Order Service)
+@app.route('/api/products/reserve-priced', methods=['POST'])
+def reserve_product_priced():
+    # Replaces check-availability + GET product + reserve: the stock check, the
+    # decrement and the price read are one atomic step
+    data = request.get_json(silent=True) or {}
+    product_id = data.get('product_id')
+    quantity = data.get('quantity')
+    if not valid_quantity(quantity):
+        return jsonify({'success': False, 'message': 'quantity must be a positive integer'}), 400
+    if data.get('reservation_id') is not None:
+        return reserve_hold(data, product_id, quantity)
+    
+    if stock_index is not None:
+        result = stock_index.reserve_priced(product_id, quantity)
+        current = stock_index.quantity(product_id) if result is None else None
+    else:
+        with db.connection() as conn:
+            result = conn.execute(RESERVE_PRICED_SQL, (quantity, product_id, quantity)).fetchone()
+            if result is None:
+                row = conn.execute('SELECT quantity FROM products WHERE id = ?', (product_id,)).fetchone()
+                current = row[0] if row else None
+    
+    if result is not None:
+        new_quantity, unit_price = result
+        return jsonify({'success': True, 'message': 'Product reserved', 'product_id': product_id,
+                        'quantity': quantity, 'unit_price': unit_price, 'new_quantity': new_quantity}), 200
+    if current is None:
+        return jsonify({'success': False, 'message': 'Product not found'}), 404
+    return jsonify({'success': False, 'message': 'Insufficient stock', 'current_quantity': current}), 400
+
+# Reservation Holds
+# With a reservation_id, reserve-priced takes the stock under a hold that
+# lapses after hold_seconds unless confirmed. The id makes retries safe: a
+# known id answers with its existing hold. Confirm makes the hold permanent,
+# release gives the stock back; a sweeper expires holds nobody confirmed,
+# so stock taken by orders that never completed becomes sellable again.
+RESERVATION_HOLD_SECONDS = int(os.getenv('RESERVATION_HOLD_SECONDS', '900'))  # Default hold before expiry
+RESERVATION_MAX_HOLD_SECONDS = int(os.getenv('RESERVATION_MAX_HOLD_SECONDS', '86400'))
+RESERVATION_SWEEP_SECONDS = float(os.getenv('RESERVATION_SWEEP_SECONDS', '5'))  # How often expired holds are released
+RESERVATION_ID = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+RELEASE_SQL = 'UPDATE products SET quantity = quantity + ? WHERE id = ?'
+
+def reserve_hold(data, product_id, quantity):
+    reservation_id = data.get('reservation_id')
+    hold_seconds = data.get('hold_seconds', RESERVATION_HOLD_SECONDS)
+    if not isinstance(reservation_id, str) or not RESERVATION_ID.match(reservation_id):
+        return jsonify({'success': False, 'message': 'reservation_id must be 1 to 64 letters, digits or ._:-'}), 400
+    if not valid_quantity(hold_seconds) or hold_seconds > RESERVATION_MAX_HOLD_SECONDS:
+        return jsonify({'success': False,
+                        'message': f'hold_seconds must be between 1 and {RESERVATION_MAX_HOLD_SECONDS}'}), 400
+    
+    expires_at = time.time() + hold_seconds
+    if stock_index is not None:
+        result = stock_index.hold(reservation_id, product_id, quantity, expires_at)
+        current = stock_index.quantity(product_id) if result is None else None
+    else:
+        result, current = hold_in_sqlite(reservation_id, product_id, quantity, expires_at)
+    
+    if result is not None:
+        hold, new_quantity = result
+        if hold['status'] not in ('held', 'confirmed'):
+            return jsonify({'success': False, 'message': f"Reservation already {hold['status']}",
+                            'reservation': hold}), 409
+        return jsonify({'success': True, 'message': 'Product reserved', 'product_id': product_id,
+                        'quantity': hold['quantity'], 'unit_price': hold['unit_price'],
+                        'new_quantity': new_quantity, 'reservation': hold}), 200
+    if current is None:
+        return jsonify({'success': False, 'message': 'Product not found'}), 404
+    return jsonify({'success': False, 'message': 'Insufficient stock', 'current_quantity': current}), 400
+
+def hold_in_sqlite(reservation_id, product_id, quantity, expires_at):
+    """((hold, new stock) or None, current stock when there was not enough)"""
+    with db.transaction() as conn:
+        row = conn.execute(f'SELECT {HOLD_COLUMNS} FROM reservations WHERE id = ?', (reservation_id,)).fetchone()
+        if row:
+            hold = hold_from_row(row)
+            current = conn.execute('SELECT quantity FROM products WHERE id = ?', (hold['product_id'],)).fetchone()
+            return (hold, current[0] if current else None), None
+        result = conn.execute(RESERVE_PRICED_SQL, (quantity, product_id, quantity)).fetchone()
+        if result is None:
+            current = conn.execute('SELECT quantity FROM products WHERE id = ?', (product_id,)).fetchone()
+            return None, current[0] if current else None
+        hold = {'reservation_id': reservation_id, 'product_id': product_id, 'quantity': quantity,
+                'unit_price': result[1], 'status': 'held', 'expires_at': expires_at}
+        conn.execute('''INSERT INTO reservations (id, product_id, quantity, unit_price, status, expires_at)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (reservation_id, product_id, quantity, result[1], 'held', expires_at))
+    return (hold, result[0]), None
+
+def finish_hold(reservation_id, status):
+    """End a held hold as confirmed, released or expired; the hold (status shows how it ended) or None"""
+    if stock_index is not None:
+        return stock_index.finish_hold(reservation_id, status)
+    with db.transaction() as conn:
+        row = conn.execute(f'SELECT {HOLD_COLUMNS} FROM reservations WHERE id = ?', (reservation_id,)).fetchone()
+        if row is None:
+            return None
+        hold = hold_from_row(row)
+        if hold['status'] != 'held':
+            return hold
+        if status == 'confirmed' and hold['expires_at'] <= time.time():
+            status = 'expired'
+        if status != 'confirmed':
+            conn.execute(RELEASE_SQL, (hold['quantity'], hold['product_id']))
+        conn.execute('UPDATE reservations SET status = ? WHERE id = ?', (status, reservation_id))
+    hold['status'] = status
+    return hold
+
+def expire_holds():
+    now = time.time()
+    if stock_index is not None:
+        return stock_index.expire_holds(now)
+    with db.connection() as conn:
+        expired = [row[0] for row in conn.execute(
+            "SELECT id FROM reservations WHERE status = 'held' AND expires_at <= ?", (now,))]
+    for reservation_id in expired:
+        finish_hold(reservation_id, 'expired')
+    return len(expired)
+
+def sweep_holds():
+    while True:
+        time.sleep(RESERVATION_SWEEP_SECONDS)
+        try:
+            expired = expire_holds()
+            if expired:
+                logger.info(f"Released {expired} expired reservation holds")
+        except Exception:
+            logger.exception("Reservation hold sweep failed")
+
+hold_sweeper_lock = threading.Lock()
+hold_sweeper_started = False
+
+@app.before_request
+def start_hold_sweeper():
+    # Started by the first request, so only the serving process sweeps (not the reloader parent)
+    global hold_sweeper_started
+    if hold_sweeper_started:
+        return
+    with hold_sweeper_lock:
+        if not hold_sweeper_started:
+            threading.Thread(target=sweep_holds, name='hold-sweeper', daemon=True).start()
+            hold_sweeper_started = True
+
+@app.route('/api/reservations/<reservation_id>/confirm', methods=['POST'])
+def confirm_reservation(reservation_id):
+    hold = finish_hold(reservation_id, 'confirmed')
+    if hold is None:
+        return jsonify({'success': False, 'message': 'Reservation not found'}), 404
+    if hold['status'] != 'confirmed':
+        return jsonify({'success': False, 'message': f"Reservation already {hold['status']}",
+                        'reservation': hold}), 409
+    return jsonify({'success': True, 'message': 'Reservation confirmed', 'reservation': hold}), 200
+
+@app.route('/api/reservations/<reservation_id>/release', methods=['POST'])
+def release_reservation(reservation_id):
+    hold = finish_hold(reservation_id, 'released')
+    if hold is None:
+        return jsonify({'success': False, 'message': 'Reservation not found'}), 404
+    if hold['status'] == 'confirmed':
+        return jsonify({'success': False, 'message': 'Reservation already confirmed', 'reservation': hold}), 409
+    # Released or expired: the stock is back either way
+    return jsonify({'success': True, 'message': 'Reservation released', 'reservation': hold}), 200
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'healthy', 'service': 'inventory-service'}), 200
@@ -0,0 +1,512 @@
+"""
+In-Memory Stock Index
+
+check-availability and reserve used to query SQLite on every call, and
+order-service calls both for every order. The StockIndex keeps the stock
+and unit price of every product in two compact arrays indexed by product
+id (8 bytes each per id, stock -1 for ids with no product), so an
+availability check is one array read and a reservation is a
+compare-and-decrement under a lock: two concurrent reservations can never
+both take the last units. The price is read under the same lock, so a
+reservation and the price it was made at always belong together.
+
+Reservations reach SQLite through a write-ahead journal instead of an
+UPDATE each:
+- Group commit: a writer thread appends the stock changes made during the
+  last STOCK_GROUP_COMMIT_MS to the current journal segment with one write
+  and one fsync. A reservation is acknowledged only once its change is on
+  disk, so a crash never forgets stock that was handed out. A request
+  whose change is not on disk within STOCK_JOURNAL_TIMEOUT_MS fails with
+  JournalTimeout (503) instead of waiting on a stuck writer for ever.
+- Checkpoint: every STOCK_CHECKPOINT_MS the writer closes the segment and
+  adds its net change per product to the products table in one fsynced
+  transaction, which also records the segment name; the file is then
+  deleted. Recording the name makes replay idempotent if the process dies
+  between the commit and the delete.
+
+Holds are reservations that lapse unless confirmed (order-service confirms
+once the order is paid). A hold and its stock change are one journal
+append, so they reach disk and SQLite (the reservations table) together.
+Holds live in memory, so a hold and its retries never read SQLite: held
+ones until they end, confirmed, released and expired ones until
+retain_seconds past their expiry (the window in which a reservation id
+is recognised as seen before).
+
+At startup load() replays the segments left by a previous process, then
+builds the arrays from the products table and the holds from the
+reservations table. Admin writes to products (create,
+update, delete) run inside write_through(), one at a time; reservations
+carry on meanwhile. An admin stock update reaches SQLite through the
+journal as a change like any reservation, so it can never be overtaken
+by older reservations still in the journal.
+
+The index is the source of truth for stock while the process runs, so
+there must be one process per database file: load() takes an exclusive
+lock on stock-index.lock in the journal directory and refuses to load
+(raising StockIndexLocked) while another process holds it.
+"""
+import fcntl
+import logging
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+ABSENT = -1  # Array value for ids without a product
+SEGMENT_PREFIX = 'stock-journal.'
+LOCK_NAME = 'stock-index.lock'  # Held by the one process that owns the index of a database
+HOLD = 'H'  # Journal record tag for a reservation hold: (HOLD, hold dict)
+
+stock_journal_group_size = Histogram('stock_journal_group_size', 'Stock changes written per journal fsync',
+                                     buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+stock_journal_checkpoints = Counter('stock_journal_checkpoints', 'Journal segments applied to SQLite', ['source'])
+
+
+class JournalTimeout(Exception):
+    """A stock change was not on disk within the journal timeout"""
+
+
+class StockIndexLocked(Exception):
+    """Another process already owns the stock index of this database"""
+
+
+class StockJournal:
+    """Write-ahead journal of stock changes, group-committed to disk and checkpointed into SQLite"""
+
+    def __init__(self, db, directory, group_commit_ms=2, checkpoint_ms=500, fsync=True, timeout_ms=5000):
+        self.db = db
+        self.directory = directory
+        self.group_commit = group_commit_ms / 1000
+        self.checkpoint_interval = checkpoint_ms / 1000
+        self.fsync = fsync
+        self.timeout = timeout_ms / 1000  # Longest wait_durable() waits for the writer
+        self.cond = threading.Condition()
+        self.pending = []  # (product_id, delta) appended but not yet written
+        self.appended = 0  # Sequence number of the last append()
+        self.durable = 0  # Sequence number of the last append() on disk
+        self.checkpoint_requests = 0
+        self.checkpoints_done = 0
+        self.segment = None  # Open segment file, created on the first write after a checkpoint
+        self.segment_opened = None
+        self.segment_deltas = {}  # product_id -> net change written to the open segment
+        self.segment_holds = {}  # reservation_id -> latest hold written to the open segment
+        self.segment_last = 0  # Sequence number of the last append() in the open segment
+        self.closed = []  # (segment name, deltas, holds, last sequence) written but not yet applied to SQLite
+        self.applied = 0  # Sequence number of the last append() applied to SQLite
+        self.started = False
+
+    def append(self, changes):
+        """Queue [(product_id, delta) or (HOLD, hold)] for the next group commit; returns the sequence number to wait for"""
+        with self.cond:
+            if not self.started:
+                # Started on first use, so a process that never reserves (e.g. the reloader parent) writes nothing
+                threading.Thread(target=self._run, name='stock-journal', daemon=True).start()
+                self.started = True
+            self.pending.extend(changes)
+            self.appended += 1
+            self.cond.notify_all()
+            return self.appended
+
+    def wait_durable(self, sequence):
+        """Block until the append() with this sequence number is fsynced; raises JournalTimeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.durable >= sequence, self.timeout):
+                raise JournalTimeout(f"Stock change {sequence} not on disk after {self.timeout:.1f}s")
+
+    def checkpoint(self):
+        """Write everything appended so far and apply it to SQLite before returning"""
+        with self.cond:
+            if not self.started:
+                return  # Nothing was ever appended
+            self.checkpoint_requests += 1
+            request = self.checkpoint_requests
+            self.cond.notify_all()
+            while self.checkpoints_done < request:
+                self.cond.wait()
+
+    def recover(self):
+        """Apply the segments a previous process left behind"""
+        names = sorted(name for name in os.listdir(self.directory or '.') if name.startswith(SEGMENT_PREFIX))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            deltas, holds = {}, {}
+            with open(path, 'rb') as segment:
+                for line in segment:
+                    if not line.endswith(b'\n'):
+                        break  # Torn last write: it was never fsynced, so never acknowledged
+                    fields = line.decode().split()
+                    if fields[0] == HOLD:
+                        reservation_id, product_id, quantity, unit_price, status, expires_at = fields[1:]
+                        holds[reservation_id] = {'reservation_id': reservation_id, 'product_id': int(product_id),
+                                                 'quantity': int(quantity), 'unit_price': float(unit_price),
+                                                 'status': status, 'expires_at': float(expires_at)}
+                    else:
+                        product_id, delta = int(fields[0]), int(fields[1])
+                        deltas[product_id] = deltas.get(product_id, 0) + delta
+            self._apply(name, deltas, holds)
+            stock_journal_checkpoints.labels('recovery').inc()
+            logger.info(f"Replayed stock journal segment {name} ({len(deltas)} products)")
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while (not self.pending and self.checkpoints_done == self.checkpoint_requests
+                       and not self._checkpoint_due()):
+                    self.cond.wait(self._until_checkpoint())
+            if self.group_commit:
+                # Commit window: let the reservations arriving meanwhile share this write and fsync
+                time.sleep(self.group_commit)
+
+            with self.cond:
+                changes, self.pending = self.pending, []
+                sequence = self.appended
+                request = self.checkpoint_requests
+            try:
+                if changes:
+                    self._write(changes, sequence)
+            except Exception:
+                logger.exception("Stock journal write failed, retrying")
+                with self.cond:
+                    # Keep the order: these changes go out before anything appended since
+                    self.pending = changes + self.pending
+                time.sleep(1)
+                continue
+            with self.cond:
+                self.durable = sequence
+                self.cond.notify_all()
+
+            try:
+                if request > self.checkpoints_done or self._checkpoint_due():
+                    self._checkpoint()
+            except Exception:
+                logger.exception("Stock journal checkpoint failed, retrying")
+                time.sleep(1)
+                continue
+            with self.cond:
+                self.checkpoints_done = request
+                self.cond.notify_all()
+
+    def _checkpoint_due(self):
+        return bool(self.closed) or (self.segment is not None and
+                                     time.monotonic() - self.segment_opened >= self.checkpoint_interval)
+
+    def _until_checkpoint(self):
+        if self.segment is None:
+            return None
+        return max(0, self.segment_opened + self.checkpoint_interval - time.monotonic())
+
+    def _write(self, changes, sequence):
+        if self.segment is None:
+            name = f'{SEGMENT_PREFIX}{time.time_ns():020d}.{os.getpid()}'
+            self.segment = open(os.path.join(self.directory, name), 'ab')
+            self.segment_opened = time.monotonic()
+            if self.fsync:
+                # The new file's directory entry too, or a power cut can lose the segment with its changes
+                directory = os.open(self.directory or '.', os.O_RDONLY)
+                try:
+                    os.fsync(directory)
+                finally:
+                    os.close(directory)
+        size = self.segment.tell()
+        lines = []
+        for record in changes:
+            if record[0] == HOLD:
+                hold = record[1]
+                lines.append(f"{HOLD} {hold['reservation_id']} {hold['product_id']} {hold['quantity']} "
+                             f"{hold['unit_price']!r} {hold['status']} {hold['expires_at']!r}\n")
+            else:
+                lines.append(f'{record[0]} {record[1]}\n')
+        try:
+            self.segment.write(''.join(lines).encode())
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+        except Exception:
+            # Drop a partial write, the changes are retried as a whole
+            self.segment.truncate(size)
+            raise
+        stock_journal_group_size.observe(len(changes))
+        for record in changes:
+            if record[0] == HOLD:
+                self.segment_holds[record[1]['reservation_id']] = record[1]
+            else:
+                self.segment_deltas[record[0]] = self.segment_deltas.get(record[0], 0) + record[1]
+        self.segment_last = sequence
+
+    def _checkpoint(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.closed.append((os.path.basename(self.segment.name), self.segment_deltas, self.segment_holds,
+                                self.segment_last))
+            self.segment, self.segment_deltas, self.segment_holds = None, {}, {}
+        while self.closed:
+            name, deltas, holds, last = self.closed[0]
+            self._apply(name, deltas, holds)
+            self.closed.pop(0)
+            self.applied = last
+            stock_journal_checkpoints.labels('periodic').inc()
+
+    def _apply(self, name, deltas, holds):
+        # The commit must be on disk before the segment goes: it is the only other copy of these changes
+        with self.db.transaction(durable=self.fsync) as conn:
+            if conn.execute('SELECT 1 FROM stock_journal_segments WHERE name = ?', (name,)).fetchone() is None:
+                conn.executemany('UPDATE products SET quantity = quantity + ? WHERE id = ?',
+                                 [(delta, product_id) for product_id, delta in deltas.items() if delta])
+                conn.executemany('''INSERT INTO reservations (id, product_id, quantity, unit_price, status, expires_at)
+                                    VALUES (?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT (id) DO UPDATE SET status = excluded.status''',
+                                 [(hold['reservation_id'], hold['product_id'], hold['quantity'], hold['unit_price'],
+                                   hold['status'], hold['expires_at']) for hold in holds.values()])
+                conn.execute('INSERT INTO stock_journal_segments (name) VALUES (?)', (name,))
+        os.remove(os.path.join(self.directory, name))
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM stock_journal_segments WHERE name = ?', (name,))
+
+
+HOLD_COLUMNS = 'id, product_id, quantity, unit_price, status, expires_at'
+
+
+def hold_from_row(row):
+    return {'reservation_id': row[0], 'product_id': row[1], 'quantity': row[2], 'unit_price': row[3],
+            'status': row[4], 'expires_at': row[5]}
+
+
+def stored_hold(db, reservation_id):
+    """A hold as recorded in the reservations table, or None"""
+    with db.connection() as conn:
+        row = conn.execute(f'SELECT {HOLD_COLUMNS} FROM reservations WHERE id = ?', (reservation_id,)).fetchone()
+    return hold_from_row(row) if row else None
+
+
+class StockIndex:
+    """Product stock and price by id in arrays, reserved in memory and journaled to SQLite"""
+
+    def __init__(self, db, journal, retain_seconds=3600):
+        self.db = db
+        self.journal = journal
+        self.retain = retain_seconds  # How long past its expiry an ended hold is remembered
+        self.quantities = array('q')
+        self.prices = array('d')
+        self.holds = {}  # reservation_id -> hold, while held
+        self.finished = {}  # reservation_id -> (hold, journal sequence), until retained long enough and applied
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # Admin writes to products, one at a time
+        self.lock_file = None
+
+    def load(self):
+        """Claim the database, replay leftover journal segments, then read every product's stock and hold"""
+        self._claim()
+        self.journal.recover()
+        with self.db.connection() as conn:
+            rows = conn.execute('SELECT id, quantity, price FROM products').fetchall()
+        size = max((row[0] for row in rows), default=0) + 1
+        quantities, prices = array('q', [ABSENT]) * size, array('d', [0.0]) * size
+        for product_id, quantity, price in rows:
+            quantities[product_id] = quantity
+            prices[product_id] = price
+        with self.db.connection() as conn:
+            stored = [hold_from_row(row) for row in conn.execute(
+                f"SELECT {HOLD_COLUMNS} FROM reservations WHERE status = 'held' OR expires_at > ?",
+                (time.time() - self.retain,))]
+        holds = {hold['reservation_id']: hold for hold in stored if hold['status'] == 'held'}
+        finished = {hold['reservation_id']: (hold, 0) for hold in stored if hold['status'] != 'held'}
+        with self.lock:
+            self.quantities, self.prices = quantities, prices
+            self.holds, self.finished = holds, finished
+        logger.info(f"Stock index loaded: {len(rows)} products, {len(holds)} holds, {len(finished)} ended holds")
+
+    def _claim(self):
+        if self.lock_file is not None:
+            return  # Reloading: this process owns the database already
+        lock_file = open(os.path.join(self.journal.directory, LOCK_NAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise StockIndexLocked(f"Another process owns the stock index of {self.db.path}: "
+                                   f"run one inventory-service process per database file")
+        self.lock_file = lock_file  # Kept open: the lock lasts as long as the process
+
+    def release(self):
+        """Give up the database to another process (load() claims it back)"""
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def quantity(self, product_id):
+        """Current stock, or None when there is no such product"""
+        slot = self._slot(product_id)
+        if slot is None or slot >= len(self.quantities) or self.quantities[slot] == ABSENT:
+            return None
+        return self.quantities[slot]
+
+    def reserve(self, product_id, quantity):
+        """Take quantity units; returns the new stock, or None if there is not enough"""
+        new_quantities, failed = self.reserve_many({product_id: quantity})
+        return None if failed else new_quantities[product_id]
+
+    def reserve_priced(self, product_id, quantity):
+        """Take quantity units; returns (new stock, unit price), or None if there is not enough"""
+        new_quantities, prices, failed = self._reserve({product_id: quantity})
+        return None if failed else (new_quantities[product_id], prices[product_id])
+
+    def reserve_many(self, quantities):
+        """Take {product_id: quantity} all or nothing; returns ({product_id: new stock}, [failed product_ids])"""
+        new_quantities, _, failed = self._reserve(quantities)
+        return new_quantities, failed
+
+    def _reserve(self, quantities):
+        totals = {}  # By slot: 3 and "3" are the same product
+        for product_id, quantity in quantities.items():
+            slot = self._slot(product_id)
+            totals[slot] = totals.get(slot, 0) + quantity
+        with self.lock:
+            failed = [product_id for product_id in quantities
+                      if (self.quantity(product_id) or 0) < totals[self._slot(product_id)]]
+            if failed:
+                return {}, {}, failed
+            for slot, quantity in totals.items():
+                self.quantities[slot] -= quantity
+            new_quantities = {product_id: self.quantities[self._slot(product_id)] for product_id in quantities}
+            prices = {product_id: self.prices[self._slot(product_id)] for product_id in quantities}
+            sequence = self.journal.append([(slot, -quantity) for slot, quantity in totals.items()])
+        try:
+            self.journal.wait_durable(sequence)
+        except JournalTimeout:
+            # Not acknowledged, so not reserved: give the stock back, through the journal as well
+            # since the reservation may still reach disk
+            with self.lock:
+                for slot, quantity in totals.items():
+                    if self.quantities[slot] != ABSENT:
+                        self.quantities[slot] += quantity
+                self.journal.append(list(totals.items()))
+            raise
+        return new_quantities, prices, []
+
+    def hold(self, reservation_id, product_id, quantity, expires_at):
+        """Reserve quantity units until expires_at unless confirmed
+
+        Returns (hold, new stock); for a reservation_id seen before, the existing hold
+        and current stock instead (retries are safe). None if there is not enough stock.
+        A hold not on disk in time raises JournalTimeout and stays held until it expires,
+        so a retry gets it once the journal has caught up.
+        """
+        slot = self._slot(product_id)
+        with self.lock:
+            known = self._memory_hold(reservation_id)
+            if known is not None:
+                hold = known
+                # A retry must not answer before the hold it gets back is on disk
+                sequence = self.journal.appended
+                new_quantity = self.quantity(hold['product_id'])
+            else:
+                current = self.quantity(slot)
+                if current is None or current < quantity:
+                    return None
+                self.quantities[slot] -= quantity
+                hold = {'reservation_id': reservation_id, 'product_id': slot, 'quantity': quantity,
+                        'unit_price': self.prices[slot], 'status': 'held', 'expires_at': expires_at}
+                self.holds[reservation_id] = hold
+                sequence = self.journal.append([(slot, -quantity), (HOLD, dict(hold))])
+                new_quantity = self.quantities[slot]
+        self.journal.wait_durable(sequence)
+        return dict(hold), new_quantity
+
+    def finish_hold(self, reservation_id, status):
+        """End a held hold as confirmed, released or expired (the last two give the stock back)
+
+        Returns the hold, whose status shows how it had ended if it was no longer held,
+        or None for an unknown reservation_id. A hold past its expiry cannot be confirmed.
+        If the change is not on disk in time this raises JournalTimeout; the hold has
+        ended all the same, and a retry answers once the journal has caught up.
+        """
+        with self.lock:
+            hold = self.holds.pop(reservation_id, None)
+            if hold is None:
+                finished = self.finished.get(reservation_id)
+            else:
+                if status == 'confirmed' and hold['expires_at'] <= time.time():
+                    status = 'expired'
+                changes = []
+                if status != 'confirmed' and self.quantity(hold['product_id']) is not None:
+                    self.quantities[hold['product_id']] += hold['quantity']
+                    changes.append((hold['product_id'], hold['quantity']))
+                hold['status'] = status
+                changes.append((HOLD, dict(hold)))
+                sequence = self.journal.append(changes)
+                self.finished[reservation_id] = (hold, sequence)
+        if hold is None:
+            if finished is None:
+                return stored_hold(self.db, reservation_id)
+            hold, sequence = finished
+        self.journal.wait_durable(sequence)
+        return dict(hold)
+
+    def expire_holds(self, now):
+        """Release the holds past their expiry and forget ended holds past the retention; returns the count"""
+        with self.lock:
+            expired = [reservation_id for reservation_id, hold in self.holds.items() if hold['expires_at'] <= now]
+        for reservation_id in expired:
+            self.finish_hold(reservation_id, 'expired')
+        applied = self.journal.applied
+        forget_before = now - self.retain
+        with self.lock:
+            for reservation_id in [reservation_id for reservation_id, (hold, sequence) in self.finished.items()
+                                   if sequence <= applied and hold['expires_at'] <= forget_before]:
+                del self.finished[reservation_id]
+        return len(expired)
+
+    def _memory_hold(self, reservation_id):
+        hold = self.holds.get(reservation_id) or self.finished.get(reservation_id, (None,))[0]
+        return dict(hold) if hold else None
+
+    @contextmanager
+    def write_through(self):
+        """Run a direct write to products and its index update apart from other such writes"""
+        with self.write_lock:
+            yield self
+
+    def add(self, product_id, quantity, price):
+        """Record a product just inserted into SQLite (inside write_through)"""
+        with self.lock:
+            if product_id >= len(self.quantities):
+                missing = product_id + 1 - len(self.quantities)
+                self.quantities.extend([ABSENT] * missing)
+                self.prices.extend([0.0] * missing)
+            self.quantities[product_id] = quantity
+            self.prices[product_id] = price
+
+    def update(self, product_id, quantity, price):
+        """Set a product's stock and price (inside write_through, after writing the price to SQLite)
+
+        The stock reaches SQLite through the journal, as the change from the current
+        stock, so reservations still in the journal are neither lost nor applied twice.
+        """
+        with self.lock:
+            current = self.quantity(product_id)
+            if current is None:
+                return
+            self.quantities[product_id] = quantity
+            self.prices[product_id] = price
+            sequence = self.journal.append([(product_id, quantity - current)])
+        self.journal.wait_durable(sequence)
+
+    def remove(self, product_id):
+        """Forget a deleted product (inside write_through)"""
+        with self.lock:
+            if product_id < len(self.quantities):
+                self.quantities[product_id] = ABSENT
+
+    @staticmethod
+    def _slot(product_id):
+        # JSON ids may arrive as "3"; SQLite matched those against the integer id, so the index does too
+        if isinstance(product_id, str) and product_id.isdigit():
+            product_id = int(product_id)
+        if not isinstance(product_id, int) or isinstance(product_id, bool) or product_id < 0:
+            return None
+        return product_id
@@ -2,36 +2,24 @@
 Notification Service - Sends notifications based on events
 Port: 5006
 """
-from flask import Flask, jsonify
+from flask import Flask, request, jsonify
 from flask_cors import CORS
-import sqlite3
-import pika
-import json
-import time
-import threading
-import logging
-from pythonjsonlogger import jsonlogger
+import os
 from flask import g
 from prometheus_flask_exporter import PrometheusMetrics
 
-import logstash
+from common.log_shipping import setup_logging
+from common.access_log import init_access_log
+from common.db import Database, init_query_plans
+from common.listing import Listing
+from common.consumer import BatchConsumer, drain_on_shutdown
 
-# Configure Structured Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Console Handler (JSON)
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s')
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Logstash Handler
-logstash_handler = logstash.TCPLogstashHandler('logstash', 5000, version=1)
-logger.addHandler(logstash_handler)
+# Configure Structured Logging (JSON console + asynchronous Logstash shipping)
+logger = setup_logging()
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app, path=None)
+init_access_log(app, 'notification-service')
 
 from prometheus_client import generate_latest
 
@@ -45,120 +33,106 @@ def before_request():
     g.correlation_id = request.headers.get('X-Correlation-ID')
     if not g.correlation_id:
         g.correlation_id = "unknown"
-        
-    logger.info(f"Request received: {request.method} {request.path}", extra={
-        'service': 'notification-service',
-        'correlation_id': g.correlation_id,
-        'method': request.method,
-        'path': request.path
-    })
 
 CORS(app)
 
 RABBITMQ_HOST = 'rabbitmq'
 RABBITMQ_PORT = 5672
 
+# Notification Write Batching
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', '100'))  # Rows per transaction
+NOTIFICATION_FLUSH_MS = float(os.getenv('NOTIFICATION_FLUSH_MS', '200'))  # Max time a notification waits for its batch
+
+# Database: pooled WAL connections (see common/db.py)
+db = Database('notifications.db')
+
+# Schema migrations: (version, statements), each applied once per database file
+MIGRATIONS = [
+    (1, ['''CREATE TABLE IF NOT EXISTS notifications
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   customer_id INTEGER NOT NULL,
+                   order_id INTEGER,
+                   type TEXT NOT NULL,
+                   message TEXT NOT NULL,
+                   status TEXT DEFAULT 'sent',
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''']),
+    # Secondary indexes for the hot lookups (see /diagnostics/query-plans)
+    (2, ['CREATE INDEX IF NOT EXISTS idx_notifications_customer_created ON notifications (customer_id, created_at)',
+         'CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications (created_at)']),
+    # Index for the notification list's ?type= filter
+    (3, ['CREATE INDEX IF NOT EXISTS idx_notifications_type ON notifications (type)']),
+]
+
 def init_db():
-    conn = sqlite3.connect('notifications.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS notifications
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  customer_id INTEGER NOT NULL,
-                  order_id INTEGER,
-                  type TEXT NOT NULL,
-                  message TEXT NOT NULL,
-                  status TEXT DEFAULT 'sent',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    db.migrate(MIGRATIONS)
 
 init_db()
 
-def send_notification(customer_id, order_id, notification_type, message):
-    """Send notification (email/SMS) - simulated"""
-    logger.info(f"NOTIFICATION SENT: {notification_type} to Customer {customer_id}", extra={
-        'correlation_id': g.correlation_id,
-        'order_id': order_id,
-        'message': message
-    })
+# Hot queries whose plans are served at /diagnostics/query-plans
+HOT_QUERIES = {
+    'notifications_by_customer': ('SELECT * FROM notifications WHERE customer_id = ? ORDER BY created_at DESC, id DESC', (1,)),
+    'notifications_page': ('SELECT * FROM notifications WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 101',
+                           ('2030-01-01 00:00:00', 0))
+}
+init_query_plans(app, db, HOT_QUERIES)
+
+def build_notification(event_type, data):
+    """Map an event to a (customer_id, order_id, type, message) row, or None if it needs no notification"""
+    customer_id = data.get('customer_id')
+    order_id = data.get('order_id')
+    
+    # Handle different event types
+    if event_type == 'order.created':
+        return (customer_id, order_id, 'order_confirmation',
+                f"Your order #{order_id} has been created successfully. Total: ${data.get('total_price')}")
+    
+    elif event_type == 'payment.completed':
+        return (customer_id, order_id, 'payment_confirmation',
+                f"Payment for order #{order_id} has been processed successfully. Amount: ${data.get('amount')}")
+    
+    elif event_type == 'shipment.created':
+        return (customer_id, order_id, 'shipment_notification',
+                f"Your order #{order_id} has been shipped! Tracking number: {data.get('tracking_number')}")
     
-    # Save notification to database
-    conn = sqlite3.connect('notifications.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO notifications (customer_id, order_id, type, message)
-                 VALUES (?, ?, ?, ?)''',
-              (customer_id, order_id, notification_type, message))
-    conn.commit()
-    conn.close()
-
-def callback(ch, method, properties, body):
-    """RabbitMQ message callback - listens to all order-related events"""
-    try:
-        message = json.loads(body)
-        event_type = message.get('event')
-        data = message.get('data')
-        
-        logger.info(f"Notification Service received event: {event_type}", extra={'correlation_id': g.correlation_id})
-        
-        customer_id = data.get('customer_id')
-        order_id = data.get('order_id')
-        
-        # Handle different event types
-        if event_type == 'order.created':
-            send_notification(
-                customer_id, order_id, 'order_confirmation',
-                f"Your order #{order_id} has been created successfully. Total: ${data.get('total_price')}"
-            )
-        
-        elif event_type == 'payment.completed':
-            send_notification(
-                customer_id, order_id, 'payment_confirmation',
-                f"Payment for order #{order_id} has been processed successfully. Amount: ${data.get('amount')}"
-            )
-        
-        elif event_type == 'shipment.created':
-            send_notification(
-                customer_id, order_id, 'shipment_notification',
-                f"Your order #{order_id} has been shipped! Tracking number: {data.get('tracking_number')}"
-            )
-        
-        elif event_type == 'order.status.updated':
-            send_notification(
-                customer_id, order_id, 'status_update',
-                f"Order #{order_id} status updated to: {data.get('status')}"
-            )
-        
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}", extra={'correlation_id': 'system'})
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-
-def start_consumer():
-    """Start RabbitMQ consumer in separate thread"""
-    while True:
-        try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-            channel = connection.channel()
-            
-            # Declare exchange and queue
-            channel.exchange_declare(exchange='order_events', exchange_type='topic', durable=True)
-            result = channel.queue_declare(queue='notification_queue', durable=True)
-            queue_name = result.method.queue
-            
-            # Bind to multiple event types using wildcard
-            channel.queue_bind(exchange='order_events', queue=queue_name, routing_key='order.*')
-            channel.queue_bind(exchange='order_events', queue=queue_name, routing_key='payment.*')
-            channel.queue_bind(exchange='order_events', queue=queue_name, routing_key='shipment.*')
-            
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=queue_name, on_message_callback=callback)
-            
-            logger.info('Notification Service: Waiting for events...', extra={'correlation_id': 'system'})
-            channel.start_consuming()
-        except Exception as e:
-            logger.error(f"Consumer error: {str(e)}", extra={'correlation_id': 'system'})
-            time.sleep(5)
+    elif event_type == 'order.status.updated':
+        return (customer_id, order_id, 'status_update',
+                f"Order #{order_id} status updated to: {data.get('status')}")
+    
+    return None
+
+def send_notifications(events):
+    """Send notifications (email/SMS) - simulated - and save the batch in one transaction"""
+    rows = []
+    for event_type, data, correlation_id in events:
+        row = build_notification(event_type, data)
+        if row is None:
+            continue
+        logger.info(f"NOTIFICATION SENT: {row[2]} to Customer {row[0]}", extra={
+            'correlation_id': correlation_id,
+            'order_id': row[1],
+            'message': row[3]
+        })
+        rows.append(row)
+    if not rows:
+        return
+    
+    # Save notifications to database: one commit (fsync) per batch instead of per event
+    with db.transaction() as conn:
+        conn.executemany('''INSERT INTO notifications (customer_id, order_id, type, message)
+                            VALUES (?, ?, ?, ?)''', rows)
+
+# RabbitMQ consumer: events are acked only once their batch is committed (see common/consumer.py)
+notification_consumer = BatchConsumer('notification_queue', 'order_events', ['order.*', 'payment.*', 'shipment.*'],
+                                      send_notifications, app=app, batch_size=NOTIFICATION_BATCH_SIZE,
+                                      max_wait_ms=NOTIFICATION_FLUSH_MS, host=RABBITMQ_HOST, port=RABBITMQ_PORT)
+
+# Notification list, newest first: ?limit=&after= keyset pages, ?type= filter (see common/listing.py)
+notification_listing = Listing(db, 'notifications', ['id', 'customer_id', 'order_id', 'type', 'message', 'status',
+                                                     'created_at'],
+                               lambda n: {
+                                   'id': n[0], 'customer_id': n[1], 'order_id': n[2],
+                                   'type': n[3], 'message': n[4], 'status': n[5], 'created_at': n[6]
+                               }, filters=['customer_id', 'type'], sorts=['created_at'], default_sort='-created_at')
 
 # API endpoints
 @app.route('/api/notifications', methods=['GET'])
@@ -168,47 +142,23 @@ def get_notifications():
     user_id = request.headers.get('X-User-Id')
     user_role = request.headers.get('X-User-Role')
     
-    conn = sqlite3.connect('notifications.db')
-    c = conn.cursor()
-    
     # Customers see only their notifications
-    if user_role == 'customer':
-        c.execute('SELECT * FROM notifications WHERE customer_id = ? ORDER BY created_at DESC', 
-                  (user_id,))
-    else:
-        c.execute('SELECT * FROM notifications ORDER BY created_at DESC')
-    
-    notifications = c.fetchall()
-    conn.close()
-    
-    return jsonify([{
-        'id': n[0], 'customer_id': n[1], 'order_id': n[2],
-        'type': n[3], 'message': n[4], 'status': n[5], 'created_at': n[6]
-    } for n in notifications]), 200
+    where = {'customer_id': user_id} if user_role == 'customer' else None
+    return notification_listing.respond(request.path, request.args, where)
 
 @app.route('/api/notifications/customer/<int:customer_id>', methods=['GET'])
 def get_customer_notifications(customer_id):
     # Authorization is handled by Gateway
-    conn = sqlite3.connect('notifications.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM notifications WHERE customer_id = ? ORDER BY created_at DESC', 
-              (customer_id,))
-    notifications = c.fetchall()
-    conn.close()
-    
-    return jsonify([{
-        'id': n[0], 'customer_id': n[1], 'order_id': n[2],
-        'type': n[3], 'message': n[4], 'status': n[5], 'created_at': n[6]
-    } for n in notifications]), 200
+    return notification_listing.respond(request.path, request.args, {'customer_id': customer_id})
 
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'healthy', 'service': 'notification-service'}), 200
 
 if __name__ == '__main__':
-    # Start RabbitMQ consumer in separate thread
-    consumer_thread = threading.Thread(target=start_consumer, daemon=True)
-    consumer_thread.start()
+    # Start batching RabbitMQ consumer, pending batch flushed and acked on SIGTERM
+    notification_consumer.start()
+    drain_on_shutdown(notification_consumer)
     
     # Start Flask app
     app.run(host='0.0.0.0', port=5006, debug=True)
\ No newline at end of file
@@ -4,40 +4,35 @@ Port: 5003
 """
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import sqlite3
+import os
+import threading
+import time
+import uuid
 import jwt
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import pybreaker
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import requests.exceptions
-import logging
-from pythonjsonlogger import jsonlogger
 from flask import g
 
-import pika
-import json
 from prometheus_flask_exporter import PrometheusMetrics
 
-import logstash
+from common.log_shipping import setup_logging
+from common.access_log import init_access_log
+from common.events import EventPublisher
+from common.db import Database, init_query_plans
+from common.listing import Listing
+from common.saga import Saga
 
-# Configure Structured Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Console Handler (JSON)
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s')
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Logstash Handler
-logstash_handler = logstash.TCPLogstashHandler('logstash', 5000, version=1)
-logger.addHandler(logstash_handler)
+# Configure Structured Logging (JSON console + asynchronous Logstash shipping)
+logger = setup_logging()
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app, path=None)
+init_access_log(app, 'order-service')
 
-from prometheus_client import generate_latest
+from prometheus_client import generate_latest, Histogram
 
 @app.route('/metrics')
 def metrics_route():
@@ -50,13 +45,6 @@ def before_request():
     g.correlation_id = request.headers.get('X-Correlation-ID')
     if not g.correlation_id:
         g.correlation_id = "unknown" # Should ideally come from Gateway
-        
-    logger.info(f"Request received: {request.method} {request.path}", extra={
-        'service': 'order-service',
-        'correlation_id': g.correlation_id,
-        'method': request.method,
-        'path': request.path
-    })
 
 # Helper to inject correlation ID into downstream requests
 def get_headers():
@@ -68,7 +56,9 @@ def get_headers():
 # Circuit Breaker Configuration
 payment_circuit_breaker = pybreaker.CircuitBreaker(
     fail_max=5,  # 50% failure rate approximation (simplified for pybreaker)
-    reset_timeout=30
+    reset_timeout=30,
+    # The tripping call re-raises its own error: CircuitBreakerError then always means "not sent"
+    throw_new_error_on_trip=False
 )
 
 # Retry Configuration
@@ -78,198 +68,401 @@ retry_strategy = retry(
     retry=retry_if_exception_type((requests.exceptions.RequestException, requests.exceptions.Timeout, requests.exceptions.ConnectionError))
 )
 
+# Database: pooled WAL connections (see common/db.py)
+db = Database('orders.db')
+
+# Schema migrations: (version, statements), each applied once per database file
+MIGRATIONS = [
+    (1, ['''CREATE TABLE IF NOT EXISTS orders
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   customer_id INTEGER NOT NULL,
+                   product_id INTEGER NOT NULL,
+                   quantity INTEGER NOT NULL,
+                   total_price REAL NOT NULL,
+                   status TEXT NOT NULL,
+                   payment_status TEXT DEFAULT 'pending',
+                   shipping_status TEXT DEFAULT 'pending',
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''']),
+    # Secondary indexes for the hot lookups (see /diagnostics/query-plans)
+    (2, ['CREATE INDEX IF NOT EXISTS idx_orders_customer_id ON orders (customer_id)']),
+    # Indexes for the order list's ?status= filter and ?sort=created_at
+    (3, ['CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status)',
+         'CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)']),
+    # Stock hold of each order (held / confirmed / released ...), indexed for the saga sweeper
+    (4, ['ALTER TABLE orders ADD COLUMN reservation_id TEXT',
+         'ALTER TABLE orders ADD COLUMN reservation_status TEXT',
+         'CREATE INDEX IF NOT EXISTS idx_orders_reservation_id ON orders (reservation_id)',
+         "CREATE INDEX IF NOT EXISTS idx_orders_held ON orders (payment_status, created_at) "
+         "WHERE reservation_status = 'held'"]),
+]
+
 def init_db():
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS orders
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  customer_id INTEGER NOT NULL,
-                  product_id INTEGER NOT NULL,
-                  quantity INTEGER NOT NULL,
-                  total_price REAL NOT NULL,
-                  status TEXT NOT NULL,
-                  payment_status TEXT DEFAULT 'pending',
-                  shipping_status TEXT DEFAULT 'pending',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    db.migrate(MIGRATIONS)
 
 # Initialize DB on startup
 init_db()
 
+# Hot queries whose plans are served at /diagnostics/query-plans
+HOT_QUERIES = {
+    'orders_by_customer': ('SELECT * FROM orders WHERE customer_id = ?', (1,)),
+    'get_order': ('SELECT * FROM orders WHERE id = ?', (1,)),
+    'unpaid_held_orders': ("SELECT id, reservation_id FROM orders WHERE reservation_status = 'held' "
+                           "AND (status = 'cancelled' OR (payment_status = 'pending' "
+                           "AND created_at <= datetime('now', ?)))", ('-600 seconds',))
+}
+init_query_plans(app, db, HOT_QUERIES)
+
+# Event Publishing: one long-lived connection with publisher confirms (see common/events.py)
+event_publisher = EventPublisher('order_events')
+
 def publish_event(event_type, data):
-    try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
-        channel = connection.channel()
-        channel.exchange_declare(exchange='order_events', exchange_type='topic', durable=True)
-        
-        event = {
-            'event': event_type,
-            'data': data
-        }
-        
-        channel.basic_publish(
-            exchange='order_events',
-            routing_key=event_type,
-            body=json.dumps(event),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-            )
-        )
-        connection.close()
-    except Exception as e:
-        print(f"Failed to publish event: {e}")
+    """Publish event to RabbitMQ (buffered locally, confirmed asynchronously)"""
+    event_publisher.publish_event(event_type, data)
 
 @retry_strategy
 def check_customer(customer_id):
+    """True if the customer exists, False if customer-service has no such customer"""
     headers = get_headers()
     logger.info(f"Checking customer {customer_id}", extra={'correlation_id': g.correlation_id})
     response = requests.get(f'http://customer-service:5001/api/customers/{customer_id}', headers=headers, timeout=3)
+    # No such customer is an answer, not a failure to retry
+    if response.status_code == 404:
+        return False
     response.raise_for_status()
-    return response
+    return True
 
 @retry_strategy
-def check_inventory(product_id, quantity):
+def reserve_inventory(product_id, quantity, reservation_id):
+    """Check stock, hold it and get the unit price in one call; inventory's answer for 400/404/409"""
     headers = get_headers()
-    logger.info(f"Checking inventory for product {product_id}", extra={'correlation_id': g.correlation_id})
+    logger.info(f"Reserving product {product_id}", extra={'correlation_id': g.correlation_id})
     response = requests.post(
-        'http://inventory-service:5002/api/products/check-availability',
-        json={'product_id': product_id, 'quantity': quantity},
+        'http://inventory-service:5002/api/products/reserve-priced',
+        json={'product_id': product_id, 'quantity': quantity,
+              'reservation_id': reservation_id, 'hold_seconds': ORDER_RESERVATION_HOLD_SECONDS},
         headers=headers,
         timeout=3
     )
-    response.raise_for_status()
-    return response.json()
-
-@retry_strategy
-def get_product_price(product_id):
-    headers = get_headers()
-    response = requests.get(f'http://inventory-service:5002/api/products/{product_id}', headers=headers, timeout=3)
-    response.raise_for_status()
+    # Not enough stock / no such product is an answer, not a failure to retry
+    if response.status_code not in (400, 404, 409):
+        response.raise_for_status()
     return response.json()
 
 @retry_strategy
-def reserve_product(product_id, quantity):
-    headers = get_headers()
-    logger.info(f"Reserving product {product_id}", extra={'correlation_id': g.correlation_id})
+def finish_reservation(reservation_id, action):
+    """Confirm or release a stock hold; inventory's answer for 404/409 (safe to retry: holds are idempotent)"""
     response = requests.post(
-        'http://inventory-service:5002/api/products/reserve',
-        json={'product_id': product_id, 'quantity': quantity},
-        headers=headers,
+        f'http://inventory-service:5002/api/reservations/{reservation_id}/{action}',
+        headers=get_headers(),
         timeout=3
     )
-    response.raise_for_status()
-    return response
+    if response.status_code not in (404, 409):
+        response.raise_for_status()
+    return response.json()
+
+# Pre-flight: the customer check runs on a bounded pool while the request
+# thread reserves inventory, so the order waits for the slower of the two
+# instead of their sum. Step durations (customer_check, inventory_reserve and
+# their wall time, preflight) go to order_create_step_seconds.
+ORDER_PREFLIGHT_WORKERS = int(os.getenv('ORDER_PREFLIGHT_WORKERS', '32'))  # Concurrent customer checks
+
+preflight_executor = ThreadPoolExecutor(max_workers=ORDER_PREFLIGHT_WORKERS, thread_name_prefix='preflight')
+order_step_seconds = Histogram('order_create_step_seconds', 'Time spent in each create_order step', ['step'])
+
+def timed(step, timings, fn, *args):
+    """Run fn(*args), recording its duration under step"""
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        timings[step] = time.perf_counter() - start
+        order_step_seconds.labels(step).observe(timings[step])
+
+def with_request_context(fn, *args):
+    """Wrap fn(*args) to run in a worker thread with this request's correlation ID in g"""
+    correlation_id = g.correlation_id
+    
+    def run():
+        # g is per request; a worker thread gets an app context of its own carrying the same ID
+        with app.app_context():
+            g.correlation_id = correlation_id
+            return fn(*args)
+    return run
+
+# Order Saga
+# create_order reserves stock as a hold that inventory-service expires unless
+# it is confirmed. While the order is being created, each step that leaves
+# something behind registers its compensation (release the hold, cancel the
+# order) with a Saga (see common/saga.py), so a rejection, a failed insert or
+# any other error undoes what was done. Once payment is taken, or queued for
+# asynchronous processing, the saga pivots: the hold is confirmed when the
+# payment completes, and a sweeper confirms paid orders whose confirmation
+# failed and cancels orders still unpaid after ORDER_PAYMENT_TIMEOUT,
+# releasing their stock before the hold lapses. The cancellation comes first:
+# a payment reported for a cancelled order leaves it 'refund_due' instead.
+ORDER_RESERVATION_HOLD_SECONDS = int(os.getenv('ORDER_RESERVATION_HOLD_SECONDS', '900'))  # Stock hold per order
+ORDER_PAYMENT_TIMEOUT = int(os.getenv('ORDER_PAYMENT_TIMEOUT', '600'))  # Seconds an order may stay unpaid
+ORDER_SWEEP_SECONDS = float(os.getenv('ORDER_SWEEP_SECONDS', '30'))  # How often the saga sweeper runs
+
+class OrderRejected(Exception):
+    """Ends create_order with an error response (after the saga's compensations)"""
+    def __init__(self, status, message, error=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {'message': message, 'error': error} if error else {'message': message}
+
+def cancel_order(order_id):
+    with db.transaction() as conn:
+        conn.execute("UPDATE orders SET status = 'cancelled' WHERE id = ?", (order_id,))
+    publish_event('order.status.updated', {'order_id': order_id, 'status': 'cancelled'})
+
+def confirm_order_reservation(order_id, reservation_id):
+    """Forward step once an order is paid: make its stock hold permanent"""
+    result = finish_reservation(reservation_id, 'confirm')
+    status = 'confirmed' if result.get('success') else (result.get('reservation') or {}).get('status', 'missing')
+    with db.transaction() as conn:
+        conn.execute("UPDATE orders SET reservation_status = ? WHERE id = ? AND reservation_status = 'held'",
+                     (status, order_id))
+    if status != 'confirmed':
+        logger.error(f"Order {order_id} is paid but its stock hold is {status}",
+                     extra={'correlation_id': g.correlation_id})
+
+def release_reservation(reservation_id):
+    """Compensation: give an order's stock hold back; False if it had been confirmed"""
+    result = finish_reservation(reservation_id, 'release')
+    if (result.get('reservation') or {}).get('status') == 'confirmed':
+        return False
+    with db.transaction() as conn:
+        conn.execute("UPDATE orders SET reservation_status = 'released' WHERE reservation_id = ?", (reservation_id,))
+    return True
+
+def cancel_unpaid_order(order_id, reservation_id):
+    """Compensation for an order whose payment never completed: cancel it, then release its stock
+
+    The cancellation is the conditional UPDATE, so a payment completing meanwhile keeps the
+    order and its hold; one completing later finds the order cancelled (see update_payment_status).
+    """
+    with db.transaction() as conn:
+        c = conn.execute('''UPDATE orders SET status = 'cancelled'
+                            WHERE id = ? AND payment_status != 'completed' AND status != 'cancelled' ''',
+                         (order_id,))
+        status = conn.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()[0]
+    if c.rowcount:
+        logger.warning(f"Order {order_id} cancelled: unpaid after {ORDER_PAYMENT_TIMEOUT}s",
+                       extra={'correlation_id': g.correlation_id})
+        publish_event('order.status.updated', {'order_id': order_id, 'status': 'cancelled'})
+    if status != 'cancelled':
+        return  # Paid meanwhile
+    if not release_reservation(reservation_id):
+        # Not held by this order any more, so the sweeper stops retrying it
+        with db.transaction() as conn:
+            conn.execute("UPDATE orders SET reservation_status = 'confirmed' WHERE id = ?", (order_id,))
+        logger.error(f"Order {order_id} is cancelled but its stock hold was confirmed",
+                     extra={'correlation_id': g.correlation_id})
 
 # Create order (orchestration)
 @app.route('/api/orders', methods=['POST'])
 def create_order():
+    try:
+        return place_order()
+    except OrderRejected as e:
+        return jsonify(e.body), e.status
+    except Exception as e:
+        logger.error(f"Order creation failed: {str(e)}", extra={'correlation_id': g.correlation_id})
+        return jsonify({'message': 'Order could not be created', 'error': str(e)}), 500
+
+def place_order():
     # Get user context from Gateway headers
     customer_id = request.headers.get('X-User-Id')
     
     data = request.json
     product_id = data.get('product_id')
     quantity = data.get('quantity')
+    reservation_id = uuid.uuid4().hex
     
-    # Step 1: Verify customer exists (synchronous call to Customer Service)
-    try:
-        check_customer(customer_id)
-    except Exception as e:
-        return jsonify({'message': 'Customer service unavailable', 'error': str(e)}), 503
+    with Saga('create_order', g.correlation_id) as saga:
+        # Steps 1 and 2 run concurrently: verify the customer exists (Customer Service)
+        # while checking availability, holding and pricing the product (Inventory Service)
+        timings = {}
+        preflight_start = time.perf_counter()
+        customer_check = preflight_executor.submit(with_request_context(timed, 'customer_check', timings,
+                                                                        check_customer, customer_id))
+        reservation, inventory_error = None, None
+        try:
+            reservation = timed('inventory_reserve', timings, reserve_inventory, product_id, quantity, reservation_id)
+        except Exception as e:
+            inventory_error = e
+        if inventory_error or reservation.get('success'):
+            # After an error the hold may exist all the same; releasing an unknown one is a no-op
+            saga.on_failure('release_reservation', release_reservation, reservation_id)
+        try:
+            customer_exists = customer_check.result()
+        except Exception as e:
+            raise OrderRejected(503, 'Customer service unavailable', str(e))
+        finally:
+            timings['preflight'] = time.perf_counter() - preflight_start
+            order_step_seconds.labels('preflight').observe(timings['preflight'])
+            logger.info("Pre-flight took " + ', '.join(f"{step} {seconds * 1000:.0f} ms"
+                                                         for step, seconds in timings.items()),
+                        extra={'correlation_id': g.correlation_id})
     
-    # Step 2: Check product availability (synchronous call to Inventory Service)
-    try:
-        availability = check_inventory(product_id, quantity)
-        if not availability.get('available'):
-            return jsonify({'message': 'Product not available in requested quantity'}), 400
-    except Exception as e:
-        return jsonify({'message': 'Inventory service unavailable', 'error': str(e)}), 503
+        if not customer_exists:
+            raise OrderRejected(400, 'Customer not found')
+        if inventory_error:
+            raise OrderRejected(503, 'Inventory service unavailable', str(inventory_error))
+        if not reservation.get('success'):
+            raise OrderRejected(400, 'Product not available in requested quantity', reservation.get('message'))
+        total_price = reservation['unit_price'] * quantity
     
-    # Step 3: Get product price
-    try:
-        product = get_product_price(product_id)
-        total_price = product['price'] * quantity
-    except Exception as e:
-        return jsonify({'message': 'Cannot calculate price', 'error': str(e)}), 503
+        # Step 3: Create order in database
+        with db.transaction() as conn:
+            c = conn.execute('''INSERT INTO orders (customer_id, product_id, quantity, total_price, status,
+                                                    reservation_id, reservation_status)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                             (customer_id, product_id, quantity, total_price, 'pending', reservation_id, 'held'))
+        order_id = c.lastrowid
+        saga.on_failure('cancel_order', cancel_order, order_id)
     
-    # Step 4: Reserve product (reduce inventory)
-    try:
-        reserve_product(product_id, quantity)
-    except Exception as e:
-        return jsonify({'message': 'Cannot reserve product', 'error': str(e)}), 503
+        # Step 4: Process Payment (Circuit Breaker Pattern)
+        payment_successful = False
+        payment_unknown = False
+        try:
+            # Define the synchronous payment call
+            @payment_circuit_breaker
+            def call_payment_service():
+                resp = requests.post(
+                    'http://payment-service:5004/api/payments/process',
+                    json={
+                        'order_id': order_id,
+                        'total_price': total_price,
+                        'customer_id': customer_id
+                    },
+                    timeout=5
+                )
+                resp.raise_for_status()
+                return resp
     
-    # Step 5: Create order in database
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO orders (customer_id, product_id, quantity, total_price, status)
-                 VALUES (?, ?, ?, ?, ?)''',
-              (customer_id, product_id, quantity, total_price, 'pending'))
-    conn.commit()
-    order_id = c.lastrowid
-    conn.close()
+            # 202: another request for this order is still charging it, so the outcome is not known yet
+            if call_payment_service().status_code == 202:
+                logger.warning(f"Payment of order {order_id} is in progress elsewhere. Awaiting its status.",
+                               extra={'correlation_id': g.correlation_id})
+                payment_unknown = True
+            else:
+                payment_successful = True
     
-    # Step 6: Process Payment (Circuit Breaker Pattern)
-    payment_successful = False
-    try:
-        # Define the synchronous payment call
-        @payment_circuit_breaker
-        def call_payment_service():
-            resp = requests.post(
-                'http://payment-service:5004/api/payments/process',
-                json={
-                    'order_id': order_id,
-                    'total_price': total_price,
-                    'customer_id': customer_id
-                },
-                timeout=5
-            )
-            resp.raise_for_status()
-            return resp
-            
-        call_payment_service()
-        payment_successful = True
-        
-    except pybreaker.CircuitBreakerError:
-        logger.warning("Circuit Breaker OPEN: Payment Service is down. Fallback to async processing.", extra={'correlation_id': g.correlation_id})
-        # Fallback: Queue the payment for later processing (simulated by just returning success with pending status)
-        # In a real system, we might push to a dead-letter queue or a separate retry queue
+        except pybreaker.CircuitBreakerError:
+            logger.warning("Circuit Breaker OPEN: Payment Service is down. Fallback to async processing.", extra={'correlation_id': g.correlation_id})
+            fallback = 'Circuit Breaker'
+        except requests.exceptions.ConnectionError as e:
+            # Refused, unresolvable or connect timeout: payment-service never saw the request
+            logger.error(f"Payment Service call failed: {str(e)}. Fallback to async processing.", extra={'correlation_id': g.correlation_id})
+            fallback = 'Error'
+        except Exception as e:
+            # Read timeout or error answer: payment-service may have taken the payment already.
+            # It reports it through /payment-status; the sweeper cancels the order if it never does
+            logger.error(f"Payment of order {order_id} failed with an unknown outcome: {str(e)}. Awaiting its status.",
+                         extra={'correlation_id': g.correlation_id})
+            payment_unknown = True
+    
+        # Step 5: Fallback / Async Processing
+        # If the payment request was never sent (CB open, no connection), publish the event so
+        # payment-service's consumer takes the payment later; the hold is confirmed when it completes
+        if not payment_successful and not payment_unknown:
+            publish_event('order.created', {
+                'order_id': order_id,
+                'customer_id': customer_id,
+                'product_id': product_id,
+                'quantity': quantity,
+                'total_price': total_price
+            })
+    
+        # The order stands from here: paid, or queued for payment (cancelled by the sweeper if that never completes)
+        saga.pivot()
+    
+    if payment_unknown:
         return jsonify({
-            'message': 'Order created. Payment processing is delayed (Circuit Breaker).',
+            'message': 'Order created. Payment outcome is being confirmed.',
             'order_id': order_id,
-            'payment_status': 'pending_retry',
+            'payment_status': 'pending',
             'total_price': total_price
         }), 202
-    except Exception as e:
-        logger.error(f"Payment Service call failed: {str(e)}. Fallback to async processing.", extra={'correlation_id': g.correlation_id})
+    
+    if not payment_successful:
         return jsonify({
-            'message': 'Order created. Payment processing is delayed (Error).',
+            'message': f'Order created. Payment processing is delayed ({fallback}).',
             'order_id': order_id,
             'payment_status': 'pending_retry',
             'total_price': total_price
         }), 202
     
-    # Step 7: Fallback / Async Processing
-    # If synchronous payment failed (or CB open), we publish the event for later processing
-    if not payment_successful:
-        order_data = {
-            'order_id': order_id,
-            'customer_id': customer_id,
-            'product_id': product_id,
-            'quantity': quantity,
-            'total_price': total_price
-        }
-        publish_event('order.created', order_data)
-        message = f'Order created. Payment processing queued (Fallback). Order ID: {order_id}'
-    else:
-        message = 'Order created and payment processed successfully.'
+    # Payment-service reports the payment through /payment-status, which normally confirms the hold already
+    try:
+        with db.connection() as conn:
+            reservation_status = conn.execute('SELECT reservation_status FROM orders WHERE id = ?',
+                                              (order_id,)).fetchone()[0]
+        if reservation_status == 'held':
+            confirm_order_reservation(order_id, reservation_id)
+    except Exception as e:
+        logger.error(f"Could not confirm stock hold of order {order_id}, left to the sweeper: {str(e)}",
+                     extra={'correlation_id': g.correlation_id})
     
     return jsonify({
-        'message': message,
+        'message': 'Order created and payment processed successfully.',
         'order_id': order_id,
         'total_price': total_price,
-        'payment_status': 'completed' if payment_successful else 'pending'
+        'payment_status': 'completed'
     }), 201
 
+def sweep_orders():
+    """Confirm the holds of paid orders and cancel orders unpaid past ORDER_PAYMENT_TIMEOUT"""
+    with db.connection() as conn:
+        paid = conn.execute('''SELECT id, reservation_id FROM orders
+                               WHERE reservation_status = 'held' AND payment_status = 'completed'
+                               AND status != 'cancelled' ''').fetchall()
+        # Cancelled orders still holding stock are the releases that failed
+        unpaid = conn.execute('''SELECT id, reservation_id FROM orders
+                                 WHERE reservation_status = 'held' AND (status = 'cancelled'
+                                 OR (payment_status = 'pending' AND created_at <= datetime('now', ?)))''',
+                              (f'-{ORDER_PAYMENT_TIMEOUT} seconds',)).fetchall()
+    for order_id, reservation_id in paid:
+        confirm_order_reservation(order_id, reservation_id)
+    for order_id, reservation_id in unpaid:
+        cancel_unpaid_order(order_id, reservation_id)
+
+def run_order_sweeper():
+    while True:
+        time.sleep(ORDER_SWEEP_SECONDS)
+        # Outside any request: an app context of its own, so get_headers() and logging find g
+        with app.app_context():
+            g.correlation_id = 'order-sweeper'
+            try:
+                sweep_orders()
+            except Exception:
+                logger.exception("Order saga sweep failed")
+
+order_sweeper_lock = threading.Lock()
+order_sweeper_started = False
+
+@app.before_request
+def start_order_sweeper():
+    # Started by the first request, so only the serving process sweeps (not the reloader parent)
+    global order_sweeper_started
+    if order_sweeper_started:
+        return
+    with order_sweeper_lock:
+        if not order_sweeper_started:
+            threading.Thread(target=run_order_sweeper, name='order-sweeper', daemon=True).start()
+            order_sweeper_started = True
+
+# Order list: ?limit=&after= keyset pages, ?status= / ?customer_id= filters (see common/listing.py)
+order_listing = Listing(db, 'orders', ['id', 'customer_id', 'product_id', 'quantity', 'total_price', 'status',
+                                       'payment_status', 'shipping_status', 'created_at'],
+                        lambda o: {
+                            'id': o[0], 'customer_id': o[1], 'product_id': o[2],
+                            'quantity': o[3], 'total_price': o[4], 'status': o[5],
+                            'payment_status': o[6], 'shipping_status': o[7], 'created_at': o[8]
+                        }, filters=['customer_id', 'status'], sorts=['created_at'])
+
 # Get all orders
 @app.route('/api/orders', methods=['GET'])
 def get_orders():
@@ -277,23 +470,9 @@ def get_orders():
     user_id = request.headers.get('X-User-Id')
     user_role = request.headers.get('X-User-Role')
     
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    
     # Customers see only their orders, admin/staff see all
-    if user_role == 'customer':
-        c.execute('SELECT * FROM orders WHERE customer_id = ?', (user_id,))
-    else:
-        c.execute('SELECT * FROM orders')
-    
-    orders = c.fetchall()
-    conn.close()
-    
-    return jsonify([{
-        'id': o[0], 'customer_id': o[1], 'product_id': o[2],
-        'quantity': o[3], 'total_price': o[4], 'status': o[5],
-        'payment_status': o[6], 'shipping_status': o[7], 'created_at': o[8]
-    } for o in orders]), 200
+    where = {'customer_id': user_id} if user_role == 'customer' else None
+    return order_listing.respond(request.path, request.args, where)
 
 # Get single order
 @app.route('/api/orders/<int:order_id>', methods=['GET'])
@@ -302,11 +481,8 @@ def get_order(order_id):
     user_id = request.headers.get('X-User-Id')
     user_role = request.headers.get('X-User-Role')
     
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
-    order = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        order = conn.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
     
     if not order:
         return jsonify({'message': 'Order not found'}), 404
@@ -328,11 +504,8 @@ def update_order_status(order_id):
     data = request.json
     status = data.get('status')
     
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('UPDATE orders SET status = ? WHERE id = ?', (status, order_id))
-    conn.commit()
-    conn.close()
+    with db.transaction() as conn:
+        conn.execute('UPDATE orders SET status = ? WHERE id = ?', (status, order_id))
     
     # Publish status update event
     publish_event('order.status.updated', {'order_id': order_id, 'status': status})
@@ -345,11 +518,24 @@ def update_payment_status(order_id):
     data = request.json
     payment_status = data.get('payment_status')
     
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('UPDATE orders SET payment_status = ? WHERE id = ?', (payment_status, order_id))
-    conn.commit()
-    conn.close()
+    with db.transaction() as conn:
+        order = conn.execute('SELECT reservation_id, reservation_status, status FROM orders WHERE id = ?',
+                             (order_id,)).fetchone()
+        if payment_status == 'completed' and order and order[2] == 'cancelled':
+            # Paid after the sweeper cancelled it (its stock is released): kept as owed back to the customer
+            payment_status = 'refund_due'
+        conn.execute('UPDATE orders SET payment_status = ? WHERE id = ?', (payment_status, order_id))
+    
+    # Saga forward step: a paid order's stock hold becomes permanent (the sweeper retries failures)
+    if payment_status == 'completed' and order and order[1] == 'held':
+        try:
+            confirm_order_reservation(order_id, order[0])
+        except Exception as e:
+            logger.error(f"Could not confirm stock hold of order {order_id}: {str(e)}",
+                         extra={'correlation_id': g.correlation_id})
+    elif payment_status == 'refund_due':
+        logger.error(f"Payment completed for cancelled order {order_id}, marked refund_due",
+                     extra={'correlation_id': g.correlation_id})
     
     return jsonify({'message': 'Payment status updated'}), 200
 
@@ -359,11 +545,8 @@ def update_shipping_status(order_id):
     data = request.json
     shipping_status = data.get('shipping_status')
     
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('UPDATE orders SET shipping_status = ? WHERE id = ?', (shipping_status, order_id))
-    conn.commit()
-    conn.close()
+    with db.transaction() as conn:
+        conn.execute('UPDATE orders SET shipping_status = ? WHERE id = ?', (shipping_status, order_id))
     
     return jsonify({'message': 'Shipping status updated'}), 200
 
@@ -4,35 +4,26 @@ Port: 5004
 """
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import sqlite3
-import pika
-import json
+import os
 import requests
 import time
-import threading
-import logging
-from pythonjsonlogger import jsonlogger
+import uuid
 from flask import g
 from prometheus_flask_exporter import PrometheusMetrics
 
-import logstash
+from common.log_shipping import setup_logging
+from common.access_log import init_access_log
+from common.db import Database, init_query_plans
+from common.listing import Listing
+from common.events import EventPublisher
+from common.consumer import EventConsumer, drain_on_shutdown
 
-# Configure Structured Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Console Handler (JSON)
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s')
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Logstash Handler
-logstash_handler = logstash.TCPLogstashHandler('logstash', 5000, version=1)
-logger.addHandler(logstash_handler)
+# Configure Structured Logging (JSON console + asynchronous Logstash shipping)
+logger = setup_logging()
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app, path=None)
+init_access_log(app, 'payment-service')
 
 from prometheus_client import generate_latest
 
@@ -47,13 +38,6 @@ def before_request():
     g.correlation_id = request.headers.get('X-Correlation-ID')
     if not g.correlation_id:
         g.correlation_id = "unknown"
-        
-    logger.info(f"Request received: {request.method} {request.path}", extra={
-        'service': 'payment-service',
-        'correlation_id': g.correlation_id,
-        'method': request.method,
-        'path': request.path
-    })
 
 # Helper to inject correlation ID into downstream requests (if any)
 def get_headers():
@@ -65,76 +49,129 @@ def get_headers():
 RABBITMQ_HOST = 'rabbitmq'
 RABBITMQ_PORT = 5672
 
+# A payment is claimed (a pending row) before the charge. A claim older than the lease is taken over by
+# the next request for the order, so it must outlast any charge: its owner is then presumed dead
+PAYMENT_CLAIM_LEASE_SECONDS = float(os.getenv('PAYMENT_CLAIM_LEASE_SECONDS', '60'))
+
+# Database: pooled WAL connections (see common/db.py)
+db = Database('payments.db')
+
+# Schema migrations: (version, statements), each applied once per database file
+MIGRATIONS = [
+    (1, ['''CREATE TABLE IF NOT EXISTS payments
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   order_id INTEGER NOT NULL,
+                   amount REAL NOT NULL,
+                   status TEXT DEFAULT 'pending',
+                   payment_method TEXT,
+                   transaction_id TEXT,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''']),
+    # Secondary indexes for the hot lookups (see /diagnostics/query-plans)
+    (2, ['CREATE INDEX IF NOT EXISTS idx_payments_order_id ON payments (order_id)']),
+    # Indexes for the payment list's ?status= filter and ?sort=created_at
+    (3, ['CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status)',
+         'CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at)']),
+    # Owner and time of the claim on a pending payment
+    (4, ['ALTER TABLE payments ADD COLUMN claim_id TEXT',
+         'ALTER TABLE payments ADD COLUMN claimed_at REAL']),
+]
+
 def init_db():
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS payments
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  order_id INTEGER NOT NULL,
-                  amount REAL NOT NULL,
-                  status TEXT DEFAULT 'pending',
-                  payment_method TEXT,
-                  transaction_id TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    db.migrate(MIGRATIONS)
 
 init_db()
 
+# Hot queries whose plans are served at /diagnostics/query-plans
+HOT_QUERIES = {
+    'get_payment': ('SELECT * FROM payments WHERE id = ?', (1,)),
+    'payments_by_order': ('SELECT * FROM payments WHERE order_id = ?', (1,))
+}
+init_query_plans(app, db, HOT_QUERIES)
+
+# Event Publishing: one long-lived connection with publisher confirms (see common/events.py)
+event_publisher = EventPublisher('order_events', host=RABBITMQ_HOST, port=RABBITMQ_PORT)
+
 def publish_event(event_type, data):
-    """Publish event to RabbitMQ"""
+    """Publish event to RabbitMQ (buffered locally, confirmed asynchronously)"""
+    event_publisher.publish_event(event_type, data)
+
+# ... (previous code)
+
+def update_order_payment_status(order_id):
+    """Update order payment status (synchronous call to Order Service)"""
     try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-        channel = connection.channel()
-        channel.exchange_declare(exchange='order_events', exchange_type='topic', durable=True)
-        
-        message = json.dumps({'event': event_type, 'data': data})
-        channel.basic_publish(
-            exchange='order_events',
-            routing_key=event_type,
-            body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
+        headers = get_headers()
+        requests.put(
+            f'http://order-service:5003/api/orders/{order_id}/payment-status',
+            json={'payment_status': 'completed'},
+            headers=headers,
+            timeout=5
         )
-        connection.close()
-        print(f"Published event: {event_type}")
     except Exception as e:
-        print(f"Error publishing event: {str(e)}")
+        logger.error(f"Error updating order payment status: {str(e)}", extra={'correlation_id': g.correlation_id})
 
-# ... (previous code)
+def claim_payment(order_id, amount, claim_id):
+    """Claim the payment of an order: (payment_id, status), status 'claimed' if this claim_id now owns it
+
+    Otherwise the status is the payment's own: 'completed', or 'pending' while another
+    request's claim is within its lease. A failed or stale claim is taken over.
+    """
+    now = time.time()
+    with db.transaction() as conn:
+        existing = conn.execute('SELECT id, status, claimed_at FROM payments WHERE order_id = ? ORDER BY id LIMIT 1',
+                                (order_id,)).fetchone()
+        if existing is None:
+            c = conn.execute('''INSERT INTO payments (order_id, amount, status, payment_method, claim_id, claimed_at)
+                                VALUES (?, ?, ?, ?, ?, ?)''', (order_id, amount, 'pending', 'credit_card', claim_id, now))
+            return c.lastrowid, 'claimed'
+        payment_id, status, claimed_at = existing
+        if status == 'completed' or (status == 'pending' and (claimed_at or 0) > now - PAYMENT_CLAIM_LEASE_SECONDS):
+            return payment_id, status
+        conn.execute("UPDATE payments SET status = 'pending', claim_id = ?, claimed_at = ? WHERE id = ?",
+                     (claim_id, now, payment_id))
+    logger.warning(f"Taking over payment {payment_id} of order {order_id} ({status}, claimed at {claimed_at})",
+                   extra={'correlation_id': g.correlation_id})
+    return payment_id, 'claimed'
 
 def process_payment_logic(order_data):
-    """Core payment processing logic"""
+    """Core payment processing logic: (payment_id, 'completed'), or (payment_id, 'pending') while in progress elsewhere"""
     order_id = order_data['order_id']
     amount = order_data['total_price']
     customer_id = order_data.get('customer_id') # Handle potential missing key if called from different context
     
+    # One payment per order: the synchronous call, the order.created fallback and a redelivered
+    # event can all ask for the same one. Only the request holding the claim charges
+    claim_id = uuid.uuid4().hex
+    payment_id, status = claim_payment(order_id, amount, claim_id)
+    if status != 'claimed':
+        logger.info(f"Order {order_id} already has payment {payment_id} ({status}), not charging again",
+                    extra={'correlation_id': g.correlation_id})
+        if status == 'completed':
+            # The earlier status update may be what failed; it is idempotent, payment.completed is not
+            update_order_payment_status(order_id)
+        return payment_id, status
+    
     logger.info(f"Processing payment for order {order_id}, amount: {amount}", extra={'correlation_id': g.correlation_id})
     
-    # Simulate payment processing
-    time.sleep(2)
+    try:
+        # Simulate payment processing (a real charge carries order_id as the gateway's idempotency key)
+        time.sleep(2)
+    except Exception:
+        with db.transaction() as conn:
+            conn.execute("UPDATE payments SET status = 'failed' WHERE id = ? AND claim_id = ?", (payment_id, claim_id))
+        raise
     
-    # Save payment record
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO payments (order_id, amount, status, payment_method, transaction_id)
-                 VALUES (?, ?, ?, ?, ?)''',
-              (order_id, amount, 'completed', 'credit_card', f'TXN-{order_id}-{int(time.time())}'))
-    conn.commit()
-    payment_id = c.lastrowid
-    conn.close()
+    # Save payment record, unless the claim was taken over meanwhile: its new owner settles it
+    with db.transaction() as conn:
+        c = conn.execute('''UPDATE payments SET status = 'completed', transaction_id = ?
+                            WHERE status = 'pending' AND id = ? AND claim_id = ?''',
+                         (f'TXN-{order_id}-{int(time.time())}', payment_id, claim_id))
+    if not c.rowcount:
+        logger.error(f"Payment {payment_id} of order {order_id} was taken over during the charge, leaving it to the new owner",
+                     extra={'correlation_id': g.correlation_id})
+        return payment_id, 'pending'
     
-    # Update order payment status (synchronous call to Order Service)
-    try:
-        headers = get_headers()
-        requests.put(
-            f'http://order-service:5003/api/orders/{order_id}/payment-status',
-            json={'payment_status': 'completed'},
-            headers=headers,
-            timeout=5
-        )
-    except Exception as e:
-        logger.error(f"Error updating order payment status: {str(e)}", extra={'correlation_id': g.correlation_id})
+    update_order_payment_status(order_id)
     
     # Publish PaymentCompleted event (asynchronous)
     publish_event('payment.completed', {
@@ -145,49 +182,19 @@ def process_payment_logic(order_data):
     })
     
     logger.info(f"Payment completed for order {order_id}", extra={'correlation_id': g.correlation_id})
-    return payment_id
+    return payment_id, 'completed'
 
-def callback(ch, method, properties, body):
-    """RabbitMQ message callback"""
-    try:
-        message = json.loads(body)
-        event_type = message.get('event')
-        data = message.get('data')
-        
-        logger.info(f"Received event: {event_type}", extra={'correlation_id': 'system'})
-        
-        if event_type == 'order.created':
-            process_payment_logic(data)
-        
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}", extra={'correlation_id': 'system'})
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+def handle_event(event_type, data):
+    """Handle an event from payment_queue (runs on a consumer worker thread)"""
+    if event_type == 'order.created':
+        payment_id, status = process_payment_logic(data)
+        if status != 'completed':
+            logger.info(f"Payment {payment_id} of order {data['order_id']} is in progress elsewhere",
+                        extra={'correlation_id': g.correlation_id})
 
-def start_consumer():
-    """Start RabbitMQ consumer in separate thread"""
-    while True:
-        try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-            channel = connection.channel()
-            
-            # Declare exchange and queue
-            channel.exchange_declare(exchange='order_events', exchange_type='topic', durable=True)
-            result = channel.queue_declare(queue='payment_queue', durable=True)
-            queue_name = result.method.queue
-            
-            # Bind queue to exchange with routing key
-            channel.queue_bind(exchange='order_events', queue=queue_name, routing_key='order.created')
-            
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=queue_name, on_message_callback=callback)
-            
-            logger.info('Payment Service: Waiting for order events...', extra={'correlation_id': 'system'})
-            channel.start_consuming()
-        except Exception as e:
-            logger.error(f"Consumer error: {str(e)}", extra={'correlation_id': 'system'})
-            time.sleep(5)
+# RabbitMQ consumer: CONSUMER_WORKERS payments processed concurrently (see common/consumer.py)
+payment_consumer = EventConsumer('payment_queue', 'order_events', ['order.created'], handle_event,
+                                 app=app, host=RABBITMQ_HOST, port=RABBITMQ_PORT)
 
 # API endpoints
 @app.route('/api/payments/process', methods=['POST'])
@@ -195,7 +202,14 @@ def process_payment_endpoint():
     """Synchronous payment processing endpoint"""
     data = request.json
     try:
-        payment_id = process_payment_logic(data)
+        payment_id, status = process_payment_logic(data)
+        if status != 'completed':
+            # Another request is charging this order: its outcome reaches order-service through /payment-status
+            return jsonify({
+                'message': 'Payment already in progress',
+                'payment_id': payment_id,
+                'status': status
+            }), 202
         return jsonify({
             'message': 'Payment processed successfully',
             'payment_id': payment_id,
@@ -204,6 +218,14 @@ def process_payment_endpoint():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Payment list: ?limit=&after= keyset pages, ?order_id= / ?status= filters (see common/listing.py)
+payment_listing = Listing(db, 'payments', ['id', 'order_id', 'amount', 'status', 'payment_method', 'transaction_id',
+                                           'created_at'],
+                          lambda p: {
+                              'id': p[0], 'order_id': p[1], 'amount': p[2],
+                              'status': p[3], 'payment_method': p[4], 'transaction_id': p[5], 'created_at': p[6]
+                          }, filters=['order_id', 'status'], sorts=['created_at'])
+
 # API endpoints
 @app.route('/api/payments', methods=['GET'])
 def get_payments():
@@ -212,30 +234,16 @@ def get_payments():
     user_id = request.headers.get('X-User-Id')
     user_role = request.headers.get('X-User-Role')
     
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    
     # Customers see only their payments
     if user_role == 'admin':
-        c.execute('SELECT * FROM payments')
-    
-        payments = c.fetchall()
-        conn.close()
-    
-        return jsonify([{
-            'id': p[0], 'order_id': p[1], 'amount': p[2],
-            'status': p[3], 'payment_method': p[4], 'transaction_id': p[5], 'created_at': p[6]
-        } for p in payments]), 200
+        return payment_listing.respond(request.path, request.args)
     return jsonify({'message': 'Payment not found'}), 404
 
 @app.route('/api/payments/<int:payment_id>', methods=['GET'])
 def get_payment(payment_id):
     # Authorization is handled by Gateway
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
-    payment = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        payment = conn.execute('SELECT * FROM payments WHERE id = ?', (payment_id,)).fetchone()
     
     if payment:
         return jsonify({
@@ -250,9 +258,9 @@ def health():
     return jsonify({'status': 'healthy', 'service': 'payment-service'}), 200
 
 if __name__ == '__main__':
-    # Start RabbitMQ consumer in separate thread
-    consumer_thread = threading.Thread(target=start_consumer, daemon=True)
-    consumer_thread.start()
+    # Start RabbitMQ consumer workers, drained gracefully on SIGTERM
+    payment_consumer.start()
+    drain_on_shutdown(payment_consumer)
     
     # Start Flask app
     app.run(host='0.0.0.0', port=5004, debug=True)
\ No newline at end of file
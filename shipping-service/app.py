@@ -2,38 +2,29 @@
 Shipping Service - Handles delivery logistics and listens to payment events
 Port: 5005
 """
-from flask import Flask, jsonify
+from flask import Flask, request, jsonify
 from flask_cors import CORS
-import sqlite3
-import pika
-import json
+import os
 import requests
 import time
-import threading
 
-import logging
-from pythonjsonlogger import jsonlogger
 from flask import g
 from prometheus_flask_exporter import PrometheusMetrics
 
-import logstash
+from common.log_shipping import setup_logging
+from common.access_log import init_access_log
+from common.db import Database, init_query_plans
+from common.listing import Listing
+from common.events import EventPublisher
+from common.consumer import EventConsumer, drain_on_shutdown
+from common.pipeline import Pipeline, Stage, StageTimeout
 
-# Configure Structured Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Console Handler (JSON)
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(level)s %(name)s %(message)s')
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Logstash Handler
-logstash_handler = logstash.TCPLogstashHandler('logstash', 5000, version=1)
-logger.addHandler(logstash_handler)
+# Configure Structured Logging (JSON console + asynchronous Logstash shipping)
+logger = setup_logging()
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app, path=None)
+init_access_log(app, 'shipping-service')
 
 from prometheus_client import generate_latest
 
@@ -47,135 +38,183 @@ def before_request():
     g.correlation_id = request.headers.get('X-Correlation-ID')
     if not g.correlation_id:
         g.correlation_id = "unknown"
-        
-    logger.info(f"Request received: {request.method} {request.path}", extra={
-        'service': 'shipping-service',
-        'correlation_id': g.correlation_id,
-        'method': request.method,
-        'path': request.path
-    })
 
 CORS(app)
 
 RABBITMQ_HOST = 'rabbitmq'
 RABBITMQ_PORT = 5672
+ORDER_SERVICE_URL = 'http://order-service:5003'
+
+# Shipment Pipeline Configuration
+SHIPPING_MAX_IN_FLIGHT = int(os.getenv('SHIPPING_MAX_IN_FLIGHT', '64'))  # Unacked shipments (consumer prefetch)
+SHIPPING_CARRIER_WORKERS = int(os.getenv('SHIPPING_CARRIER_WORKERS', '32'))
+SHIPPING_NOTIFY_WORKERS = int(os.getenv('SHIPPING_NOTIFY_WORKERS', '8'))
+SHIPPING_STAGE_QUEUE_SIZE = int(os.getenv('SHIPPING_STAGE_QUEUE_SIZE', '64'))
+SHIPPING_QUEUE_TIMEOUT = float(os.getenv('SHIPPING_QUEUE_TIMEOUT', '60'))  # Max wait for a carrier worker
+SHIPPING_PREPARE_SECONDS = float(os.getenv('SHIPPING_PREPARE_SECONDS', '2'))  # Simulated carrier booking time
+SHIPPING_CARRIER_TIMEOUT = float(os.getenv('SHIPPING_CARRIER_TIMEOUT', '10'))  # Request timeout of a carrier booking
+SHIPPING_CONNECT_TIMEOUT = float(os.getenv('SHIPPING_CONNECT_TIMEOUT', '2'))
+SHIPPING_ORDER_TIMEOUT = float(os.getenv('SHIPPING_ORDER_TIMEOUT', '5'))  # Read timeout for the order-status update
+
+# Database: pooled WAL connections (see common/db.py)
+db = Database('shipping.db')
+
+# Schema migrations: (version, statements), each applied once per database file
+MIGRATIONS = [
+    (1, ['''CREATE TABLE IF NOT EXISTS shipments
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   order_id INTEGER NOT NULL,
+                   tracking_number TEXT,
+                   status TEXT DEFAULT 'preparing',
+                   carrier TEXT,
+                   estimated_delivery TEXT,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''']),
+    # Secondary indexes for the hot lookups (see /diagnostics/query-plans)
+    (2, ['CREATE INDEX IF NOT EXISTS idx_shipments_tracking_number ON shipments (tracking_number)',
+         'CREATE INDEX IF NOT EXISTS idx_shipments_order_id ON shipments (order_id)']),
+    # Indexes for the shipment list's ?status= filter and ?sort=created_at
+    (3, ['CREATE INDEX IF NOT EXISTS idx_shipments_status ON shipments (status)',
+         'CREATE INDEX IF NOT EXISTS idx_shipments_created ON shipments (created_at)']),
+]
 
 def init_db():
-    conn = sqlite3.connect('shipping.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS shipments
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  order_id INTEGER NOT NULL,
-                  tracking_number TEXT,
-                  status TEXT DEFAULT 'preparing',
-                  carrier TEXT,
-                  estimated_delivery TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    db.migrate(MIGRATIONS)
 
 init_db()
 
+# Hot queries whose plans are served at /diagnostics/query-plans
+HOT_QUERIES = {
+    'track_shipment': ('SELECT * FROM shipments WHERE tracking_number = ?', ('TRACK-1',)),
+    'shipments_by_order': ('SELECT * FROM shipments WHERE order_id = ?', (1,))
+}
+init_query_plans(app, db, HOT_QUERIES)
+
+# Event Publishing: one long-lived connection with publisher confirms (see common/events.py)
+event_publisher = EventPublisher('order_events', host=RABBITMQ_HOST, port=RABBITMQ_PORT)
+
+# Keep-alive connections to Order Service, shared by the order-status workers
+order_service_session = requests.Session()
+order_service_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=SHIPPING_NOTIFY_WORKERS))
+
 def publish_event(event_type, data):
-    """Publish event to RabbitMQ"""
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-        channel = connection.channel()
-        channel.exchange_declare(exchange='order_events', exchange_type='topic', durable=True)
-        
-        message = json.dumps({'event': event_type, 'data': data})
-        channel.basic_publish(
-            exchange='order_events',
-            routing_key=event_type,
-            body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        connection.close()
-        print(f"Published event: {event_type}")
-    except Exception as e:
-        print(f"Error publishing event: {str(e)}")
+    """Publish event to RabbitMQ (buffered locally, confirmed asynchronously)"""
+    event_publisher.publish_event(event_type, data)
 
-def process_shipping(payment_data):
-    """Create shipment after payment is completed"""
-    order_id = payment_data['order_id']
-    
-    logger.info(f"Processing shipment for order {order_id}", extra={'correlation_id': g.correlation_id})
+def book_with_carrier(order_id, timeout):
+    """Carrier booking (simulated): returns (tracking number, carrier, estimated delivery)
+
+    The order id is the booking's idempotency key, so booking an order again (a retry after a
+    timeout the carrier did get to) returns the same booking. Like a request timeout on the
+    carrier call, raises TimeoutError once timeout seconds pass without an answer.
+    """
+    if SHIPPING_PREPARE_SECONDS > timeout:
+        time.sleep(timeout)
+        raise TimeoutError(f"Carrier did not answer within {timeout}s")
+    time.sleep(SHIPPING_PREPARE_SECONDS)
+    return f'TRACK-{order_id}', 'DHL', '2024-12-10'
+
+def prepare_shipment(shipment):
+    """Carrier step: book the shipment with the carrier within SHIPPING_CARRIER_TIMEOUT"""
+    order_id = shipment['order_id']
+    logger.info(f"Processing shipment for order {order_id}", extra={'correlation_id': shipment['correlation_id']})
     
-    # Simulate shipping preparation
-    time.sleep(2)
+    with db.connection() as conn:
+        existing = conn.execute('''SELECT id, tracking_number, carrier, estimated_delivery FROM shipments
+                                   WHERE order_id = ? LIMIT 1''', (order_id,)).fetchone()
+    if existing is not None:
+        # A redelivery (or a second payment.completed): booked and saved already, only notify again
+        logger.info(f"Order {order_id} already has shipment {existing[0]}, not booking again",
+                    extra={'correlation_id': shipment['correlation_id']})
+        shipment['shipment_id'], shipment['tracking_number'], shipment['carrier'], shipment['estimated_delivery'] = existing
+        return shipment
     
-    # Create shipment record
-    conn = sqlite3.connect('shipping.db')
-    c = conn.cursor()
-    tracking_number = f'TRACK-{order_id}-{int(time.time())}'
-    c.execute('''INSERT INTO shipments (order_id, tracking_number, status, carrier, estimated_delivery)
-                 VALUES (?, ?, ?, ?, ?)''',
-              (order_id, tracking_number, 'shipped', 'DHL', '2024-12-10'))
-    conn.commit()
-    shipment_id = c.lastrowid
-    conn.close()
+    tracking_number, carrier, estimated_delivery = book_with_carrier(order_id, SHIPPING_CARRIER_TIMEOUT)
+    shipment['tracking_number'] = tracking_number
+    shipment['carrier'] = carrier
+    shipment['estimated_delivery'] = estimated_delivery
+    return shipment
+
+def save_shipment(shipment):
+    """Persistence step: create the shipment record (one per order)"""
+    if 'shipment_id' in shipment:
+        return shipment  # Saved by an earlier delivery
+    with db.transaction() as conn:
+        existing = conn.execute('SELECT id FROM shipments WHERE order_id = ? LIMIT 1', (shipment['order_id'],)).fetchone()
+        if existing is not None:
+            shipment['shipment_id'] = existing[0]
+            return shipment
+        c = conn.execute('''INSERT INTO shipments (order_id, tracking_number, status, carrier, estimated_delivery)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         (shipment['order_id'], shipment['tracking_number'], 'shipped',
+                          shipment['carrier'], shipment['estimated_delivery']))
+    shipment['shipment_id'] = c.lastrowid
+    return shipment
+
+def notify_shipped(shipment):
+    """Order-status step: update the order's shipping status and publish ShipmentCreated"""
+    order_id = shipment['order_id']
+    correlation_id = shipment['correlation_id']
     
-    # Update order shipping status (synchronous call to Order Service)
+    # Update order shipping status (synchronous call to Order Service, bounded by a timeout)
     try:
-        requests.put(
-            f'http://order-service:5003/api/orders/{order_id}/shipping-status',
-            json={'shipping_status': 'shipped'}
+        response = order_service_session.put(
+            f'{ORDER_SERVICE_URL}/api/orders/{order_id}/shipping-status',
+            json={'shipping_status': 'shipped'},
+            headers={'X-Correlation-ID': correlation_id},
+            timeout=(SHIPPING_CONNECT_TIMEOUT, SHIPPING_ORDER_TIMEOUT)
         )
+        response.raise_for_status()
     except Exception as e:
-        print(f"Error updating order shipping status: {str(e)}")
+        logger.error(f"Error updating order shipping status: {str(e)}", extra={'correlation_id': correlation_id})
     
     # Publish ShipmentCreated event (asynchronous)
     publish_event('shipment.created', {
-        'shipment_id': shipment_id,
+        'shipment_id': shipment['shipment_id'],
         'order_id': order_id,
-        'tracking_number': tracking_number,
-        'customer_id': payment_data['customer_id']
+        'tracking_number': shipment['tracking_number'],
+        'customer_id': shipment['customer_id']
     })
     
-    logger.info(f"Shipment created for order {order_id}, tracking: {tracking_number}", extra={'correlation_id': g.correlation_id})
+    logger.info(f"Shipment created for order {order_id}, tracking: {shipment['tracking_number']}",
+                extra={'correlation_id': correlation_id})
+    return shipment
 
-def callback(ch, method, properties, body):
-    """RabbitMQ message callback"""
-    try:
-        message = json.loads(body)
-        event_type = message.get('event')
-        data = message.get('data')
-        
-        logger.info(f"Received event: {event_type}", extra={'correlation_id': 'system'})
-        
-        if event_type == 'payment.completed':
-            process_shipping(data)
-        
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}", extra={'correlation_id': 'system'})
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-
-def start_consumer():
-    """Start RabbitMQ consumer in separate thread"""
-    while True:
-        try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-            channel = connection.channel()
-            
-            # Declare exchange and queue
-            channel.exchange_declare(exchange='order_events', exchange_type='topic', durable=True)
-            result = channel.queue_declare(queue='shipping_queue', durable=True)
-            queue_name = result.method.queue
-            
-            # Bind queue to exchange with routing key
-            channel.queue_bind(exchange='order_events', queue=queue_name, routing_key='payment.completed')
-            
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=queue_name, on_message_callback=callback)
-            
-            logger.info('Shipping Service: Waiting for payment events...', extra={'correlation_id': 'system'})
-            channel.start_consuming()
-        except Exception as e:
-            logger.error(f"Consumer error: {str(e)}", extra={'correlation_id': 'system'})
-            time.sleep(5)
+# Shipment Pipeline: each step has its own workers and bounded queue (see common/pipeline.py)
+shipping_pipeline = Pipeline('shipping', [
+    Stage('carrier', prepare_shipment, workers=SHIPPING_CARRIER_WORKERS, queue_size=SHIPPING_STAGE_QUEUE_SIZE,
+          timeout=SHIPPING_QUEUE_TIMEOUT),
+    Stage('persist', save_shipment, workers=1, queue_size=SHIPPING_STAGE_QUEUE_SIZE),
+    Stage('order_status', notify_shipped, workers=SHIPPING_NOTIFY_WORKERS, queue_size=SHIPPING_STAGE_QUEUE_SIZE)
+])
+
+def process_shipping(payment_data):
+    """Create shipment after payment is completed; returns the Future of the pipeline run"""
+    return shipping_pipeline.submit({
+        'order_id': payment_data['order_id'],
+        'customer_id': payment_data['customer_id'],
+        'correlation_id': g.correlation_id
+    })
+
+def handle_event(event_type, data):
+    """Handle an event from shipping_queue (acked once its shipment leaves the pipeline)"""
+    if event_type == 'payment.completed':
+        return process_shipping(data)
+
+# RabbitMQ consumer: the prefetch window bounds the shipments in the pipeline. A shipment that timed
+# out (carrier timeout, or too long in the carrier queue) goes back to the queue to be tried again:
+# the order is paid, dropping it would leave it unshipped. After CONSUMER_MAX_REDELIVERIES tries it
+# is parked in shipping_queue.dead (see common/consumer.py).
+shipping_consumer = EventConsumer('shipping_queue', 'order_events', ['payment.completed'], handle_event,
+                                  app=app, prefetch=SHIPPING_MAX_IN_FLIGHT, host=RABBITMQ_HOST, port=RABBITMQ_PORT,
+                                  requeue_on=(StageTimeout, TimeoutError))
+
+# Shipment list: ?limit=&after= keyset pages, ?order_id= / ?status= filters (see common/listing.py)
+shipment_listing = Listing(db, 'shipments', ['id', 'order_id', 'tracking_number', 'status', 'carrier',
+                                             'estimated_delivery', 'created_at'],
+                           lambda s: {
+                               'id': s[0], 'order_id': s[1], 'tracking_number': s[2],
+                               'status': s[3], 'carrier': s[4], 'estimated_delivery': s[5], 'created_at': s[6]
+                           }, filters=['order_id', 'status'], sorts=['created_at'])
 
 # API endpoints
 @app.route('/api/shipments', methods=['GET'])
@@ -185,32 +224,20 @@ def get_shipments():
     user_id = request.headers.get('X-User-Id')
     user_role = request.headers.get('X-User-Role')
     
-    conn = sqlite3.connect('shipping.db')
-    c = conn.cursor()
-    
     # Customers see only their shipments
     if user_role == 'customer':
-        c.execute('''SELECT s.* FROM shipments s
-                     JOIN orders o ON s.order_id = o.id
-                     WHERE o.customer_id = ?''', (user_id,))
-    else:
-        c.execute('SELECT * FROM shipments')
-    
-    shipments = c.fetchall()
-    conn.close()
+        with db.connection() as conn:
+            shipments = conn.execute('''SELECT s.* FROM shipments s
+                                        JOIN orders o ON s.order_id = o.id
+                                        WHERE o.customer_id = ?''', (user_id,)).fetchall()
+        return jsonify([shipment_listing.to_dict(s) for s in shipments]), 200
     
-    return jsonify([{
-        'id': s[0], 'order_id': s[1], 'tracking_number': s[2],
-        'status': s[3], 'carrier': s[4], 'estimated_delivery': s[5], 'created_at': s[6]
-    } for s in shipments]), 200
+    return shipment_listing.respond(request.path, request.args)
 
 @app.route('/api/shipments/<int:shipment_id>', methods=['GET'])
 def get_shipment(shipment_id):
-    conn = sqlite3.connect('shipping.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM shipments WHERE id = ?', (shipment_id,))
-    shipment = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        shipment = conn.execute('SELECT * FROM shipments WHERE id = ?', (shipment_id,)).fetchone()
     
     if shipment:
         return jsonify({
@@ -222,11 +249,8 @@ def get_shipment(shipment_id):
 
 @app.route('/api/shipments/track/<tracking_number>', methods=['GET'])
 def track_shipment(tracking_number):
-    conn = sqlite3.connect('shipping.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM shipments WHERE tracking_number = ?', (tracking_number,))
-    shipment = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        shipment = conn.execute('SELECT * FROM shipments WHERE tracking_number = ?', (tracking_number,)).fetchone()
     
     if shipment:
         return jsonify({
@@ -241,9 +265,9 @@ def health():
     return jsonify({'status': 'healthy', 'service': 'shipping-service'}), 200
 
 if __name__ == '__main__':
-    # Start RabbitMQ consumer in separate thread
-    consumer_thread = threading.Thread(target=start_consumer, daemon=True)
-    consumer_thread.start()
+    # Start RabbitMQ consumer feeding the shipment pipeline, drained gracefully on SIGTERM
+    shipping_consumer.start()
+    drain_on_shutdown(shipping_consumer)
     
     # Start Flask app
     app.run(host='0.0.0.0', port=5005, debug=True)
\ No newline at end of file